@@ -0,0 +1,614 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of the migration stages with synthetic catalogues.
+
+Generates ``datasets.csv``, ``datafiles.csv`` and raw files at several
+scales, runs the stages of :mod:`nesstar` against the local stand-in API of
+:mod:`fakeapi` and writes wall time, throughput, peak RSS and file I/O per
+stage to a JSON file:
+
+    python -m benchmark --scales 100 10000 --output benchmark.json
+    python -m benchmark --scales 100 --compare benchmark.json
+
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import nesstar
+from client import configure_session
+from metrics import METRICS
+
+SCALES = [100, 10000, 100000]
+STAGES = [
+    "import_datasets",
+    "import_datafiles",
+    "setup_dirs",
+    "create_datasets_json",
+    "upload_datasets",
+    "create_datafiles_json",
+    "upload_datafiles",
+]
+DATAVERSE_IDS = ["aussda", "autnes", "ssoe", "wvs"]
+TABULAR_EXTENSIONS = [".sav", ".dta"]
+DOCUMENT_EXTENSIONS = [".pdf", ".txt"]
+CATEGORIES = [["Data"], ["Documentation"], ["Questionnaire"], ["Codebook"]]
+SERVER_STARTUP_TIMEOUT = 10
+REGRESSION_THRESHOLD = 0.2
+DATASETS_HEADER = [
+    "org.dataset_id",
+    "org.dataverse_id",
+    "org.doi",
+    "org.to_upload",
+    "org.is_uploaded",
+    "org.to_publish",
+    "org.is_published",
+    "dv.title",
+    "dv.author",
+    "dv.datasetContact",
+    "dv.dsDescription",
+    "dv.subject",
+    "dv.keyword",
+    "dv.kindOfData",
+]
+DATAFILES_HEADER = [
+    "org.datafile_id",
+    "org.dataset_id",
+    "org.filename",
+    "org.to_upload",
+    "org.is_uploaded",
+    "dv.description",
+    "dv.categories",
+    "dv.restrict",
+]
+
+
+def generate_catalogue(
+    data_dir,
+    num_datasets,
+    datafiles_per_dataset=3,
+    file_size=64 * 1024,
+    tabular_share=0.3,
+    seed=0,
+):
+    """Generate a synthetic NESSTAR catalogue with raw files.
+
+    Parameters
+    ----------
+    data_dir : string
+        Directory, where ``datasets.csv``, ``datafiles.csv`` and the ``raw``
+        directory are created in.
+    num_datasets : int
+        Number of datasets.
+    datafiles_per_dataset : int
+        Number of datafiles per dataset.
+    file_size : int
+        Size of each raw file in bytes.
+    tabular_share : float
+        Share of datafiles with a tabular file format (``.sav``, ``.dta``).
+    seed : int
+        Seed of the random generator, for reproducible catalogues.
+
+    Returns
+    -------
+    dict
+        Number of datasets, datafiles and raw bytes generated.
+
+    """
+    rand = random.Random(seed)
+    raw_dir = os.path.join(data_dir, "raw")
+    os.makedirs(raw_dir, exist_ok=True)
+    # one random block, repeated and prefixed with the filename, keeps the
+    # generation fast while every file gets its own checksum.
+    block = bytes(rand.getrandbits(8) for _ in range(min(file_size, 64 * 1024)))
+    num_datafiles = 0
+    num_bytes = 0
+    with open(
+        os.path.join(data_dir, "datasets.csv"), "w", newline="", encoding="utf-8"
+    ) as ds_file, open(
+        os.path.join(data_dir, "datafiles.csv"), "w", newline="", encoding="utf-8"
+    ) as df_file:
+        ds_writer = csv.DictWriter(ds_file, fieldnames=DATASETS_HEADER)
+        df_writer = csv.DictWriter(df_file, fieldnames=DATAFILES_HEADER)
+        ds_writer.writeheader()
+        df_writer.writeheader()
+        for ds_num in range(num_datasets):
+            ds_id = "{0:06d}".format(ds_num + 1)
+            ds_writer.writerow(
+                {
+                    "org.dataset_id": ds_id,
+                    "org.dataverse_id": rand.choice(DATAVERSE_IDS),
+                    "org.doi": "",
+                    "org.to_upload": "TRUE",
+                    "org.is_uploaded": "FALSE",
+                    "org.to_publish": "TRUE",
+                    "org.is_published": "FALSE",
+                    "dv.title": "Synthetic Study {0}".format(ds_id),
+                    "dv.author": json.dumps(
+                        [
+                            {
+                                "authorName": "Author {0}".format(rand.randint(1, 999)),
+                                "authorAffiliation": "AUSSDA",
+                            }
+                        ]
+                    ),
+                    "dv.datasetContact": json.dumps(
+                        [
+                            {
+                                "datasetContactName": "AUSSDA",
+                                "datasetContactEmail": "info@aussda.at",
+                            }
+                        ]
+                    ),
+                    "dv.dsDescription": json.dumps(
+                        [
+                            {
+                                "dsDescriptionValue": "Description of study {0}.".format(
+                                    ds_id
+                                )
+                            }
+                        ]
+                    ),
+                    "dv.subject": json.dumps(["Social Sciences"]),
+                    "dv.keyword": json.dumps(
+                        [{"keywordValue": "keyword {0}".format(rand.randint(1, 50))}]
+                    ),
+                    "dv.kindOfData": json.dumps(["Survey data"]),
+                }
+            )
+            for df_num in range(datafiles_per_dataset):
+                if rand.random() < tabular_share:
+                    extension = rand.choice(TABULAR_EXTENSIONS)
+                else:
+                    extension = rand.choice(DOCUMENT_EXTENSIONS)
+                filename = "{0}_{1}{2}".format(ds_id, df_num + 1, extension)
+                df_writer.writerow(
+                    {
+                        "org.datafile_id": "{0}_{1}".format(ds_id, df_num + 1),
+                        "org.dataset_id": ds_id,
+                        "org.filename": filename,
+                        "org.to_upload": "TRUE",
+                        "org.is_uploaded": "FALSE",
+                        "dv.description": "File {0} of study {1}.".format(
+                            df_num + 1, ds_id
+                        ),
+                        "dv.categories": json.dumps(rand.choice(CATEGORIES)),
+                        "dv.restrict": rand.choice(["TRUE", "FALSE"]),
+                    }
+                )
+                num_bytes += write_raw_file(
+                    os.path.join(raw_dir, filename), block, file_size
+                )
+                num_datafiles += 1
+    return {
+        "datasets": num_datasets,
+        "datafiles": num_datafiles,
+        "raw_bytes": num_bytes,
+    }
+
+
+def write_raw_file(filename, block, file_size):
+    """Write a raw file of `file_size` bytes, made of a repeated block."""
+    header = filename.encode("utf-8")[:file_size]
+    remaining = file_size - len(header)
+    with open(filename, "wb") as f:
+        f.write(header)
+        while remaining > 0:
+            chunk = block[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+    return file_size
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process, if the kernel supports it.
+
+    Returns
+    -------
+    bool
+        ``True`` if the peak was reset, so it can be measured per stage.
+
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+    """Return the peak RSS of the process in bytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Linux reports kilobytes, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def read_io_counters():
+    """Return the I/O counters of the process in bytes.
+
+    ``read_bytes`` and ``write_bytes`` count storage I/O, ``rchar`` and
+    ``wchar`` all bytes passed through read and write calls, including
+    sockets. Without ``/proc/self/io``, block counts of ``getrusage`` are used.
+
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, val = line.split(":")
+                counters[key] = int(val)
+    except OSError:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        counters["read_bytes"] = usage.ru_inblock * 512
+        counters["write_bytes"] = usage.ru_oublock * 512
+    return {
+        key: counters.get(key)
+        for key in ["rchar", "wchar", "read_bytes", "write_bytes"]
+    }
+
+
+def measure_stage(stage, num_items, func, *args, **kwargs):
+    """Run a stage function and measure it.
+
+    Parameters
+    ----------
+    stage : string
+        Name of the stage.
+    num_items : int
+        Number of items processed by the stage, for the throughput.
+    func : callable
+        Stage function.
+
+    Returns
+    -------
+    tuple
+        Return value of `func` and the measurements as dict.
+
+    """
+    peak_per_stage = reset_peak_rss()
+    io_start = read_io_counters()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    io_end = read_io_counters()
+    stats = {
+        "stage": stage,
+        "items": num_items,
+        "seconds": round(seconds, 4),
+        "cpu_seconds": round(cpu_seconds, 4),
+        "items_per_second": round(num_items / seconds, 2) if seconds else None,
+        "peak_rss_bytes": read_peak_rss(),
+        "peak_rss_per_stage": peak_per_stage,
+    }
+    for key, val in io_end.items():
+        if val is not None and io_start[key] is not None:
+            stats[key] = val - io_start[key]
+    return result, stats
+
+
+def start_fakeapi(latency=0.0, error_rate=0.0, ingest_lock=0.0, seed=0):
+    """Start the stand-in API in a separate process.
+
+    A separate process keeps the CPU time and memory of the server out of
+    the measurements.
+
+    Returns
+    -------
+    tuple
+        The server process and its base URL.
+
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakeapi.py"),
+            "--port",
+            str(port),
+            "--latency",
+            str(latency),
+            "--error-rate",
+            str(error_rate),
+            "--ingest-lock",
+            str(ingest_lock),
+            "--seed",
+            str(seed),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("Fake API server could not be started.")
+            time.sleep(0.05)
+    return process, "http://127.0.0.1:{0}".format(port)
+
+
+def configure_pipeline(data_dir, base_url, requests_per_second=0, lock_poll=0.1):
+    """Point the module settings of :mod:`nesstar` to a benchmark catalogue."""
+    nesstar.NUM_DATASETS = -1
+    nesstar.BASE_URL = base_url
+    nesstar.API_TOKEN = None
+    nesstar.DATA_DIR = data_dir
+    nesstar.RAW_DIR = os.path.join(data_dir, "raw")
+    nesstar.INGEST_DIR = os.path.join(data_dir, nesstar.INGEST_FOLDERNAME)
+    nesstar.FILENAME_DATASETS = os.path.join(data_dir, "datasets.csv")
+    nesstar.FILENAME_DATAFILES = os.path.join(data_dir, "datafiles.csv")
+    nesstar.FILENAME_IMPORT_CACHE = os.path.join(data_dir, "import_cache.pickle")
+    nesstar.FILENAME_CRAWL_CACHE = os.path.join(data_dir, "datafiles_crawl.json")
+    nesstar.UPLOAD_DATASETS_REQUESTS_PER_SECOND = requests_per_second
+    nesstar.UPLOAD_DATAFILES_REQUESTS_PER_SECOND = requests_per_second
+    nesstar.PUBLISH_REQUESTS_PER_SECOND = requests_per_second
+    nesstar.LOCK_POLL_INITIAL = lock_poll
+    os.makedirs(nesstar.INGEST_DIR, exist_ok=True)
+
+
+def run_scale(num_datasets, args):
+    """Generate a catalogue of one scale and run the selected stages on it.
+
+    A failing stage is recorded with its error and ends the run of the
+    scale, as the following stages depend on it.
+
+    Returns
+    -------
+    dict
+        Catalogue figures, the measurements of all stages and the API
+        request metrics.
+
+    """
+    data_dir = os.path.join(args.work_dir, "scale_{0}".format(num_datasets))
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir)
+    start = time.perf_counter()
+    catalogue = generate_catalogue(
+        data_dir,
+        num_datasets,
+        datafiles_per_dataset=args.datafiles_per_dataset,
+        file_size=args.file_size,
+        tabular_share=args.tabular_share,
+        seed=args.seed,
+    )
+    catalogue["generate_seconds"] = round(time.perf_counter() - start, 4)
+    num_datafiles = catalogue["datafiles"]
+
+    process = None
+    base_url = args.base_url
+    if not base_url and set(args.stages) & {"upload_datasets", "upload_datafiles"}:
+        process, base_url = start_fakeapi(
+            args.latency, args.error_rate, args.ingest_lock, args.seed
+        )
+    configure_pipeline(data_dir, base_url, args.requests_per_second, args.lock_poll)
+    data = {}
+    # stage: (number of items, call). The calls look `data` up when they run.
+    stage_calls = {
+        "import_datasets": (
+            num_datasets,
+            lambda: nesstar.import_datasets(
+                nesstar.read_csv_rows(nesstar.FILENAME_DATASETS)
+            ),
+        ),
+        "import_datafiles": (
+            num_datafiles,
+            lambda: nesstar.import_datafiles(
+                data, nesstar.read_csv_rows(nesstar.FILENAME_DATAFILES)
+            ),
+        ),
+        "setup_dirs": (num_datafiles, lambda: nesstar.setup_dirs(data)),
+        "create_datasets_json": (
+            num_datasets,
+            lambda: nesstar.create_datasets_json(data),
+        ),
+        "upload_datasets": (
+            num_datasets,
+            lambda: nesstar.upload_datasets(data, nesstar.FILENAME_DATASETS),
+        ),
+        "create_datafiles_json": (
+            num_datafiles,
+            lambda: nesstar.create_datafiles_json(data),
+        ),
+        "upload_datafiles": (
+            num_datafiles,
+            lambda: nesstar.upload_datafiles(data, nesstar.FILENAME_DATAFILES),
+        ),
+    }
+    stages = []
+    METRICS.reset()
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(
+            sys.stdout if args.verbose else devnull
+        ):
+            for stage in STAGES:
+                if stage not in args.stages:
+                    continue
+                num_items, call = stage_calls[stage]
+                try:
+                    result, stats = measure_stage(stage, num_items, call)
+                except Exception as e:
+                    error = "{0}: {1}".format(type(e).__name__, e)
+                    stages.append({"stage": stage, "items": num_items, "error": error})
+                    print(
+                        "{0:>8} {1:<22} ERROR {2}".format(num_datasets, stage, error),
+                        file=sys.__stdout__,
+                    )
+                    break
+                if stage.startswith("import_"):
+                    data = result
+                stages.append(stats)
+                print(
+                    "{0:>8} {1:<22} {2:>10.2f}s {3:>12} items/s {4:>8.1f} MB peak RSS".format(
+                        num_datasets,
+                        stage,
+                        stats["seconds"],
+                        stats["items_per_second"],
+                        stats["peak_rss_bytes"] / 1024 / 1024,
+                    ),
+                    file=sys.__stdout__,
+                )
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    if not args.keep:
+        shutil.rmtree(data_dir)
+    return {
+        "scale": num_datasets,
+        "catalogue": catalogue,
+        "stages": stages,
+        "metrics": METRICS.summary(),
+    }
+
+
+def compare_results(results, previous, threshold=REGRESSION_THRESHOLD):
+    """Compare the stage wall times of two benchmark runs.
+
+    Parameters
+    ----------
+    results : dict
+        Current benchmark results.
+    previous : dict
+        Benchmark results to compare with.
+    threshold : float
+        Relative slowdown, above which a stage counts as regression.
+
+    Returns
+    -------
+    list
+        Regressions as (scale, stage, previous seconds, current seconds).
+
+    """
+    previous_seconds = {
+        (scale["scale"], stats["stage"]): stats["seconds"]
+        for scale in previous["results"]
+        for stats in scale["stages"]
+        if "seconds" in stats
+    }
+    regressions = []
+    for scale in results["results"]:
+        for stats in scale["stages"]:
+            key = (scale["scale"], stats["stage"])
+            if key not in previous_seconds:
+                continue
+            before = previous_seconds[key]
+            after = stats.get("seconds")
+            if after is None:
+                # the stage ran before, but fails now
+                print("{0:>8} {1:<22} {2:>10.2f}s -> ERROR".format(*key, before))
+                regressions.append(key + (before, after))
+                continue
+            ratio = after / before if before else 1
+            print(
+                "{0:>8} {1:<22} {2:>10.2f}s -> {3:>10.2f}s ({4:+.0%})".format(
+                    key[0], key[1], before, after, ratio - 1
+                )
+            )
+            if ratio > 1 + threshold:
+                regressions.append(key + (before, after))
+    return regressions
+
+
+def main():
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--datafiles-per-dataset", type=int, default=3)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--tabular-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-url", default=None, help="use a running API server")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--ingest-lock", type=float, default=0.0)
+    parser.add_argument("--requests-per-second", type=float, default=0)
+    parser.add_argument("--lock-poll", type=float, default=0.1)
+    parser.add_argument("--work-dir", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep generated files")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="previous results file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    remove_work_dir = args.work_dir is None
+    if remove_work_dir:
+        args.work_dir = tempfile.mkdtemp(prefix="nesstar_benchmark_")
+    configure_session(pool_size=nesstar.HTTP_POOL_SIZE)
+    results = {
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {
+            key: val
+            for key, val in vars(args).items()
+            if key not in ["output", "compare", "work_dir", "verbose"]
+        },
+        "workers": {
+            "setup_dirs": nesstar.SETUP_DIRS_WORKERS,
+            "upload_datasets": nesstar.UPLOAD_DATASETS_WORKERS,
+            "upload_datafiles": nesstar.UPLOAD_DATAFILES_WORKERS,
+        },
+        "results": [],
+    }
+    try:
+        for num_datasets in args.scales:
+            results["results"].append(run_scale(num_datasets, args))
+    finally:
+        if remove_work_dir and not args.keep:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {0}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = compare_results(results, previous, args.threshold)
+        for scale, stage, before, after in regressions:
+            if after is None:
+                after = "ERROR"
+            else:
+                after = "{0:.2f}s".format(after)
+            print(
+                "REGRESSION: {0} datasets, {1}: {2:.2f}s -> {3}".format(
+                    scale, stage, before, after
+                )
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compact in-memory records of the imported catalogue."""
+import json
+import sys
+from collections.abc import MutableMapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson decodes the JSON columns faster, if installed
+if orjson:
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads
+
+# longer strings are rarely repeated, so they are not interned
+INTERN_MAX_LENGTH = 128
+
+
+class _Missing(object):
+    """Marker of a key without value in a :class:`Metadata` record."""
+
+    def __reduce__(self):
+        return "MISSING"
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+def decode_json(raw):
+    """Decode a JSON column."""
+    return json_loads(raw)
+
+
+def decode_other_id(raw):
+    """Decode the otherId JSON column, in which ``!`` stands for ``_``."""
+    return json_loads(raw.replace("!", "_"))
+
+
+def intern_value(val):
+    """Return a shared copy of short strings, other values unchanged.
+
+    Values like the Dataverse alias, the categories or flags repeat across
+    many rows, so all records refer to the same string object. The pickled
+    cache stores them only once as well.
+
+    """
+    if type(val) is str and len(val) <= INTERN_MAX_LENGTH:
+        return sys.intern(val)
+    return val
+
+
+class RecordSchema(object):
+    """Keys of the metadata records of one CSV header.
+
+    All records of a CSV file share one schema, so a record only holds its
+    values, in the order of the keys.
+
+    """
+
+    def __init__(self, keys, decoders=None):
+        """Init a RecordSchema() class.
+
+        Parameters
+        ----------
+        keys : list
+            Metadata keys. Duplicates are kept only once.
+        decoders : dict
+            Decoder by key, for values stored raw and decoded on access,
+            e. g. :func:`decode_json`.
+
+        """
+        self.keys = tuple(dict.fromkeys(keys))
+        self.index = {key: pos for pos, key in enumerate(self.keys)}
+        decoders = decoders or {}
+        self.decoders = tuple(decoders.get(key) for key in self.keys)
+
+    def __str__(self):
+        """Return name of RecordSchema() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the RecordSchema() class.
+
+        """
+        return "Record schema ({0} keys)".format(len(self.keys))
+
+    def new_values(self):
+        """Return an empty value list for a record."""
+        return [MISSING] * len(self.keys)
+
+
+class Metadata(MutableMapping):
+    """Metadata of a dataset or datafile, accessed like a dict.
+
+    Values are stored by position of their key in the shared
+    :class:`RecordSchema`. JSON columns stay raw strings and are decoded
+    every time they are read. Keys outside the schema (e. g. ``pid``, set by
+    the upload) and values set later are kept in a small dict.
+
+    """
+
+    __slots__ = ("schema", "values", "extra")
+
+    def __init__(self, schema, values=None, extra=None):
+        """Init a Metadata() class.
+
+        Parameters
+        ----------
+        schema : RecordSchema
+            Shared keys of the record.
+        values : list
+            Values in the order of the schema keys, :data:`MISSING` for
+            keys without value.
+        extra : dict
+            Values of keys not in the schema or decoded already.
+
+        """
+        self.schema = schema
+        self.values = values if values is not None else schema.new_values()
+        self.extra = extra
+
+    def __str__(self):
+        """Return name of Metadata() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the Metadata() class.
+
+        """
+        return "Metadata ({0} keys)".format(len(self))
+
+    def __repr__(self):
+        return "Metadata({0!r})".format(dict(self.items()))
+
+    def __reduce__(self):
+        return (Metadata, (self.schema, self.values, self.extra))
+
+    def __getitem__(self, key):
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        pos = self.schema.index.get(key)
+        if pos is None:
+            raise KeyError(key)
+        val = self.values[pos]
+        if val is MISSING:
+            raise KeyError(key)
+        decoder = self.schema.decoders[pos]
+        if decoder:
+            return decoder(val)
+        return val
+
+    def __setitem__(self, key, val):
+        pos = self.schema.index.get(key)
+        if pos is not None and not self.schema.decoders[pos]:
+            self.values[pos] = val
+            if self.extra:
+                self.extra.pop(key, None)
+            return
+        if pos is not None:
+            self.values[pos] = MISSING
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = val
+
+    def __delitem__(self, key):
+        found = False
+        if self.extra and key in self.extra:
+            del self.extra[key]
+            found = True
+        pos = self.schema.index.get(key)
+        if pos is not None and self.values[pos] is not MISSING:
+            self.values[pos] = MISSING
+            found = True
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if self.extra and key in self.extra:
+            return True
+        pos = self.schema.index.get(key)
+        return pos is not None and self.values[pos] is not MISSING
+
+    def __iter__(self):
+        for key, val in zip(self.schema.keys, self.values):
+            if val is not MISSING:
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        num_keys = len(self.values) - self.values.count(MISSING)
+        if self.extra:
+            num_keys += len(self.extra)
+        return num_keys
+
+
+class SlotRecord(MutableMapping):
+    """Record with a fixed set of keys, accessed like a dict.
+
+    The keys are the ``__slots__`` of the subclass, whose ``__init__`` takes
+    their values in the same order. A slot set to ``None`` counts as missing
+    key, e. g. ``'datafiles' in dataset`` is ``False`` for a dataset without
+    datafiles.
+
+    """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self.items()))
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        val = getattr(self, key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, val)
+
+    def __delitem__(self, key):
+        self[key]
+        setattr(self, key, None)
+
+    def __iter__(self):
+        for name in self.__slots__:
+            if getattr(self, name) is not None:
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+
+class DatasetRecord(SlotRecord):
+    """Dataset of the catalogue, with ``metadata`` and ``datafiles`` keys."""
+
+    __slots__ = ("metadata", "datafiles")
+
+    def __init__(self, metadata=None, datafiles=None):
+        """Init a DatasetRecord() class.
+
+        Parameters
+        ----------
+        metadata : Metadata
+            Dataset metadata.
+        datafiles : dict
+            :class:`DatafileRecord` by Datafile ID, ``None`` if the dataset
+            has no datafiles.
+
+        """
+        self.metadata = metadata
+        self.datafiles = datafiles
+
+    def __str__(self):
+        """Return name of DatasetRecord() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the DatasetRecord() class.
+
+        """
+        return "Dataset record ({0} datafiles)".format(len(self.datafiles or {}))
+
+
+class DatafileRecord(SlotRecord):
+    """Datafile of the catalogue, with a ``metadata`` key."""
+
+    __slots__ = ("metadata",)
+
+    def __init__(self, metadata=None):
+        """Init a DatafileRecord() class.
+
+        Parameters
+        ----------
+        metadata : Metadata
+            Datafile metadata.
+
+        """
+        self.metadata = metadata
+
+    def __str__(self):
+        """Return name of DatafileRecord() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the DatafileRecord() class.
+
+        """
+        return "Datafile record"
@@ -0,0 +1,201 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Dataverse API clients sharing one pooled HTTP session."""
+import threading
+import time
+
+import requests
+from pyDataverse.api import DataAccessApi, NativeApi
+from requests.adapters import HTTPAdapter
+
+from metrics import record_request
+
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 500
+MAX_RETRIES = 0
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+
+def configure_session(
+    pool_size=POOL_SIZE,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+    max_retries=MAX_RETRIES,
+):
+    """Create the HTTP session shared by all API clients.
+
+    Must be called before the first client is created, to take effect.
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of keep-alive connections per host. Should be at
+        least the number of concurrent workers of a stage.
+    connect_timeout : float
+        Timeout in seconds to establish a connection.
+    read_timeout : float
+        Timeout in seconds to wait for a response.
+    max_retries : int
+        Number of retries of failed connection attempts.
+
+    Returns
+    -------
+    requests.Session
+        The shared session.
+
+    """
+    global SESSION
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=max_retries,
+        pool_block=True,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.timeout = (connect_timeout, read_timeout)
+    with SESSION_LOCK:
+        SESSION = session
+    return session
+
+
+def get_session():
+    """Get the shared HTTP session, creating it with defaults if needed.
+
+    Returns
+    -------
+    requests.Session
+        The shared session.
+
+    """
+    with SESSION_LOCK:
+        session = SESSION
+    if session is None:
+        session = configure_session()
+    return session
+
+
+class PooledApiMixin(object):
+    """Send the requests of a pyDataverse API class via the shared session.
+
+    Overrides the request methods of :class:`pyDataverse.api.Api`, so all
+    API functions reuse the keep-alive connections of one pool instead of
+    opening a new connection per request.
+
+    """
+
+    def get_request(self, url, params=None, auth=False):
+        """Make a GET request."""
+        return self.request("GET", url, params=params)
+
+    def post_request(self, url, data=None, auth=False, params=None, files=None):
+        """Make a POST request."""
+        return self.request("POST", url, params=params, data=data, files=files)
+
+    def put_request(self, url, data=None, auth=False, params=None):
+        """Make a PUT request."""
+        return self.request("PUT", url, params=params, data=data)
+
+    def delete_request(self, url, auth=False, params=None):
+        """Make a DELETE request."""
+        return self.request("DELETE", url, params=params)
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        """Make a request via the shared session.
+
+        Latency, status and transferred bytes of every request are recorded
+        in :data:`metrics.METRICS`.
+
+        Parameters
+        ----------
+        method : string
+            HTTP method.
+        url : string
+            Full URL.
+        params : dict
+            Parameters added to the URL query.
+        headers : dict
+            Additional request headers.
+
+        Returns
+        -------
+        requests.Response
+            Response object of requests library.
+
+        """
+        session = get_session()
+        headers = dict(headers or {}, **{"User-Agent": "pydataverse"})
+        if self.api_token:
+            headers["X-Dataverse-key"] = str(self.api_token)
+        start = time.perf_counter()
+        try:
+            resp = session.request(
+                method,
+                url,
+                params=params,
+                headers=headers,
+                timeout=session.timeout,
+                **kwargs
+            )
+        except requests.RequestException:
+            record_request(method, url, "error", time.perf_counter() - start)
+            raise
+        record_request(
+            method,
+            url,
+            resp.status_code,
+            time.perf_counter() - start,
+            sent_bytes=int(resp.request.headers.get("Content-Length") or 0),
+            received_bytes=len(resp.content),
+        )
+        return resp
+
+
+class PooledNativeApi(PooledApiMixin, NativeApi):
+    """Native API client using the shared session."""
+
+
+class PooledDataAccessApi(PooledApiMixin, DataAccessApi):
+    """Data Access API client using the shared session."""
+
+
+def get_native_api(base_url, api_token=None):
+    """Create a Native API client using the shared session.
+
+    Parameters
+    ----------
+    base_url : string
+        Base URL of the Dataverse installation.
+    api_token : string
+        API token.
+
+    Returns
+    -------
+    PooledNativeApi
+        Native API client.
+
+    """
+    return PooledNativeApi(base_url, api_token)
+
+
+def get_data_access_api(base_url, api_token=None):
+    """Create a Data Access API client using the shared session.
+
+    Parameters
+    ----------
+    base_url : string
+        Base URL of the Dataverse installation.
+    api_token : string
+        API token.
+
+    Returns
+    -------
+    PooledDataAccessApi
+        Data Access API client.
+
+    """
+    return PooledDataAccessApi(base_url, api_token)
@@ -0,0 +1,780 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Dataverse Native API endpoints used by nesstar.
+
+Runs an in-memory Dataverse on one machine, so the pipeline stages can be
+tested and benchmarked without network access:
+
+    python -m fakeapi --port 8085 --latency 0.05 --error-rate 0.01 --ingest-lock 5
+
+"""
+import argparse
+import hashlib
+import io
+import json
+import mimetypes
+import posixpath
+import random
+import re
+import string
+import threading
+import time
+import zipfile
+from datetime import datetime
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TABULAR_EXTENSIONS = [".sav", ".dta", ".por", ".csv", ".xlsx", ".rdata"]
+
+
+class FakeDataverse(object):
+    """In-memory state of the fake Dataverse installation."""
+
+    def __init__(
+        self, doi_prefix="doi:10.5072", ingest_lock_seconds=0.0, part_size=5242880
+    ):
+        """Init a FakeDataverse() class.
+
+        Parameters
+        ----------
+        doi_prefix : string
+            Prefix of the generated persistent identifiers.
+        ingest_lock_seconds : float
+            Duration of the ingest lock after a tabular file was added.
+        part_size : int
+            Part size of direct uploads in bytes. Smaller files are uploaded
+            in one part.
+
+        """
+        self.doi_prefix = doi_prefix
+        self.ingest_lock_seconds = ingest_lock_seconds
+        self.part_size = part_size
+        self.lock = threading.Lock()
+        self.datasets = {}
+        self.datafiles = {}
+        self.uploads = {}
+        self.next_id = 1
+
+    def __str__(self):
+        """Return name of FakeDataverse() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the FakeDataverse() class.
+
+        """
+        return "Fake Dataverse ({0} datasets, {1} datafiles)".format(
+            len(self.datasets), len(self.datafiles)
+        )
+
+    def new_id(self):
+        """Return the next database ID. Must be called with the lock held."""
+        new_id = self.next_id
+        self.next_id += 1
+        return new_id
+
+    def active_locks(self, dataset):
+        """Return the locks of a dataset, which did not expire yet."""
+        now = time.monotonic()
+        dataset["locks"] = [lock for lock in dataset["locks"] if lock["until"] > now]
+        return dataset["locks"]
+
+    def dataset_json(self, dataset):
+        """Return the JSON representation of a dataset."""
+        return {
+            "id": dataset["id"],
+            "identifier": dataset["identifier"],
+            "persistentUrl": "https://doi.org/{0}".format(dataset["pid"][4:]),
+            "protocol": "doi",
+            "authority": dataset["pid"][4:].split("/")[0],
+            "latestVersion": {
+                "id": dataset["version_id"],
+                "versionState": dataset["version_state"],
+                "versionNumber": dataset["version_number"],
+                "versionMinorNumber": dataset["version_minor_number"],
+                "lastUpdateTime": dataset["last_update_time"],
+                "metadataBlocks": dataset["metadata_blocks"],
+                "files": [self.datafile_json(df) for df in self.dataset_files(dataset)],
+            },
+        }
+
+    def datafile_json(self, datafile):
+        """Return the file metadata JSON of a datafile, as listed in a version."""
+        return {
+            "label": datafile["label"],
+            "description": datafile["description"],
+            "directoryLabel": datafile["directoryLabel"],
+            "categories": datafile["categories"],
+            "restricted": datafile["restrict"],
+            "version": 1,
+            "datasetVersionId": self.datasets[datafile["pid"]]["version_id"],
+            "dataFile": {
+                "id": datafile["id"],
+                "filename": datafile["label"],
+                "contentType": datafile["contentType"],
+                "filesize": datafile["filesize"],
+                "checksum": {"type": "MD5", "value": datafile["md5"]},
+            },
+        }
+
+    def dataset_files(self, dataset):
+        """Return the datafiles of a dataset."""
+        return [self.datafiles[df_id] for df_id in dataset["datafile_ids"]]
+
+    def touch(self, dataset):
+        """Mark a dataset as changed."""
+        dataset["last_update_time"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+        if dataset["version_state"] == "RELEASED":
+            dataset["version_state"] = "DRAFT"
+            dataset["version_id"] = self.new_id()
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Request handler, routing Native API calls to the fake Dataverse."""
+
+    protocol_version = "HTTP/1.1"
+    routes = [
+        ("POST", r"/dataverses/(?P<alias>[^/]+)/datasets", "create_dataset"),
+        ("GET", r"/datasets/:persistentId", "get_dataset"),
+        ("GET", r"/datasets/(?P<id>\d+)", "get_dataset"),
+        ("DELETE", r"/datasets/:persistentId", "delete_dataset"),
+        ("DELETE", r"/datasets/:persistentId/versions/:draft", "delete_dataset"),
+        ("DELETE", r"/datasets/:persistentId/destroy", "destroy_dataset"),
+        ("POST", r"/datasets/:persistentId/add", "add_datafile"),
+        ("POST", r"/datasets/:persistentId/actions/:publish", "publish_dataset"),
+        ("PUT", r"/datasets/:persistentId/editMetadata", "edit_dataset_metadata"),
+        ("PUT", r"/datasets/:persistentId/deleteMetadata", "delete_dataset_metadata"),
+        (
+            "GET",
+            r"/datasets/:persistentId/versions/(?P<version>[^/]+)",
+            "get_dataset_version",
+        ),
+        (
+            "GET",
+            r"/datasets/:persistentId/versions/(?P<version>[^/]+)/files",
+            "get_datafiles",
+        ),
+        ("GET", r"/datasets/:persistentId/locks", "get_locks"),
+        ("GET", r"/datasets/:persistentId/uploadurls", "get_upload_urls"),
+        ("PUT", r"/s3/(?P<token>\w+)/(?P<part>\d+)", "put_upload_part"),
+        ("PUT", r"/datasets/mpupload", "complete_upload"),
+        ("DELETE", r"/datasets/mpupload", "abort_upload"),
+        ("POST", r"/files/(?P<id>\d+)/redetect", "redetect_datafile"),
+        ("PUT", r"/access/:persistentId/allowAccessRequest", "allow_access_request"),
+        ("POST", r"/files/(?P<id>\d+)/metadata", "update_datafile_metadata"),
+        (
+            "GET",
+            r"/files/(?P<id>\d+)/metadata(?P<draft>/draft)?",
+            "get_datafile_metadata",
+        ),
+    ]
+
+    def do_GET(self):
+        """Handle GET requests."""
+        self.dispatch("GET")
+
+    def do_POST(self):
+        """Handle POST requests."""
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        """Handle PUT requests."""
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        """Handle DELETE requests."""
+        self.dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        """Log only if the server is verbose."""
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def dispatch(self, method):
+        """Route a request to its handler method."""
+        url = urlparse(self.path)
+        self.query = {key: val[0] for key, val in parse_qs(url.query).items()}
+        self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = re.sub(r"^/api(/v1)?", "", url.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        # presigned storage URLs are sent without API token
+        presigned = path.startswith("/s3/")
+        keys = [self.headers.get("X-Dataverse-key"), self.query.get("key")]
+        if (
+            self.server.api_token
+            and not presigned
+            and self.server.api_token not in keys
+        ):
+            return self.send_json(401, error("Bad api key"))
+        if self.server.inject_error():
+            return self.send_json(500, error("Injected error."))
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern + "/?", path)
+            if route_method == method and match:
+                kwargs = match.groupdict()
+                with self.server.dataverse.lock:
+                    response = getattr(self, handler)(**kwargs)
+                return self.send_json(*response)
+        self.send_json(404, error("API endpoint does not exist on this server."))
+
+    def send_json(self, status, data, headers=None):
+        """Send a JSON response."""
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def form_data(self):
+        """Parse the multipart/form-data body into name: (filename, bytes)."""
+        message = BytesParser(policy=HTTP).parsebytes(
+            "Content-Type: {0}\r\n\r\n".format(self.headers["Content-Type"]).encode(
+                "utf-8"
+            )
+            + self.body
+        )
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        return fields
+
+    def find_dataset(self, id=None):
+        """Return the dataset addressed by ID or persistentId query."""
+        dataverse = self.server.dataverse
+        if id is not None:
+            for dataset in dataverse.datasets.values():
+                if str(dataset["id"]) == id:
+                    return dataset
+            return None
+        return dataverse.datasets.get(self.query.get("persistentId"))
+
+    def create_dataset(self, alias):
+        """Create a dataset from the Dataverse upload JSON."""
+        dataverse = self.server.dataverse
+        try:
+            metadata = json.loads(self.body)["datasetVersion"]["metadataBlocks"]
+        except (ValueError, KeyError, TypeError):
+            return 400, error("Error parsing Json: invalid dataset JSON.")
+        identifier = "FK2/" + "".join(
+            random.choice(string.ascii_uppercase + string.digits) for _ in range(6)
+        )
+        pid = "{0}/{1}".format(dataverse.doi_prefix, identifier)
+        dataset = {
+            "id": dataverse.new_id(),
+            "pid": pid,
+            "identifier": identifier,
+            "dataverse": alias,
+            "metadata_blocks": metadata,
+            "version_id": dataverse.new_id(),
+            "version_state": "DRAFT",
+            "version_number": None,
+            "version_minor_number": None,
+            "is_released": False,
+            "locks": [],
+            "datafile_ids": [],
+        }
+        dataverse.touch(dataset)
+        dataverse.datasets[pid] = dataset
+        return 201, ok({"id": dataset["id"], "persistentId": pid})
+
+    def get_dataset(self, id=None):
+        """Return the JSON representation of a dataset."""
+        dataset = self.find_dataset(id)
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        return 200, ok(self.server.dataverse.dataset_json(dataset))
+
+    def delete_dataset(self):
+        """Delete the draft version of a dataset."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        if dataset["version_state"] != "DRAFT":
+            return 404, error("This dataset does not have a draft version.")
+        if dataset["is_released"]:
+            dataset["version_state"] = "RELEASED"
+        else:
+            for df_id in dataset["datafile_ids"]:
+                del dataverse.datafiles[df_id]
+            del dataverse.datasets[dataset["pid"]]
+        return 200, ok({"message": "Draft version of dataset deleted"})
+
+    def destroy_dataset(self):
+        """Destroy a dataset, including its released versions."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        for df_id in dataset["datafile_ids"]:
+            del dataverse.datafiles[df_id]
+        del dataverse.datasets[dataset["pid"]]
+        return 200, ok({"message": "Dataset {0} destroyed".format(dataset["id"])})
+
+    def add_datafile(self):
+        """Add a file to a dataset, locking it while tabular files ingest."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        if dataverse.active_locks(dataset):
+            return 409, error("Dataset cannot be edited due to dataset lock.")
+        fields = self.form_data()
+        metadata = {}
+        if "jsonData" in fields and fields["jsonData"][1]:
+            metadata = json.loads(fields["jsonData"][1])
+        if "file" in fields:
+            filename, content = fields["file"]
+        elif "storageIdentifier" in metadata:
+            # file uploaded directly to the storage before
+            token = metadata["storageIdentifier"].rsplit(":", 1)[-1]
+            upload = dataverse.uploads.get(token)
+            if upload is None or not upload["complete"]:
+                return 400, error("Storage identifier not found.")
+            del dataverse.uploads[token]
+            filename = metadata.get("fileName", token)
+            content = b"".join(upload["parts"][num] for num in sorted(upload["parts"]))
+            checksum = metadata.get("checksum", {}).get("@value")
+            if checksum and checksum != hashlib.md5(content).hexdigest():
+                return 400, error("Checksum does not match the uploaded file.")
+        else:
+            return 400, error("A file must be uploaded.")
+        if not filename.lower().endswith(".zip") or "storageIdentifier" in metadata:
+            datafiles = [self.add_file(dataset, filename, content, metadata)]
+        else:
+            # zip files are unpacked, like Dataverse does for uploads via API
+            try:
+                with zipfile.ZipFile(io.BytesIO(content)) as archive:
+                    entries = [
+                        (info.filename, archive.read(info))
+                        for info in archive.infolist()
+                        if not info.is_dir()
+                    ]
+            except zipfile.BadZipFile:
+                return 400, error("Unzipping failed.")
+            datafiles = []
+            for name, data in entries:
+                entry_metadata = dict(metadata, label=posixpath.basename(name))
+                if posixpath.dirname(name):
+                    entry_metadata["directoryLabel"] = posixpath.dirname(name)
+                label = entry_metadata["label"]
+                datafiles.append(self.add_file(dataset, label, data, entry_metadata))
+        dataverse.touch(dataset)
+        return 200, ok({"files": [dataverse.datafile_json(df) for df in datafiles]})
+
+    def add_file(self, dataset, filename, content, metadata):
+        """Add one file to a dataset and return it."""
+        dataverse = self.server.dataverse
+        label = metadata.get("label") or filename
+        contentType = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        extension = "." + filename.rsplit(".", 1)[-1].lower()
+        if extension in TABULAR_EXTENSIONS:
+            # ingested files are renamed to .tab, just like in Dataverse
+            label = label.rsplit(".", 1)[0] + ".tab"
+            contentType = "text/tab-separated-values"
+            if dataverse.ingest_lock_seconds:
+                dataset["locks"].append(
+                    {
+                        "lockType": "Ingest",
+                        "date": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                        "user": "fakeapi",
+                        "until": time.monotonic() + dataverse.ingest_lock_seconds,
+                    }
+                )
+        datafile = {
+            "id": dataverse.new_id(),
+            "pid": dataset["pid"],
+            "label": label,
+            "description": metadata.get("description", ""),
+            "directoryLabel": metadata.get("directoryLabel"),
+            "categories": metadata.get("categories", []),
+            "restrict": metadata.get("restrict", False),
+            "contentType": contentType,
+            "filesize": len(content),
+            "md5": hashlib.md5(content).hexdigest(),
+        }
+        dataverse.datafiles[datafile["id"]] = datafile
+        dataset["datafile_ids"].append(datafile["id"])
+        return datafile
+
+    def publish_dataset(self):
+        """Publish a dataset, unless it is locked."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        if dataverse.active_locks(dataset):
+            return 409, error("Dataset is locked and can not be published.")
+        if dataset["version_state"] != "DRAFT":
+            return 409, error("Dataset has no draft version to publish.")
+        if self.query.get("type") == "minor" and dataset["is_released"]:
+            dataset["version_minor_number"] += 1
+        else:
+            dataset["version_number"] = (dataset["version_number"] or 0) + 1
+            dataset["version_minor_number"] = 0
+        dataset["version_state"] = "RELEASED"
+        dataset["is_released"] = True
+        return 200, ok(dataverse.dataset_json(dataset))
+
+    def edit_dataset_metadata(self):
+        """Add or replace metadata fields of a dataset."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        if dataverse.active_locks(dataset):
+            return 409, error("Dataset cannot be edited due to dataset lock.")
+        try:
+            new_fields = json.loads(self.body)["fields"]
+        except (ValueError, KeyError, TypeError):
+            return 400, error("Error parsing Json: invalid metadata JSON.")
+        replace = self.query.get("replace", "").lower() == "true"
+        for new_field in new_fields:
+            for block in dataset["metadata_blocks"].values():
+                for idx, field in enumerate(block["fields"]):
+                    if field["typeName"] == new_field["typeName"]:
+                        if not replace and not field.get("multiple"):
+                            message = (
+                                "You may not add data to a field that already "
+                                "has data and does not allow multiples."
+                            )
+                            return 400, error(message)
+                        if replace:
+                            block["fields"][idx] = new_field
+                        else:
+                            field["value"] = field["value"] + new_field["value"]
+                        break
+                else:
+                    continue
+                break
+            else:
+                dataset["metadata_blocks"].setdefault("citation", {"fields": []})[
+                    "fields"
+                ].append(new_field)
+        dataverse.touch(dataset)
+        return 200, ok(dataverse.dataset_json(dataset)["latestVersion"])
+
+    def delete_dataset_metadata(self):
+        """Remove metadata fields of a dataset."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        if dataverse.active_locks(dataset):
+            return 409, error("Dataset cannot be edited due to dataset lock.")
+        try:
+            fields = json.loads(self.body)["fields"]
+            type_names = [field["typeName"] for field in fields]
+        except (ValueError, KeyError, TypeError):
+            return 400, error("Error parsing Json: invalid metadata JSON.")
+        for block in dataset["metadata_blocks"].values():
+            block["fields"] = [
+                field
+                for field in block["fields"]
+                if field["typeName"] not in type_names
+            ]
+        dataverse.touch(dataset)
+        return 200, ok(dataverse.dataset_json(dataset)["latestVersion"])
+
+    def get_dataset_version(self, version):
+        """Return the latest version of a dataset, without files if excluded."""
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        data = self.server.dataverse.dataset_json(dataset)["latestVersion"]
+        if self.query.get("excludeFiles") == "true":
+            del data["files"]
+        return 200, ok(data)
+
+    def get_datafiles(self, version):
+        """List the datafiles of a dataset."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        return (
+            200,
+            ok(
+                [dataverse.datafile_json(df) for df in dataverse.dataset_files(dataset)]
+            ),
+        )
+
+    def get_locks(self):
+        """List the active locks of a dataset."""
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        locks = [
+            {key: val for key, val in lock.items() if key != "until"}
+            for lock in self.server.dataverse.active_locks(dataset)
+        ]
+        return 200, ok(locks)
+
+    def get_upload_urls(self):
+        """Return presigned URLs for a direct upload to the fake storage."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        size = int(self.query.get("size", 0))
+        token = "{0}{1}".format(dataverse.new_id(), random.getrandbits(32))
+        num_parts = max(1, -(-size // dataverse.part_size))
+        dataverse.uploads[token] = {
+            "pid": dataset["pid"],
+            "num_parts": num_parts,
+            "parts": {},
+            "complete": num_parts == 1,
+        }
+        url = "{0}/s3/{1}/{{0}}".format(self.server.base_url, token)
+        data = {"storageIdentifier": "s3://fakeapi:{0}".format(token)}
+        if num_parts == 1:
+            data["url"] = url.format(1)
+            data["partSize"] = size
+        else:
+            mpupload = "/api/datasets/mpupload?persistentId={0}&token={1}".format(
+                dataset["pid"], token
+            )
+            data["urls"] = {
+                str(num): url.format(num) for num in range(1, num_parts + 1)
+            }
+            data["partSize"] = dataverse.part_size
+            data["complete"] = mpupload
+            data["abort"] = mpupload
+        return 200, ok(data)
+
+    def put_upload_part(self, token, part):
+        """Store one part of a direct upload and return its ETag."""
+        upload = self.server.dataverse.uploads.get(token)
+        if upload is None or int(part) > upload["num_parts"]:
+            return 404, error("NoSuchUpload")
+        upload["parts"][int(part)] = self.body
+        etag = '"{0}"'.format(hashlib.md5(self.body).hexdigest())
+        return 200, {}, {"ETag": etag}
+
+    def complete_upload(self):
+        """Complete a multipart direct upload with the ETags of all parts."""
+        upload = self.server.dataverse.uploads.get(self.query.get("token"))
+        if upload is None:
+            return 404, error("NoSuchUpload")
+        etags = json.loads(self.body)
+        for num in range(1, upload["num_parts"] + 1):
+            content = upload["parts"].get(num)
+            if content is None or etags.get(str(num)) != '"{0}"'.format(
+                hashlib.md5(content).hexdigest()
+            ):
+                return 400, error("Part {0} is missing or invalid.".format(num))
+        upload["complete"] = True
+        return 200, ok({"message": "Multipart upload completed"})
+
+    def abort_upload(self):
+        """Abort a multipart direct upload."""
+        if self.server.dataverse.uploads.pop(self.query.get("token"), None) is None:
+            return 404, error("NoSuchUpload")
+        return 200, ok({"message": "Multipart upload aborted"})
+
+    def allow_access_request(self):
+        """Allow or disallow access requests for the files of a dataset."""
+        dataverse = self.server.dataverse
+        dataset = self.find_dataset()
+        if dataset is None:
+            return 404, error("Dataset not found.")
+        dataset["allow_access_request"] = self.body.strip().lower() == b"true"
+        dataverse.touch(dataset)
+        if dataset["allow_access_request"]:
+            return 200, ok({"message": "Access requests are enabled."})
+        return 200, ok({"message": "Access requests are disabled."})
+
+    def redetect_datafile(self, id):
+        """Redetect the content type of a datafile by its filename."""
+        datafile = self.server.dataverse.datafiles.get(int(id))
+        if datafile is None:
+            return 404, error("File not found.")
+        old_type = datafile["contentType"]
+        new_type = mimetypes.guess_type(datafile["label"])[0] or old_type
+        dry_run = self.query.get("dryRun", "false").lower() == "true"
+        if not dry_run:
+            datafile["contentType"] = new_type
+        return (
+            200,
+            ok(
+                {
+                    "dryRun": dry_run,
+                    "oldContentType": old_type,
+                    "newContentType": new_type,
+                }
+            ),
+        )
+
+    def update_datafile_metadata(self, id):
+        """Update the metadata of a datafile."""
+        dataverse = self.server.dataverse
+        datafile = dataverse.datafiles.get(int(id))
+        if datafile is None:
+            return 404, error("File not found.")
+        fields = self.form_data()
+        if "jsonData" not in fields:
+            return 400, error("jsonData is missing.")
+        metadata = json.loads(fields["jsonData"][1])
+        for key in ["label", "description", "directoryLabel", "categories", "restrict"]:
+            if key in metadata:
+                datafile[key] = metadata[key]
+        dataverse.touch(dataverse.datasets[datafile["pid"]])
+        return 200, ok({"message": "File Metadata update has been completed"})
+
+    def get_datafile_metadata(self, id, draft=None):
+        """Return the metadata of a datafile, unwrapped like Dataverse does."""
+        datafile = self.server.dataverse.datafiles.get(int(id))
+        if datafile is None:
+            return 404, error("File not found.")
+        return (
+            200,
+            {
+                key: datafile[key]
+                for key in [
+                    "label",
+                    "description",
+                    "directoryLabel",
+                    "categories",
+                    "restrict",
+                ]
+            },
+        )
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """HTTP server of the fake Dataverse Native API."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        latency=0.0,
+        error_rate=0.0,
+        ingest_lock_seconds=0.0,
+        part_size=5242880,
+        api_token=None,
+        seed=None,
+        verbose=False,
+    ):
+        """Init a FakeApiServer() class.
+
+        Parameters
+        ----------
+        address : tuple
+            Host and port to listen on. Port ``0`` picks a free port.
+        latency : float
+            Delay in seconds added to every request.
+        error_rate : float
+            Share of requests answered with an injected HTTP 500 error.
+        ingest_lock_seconds : float
+            Duration of the ingest lock after a tabular file was added.
+        part_size : int
+            Part size of direct uploads in bytes.
+        api_token : string
+            Required API token. ``None`` accepts every request.
+        seed : int
+            Seed of the error injection, for reproducible runs.
+        verbose : bool
+            ``True`` to log every request.
+
+        """
+        super().__init__(address, FakeApiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.api_token = api_token
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.dataverse = FakeDataverse(
+            ingest_lock_seconds=ingest_lock_seconds, part_size=part_size
+        )
+
+    @property
+    def base_url(self):
+        """Base URL to pass to the API clients."""
+        host, port = self.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def inject_error(self):
+        """Decide if the current request fails."""
+        if not self.error_rate:
+            return False
+        with self.random_lock:
+            return self.random.random() < self.error_rate
+
+
+def ok(data):
+    """Wrap data in a successful API response."""
+    return {"status": "OK", "data": data}
+
+
+def error(message):
+    """Wrap a message in an error API response."""
+    return {"status": "ERROR", "message": message}
+
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    """Start a fake API server in a background thread.
+
+    Parameters
+    ----------
+    host : string
+        Host to listen on.
+    port : int
+        Port to listen on. ``0`` picks a free port.
+    kwargs : dict
+        Options passed to :class:`FakeApiServer`.
+
+    Returns
+    -------
+    FakeApiServer
+        Running server. Stop it with ``server.shutdown()``.
+
+    """
+    server = FakeApiServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    """Run the fake API server from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--ingest-lock", type=float, default=0.0)
+    parser.add_argument("--part-size", type=int, default=5242880)
+    parser.add_argument("--api-token", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    server = FakeApiServer(
+        (args.host, args.port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        ingest_lock_seconds=args.ingest_lock,
+        part_size=args.part_size,
+        api_token=args.api_token,
+        seed=args.seed,
+        verbose=args.verbose,
+    )
+    print("Fake Dataverse API listening on {0}".format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Metrics of the migration stages and the Dataverse API requests.
+
+Counters, gauges and latency histograms are collected in one process wide
+registry (:data:`METRICS`) and written periodically to a Prometheus textfile
+(for the node exporter textfile collector) and a JSON summary.
+
+"""
+import functools
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+WRITE_INTERVAL = 15
+HELP = {
+    "nesstar_api_requests_total": "Dataverse API requests.",
+    "nesstar_api_request_duration_seconds": "Dataverse API request latency.",
+    "nesstar_api_sent_bytes_total": "Bytes sent to the Dataverse API.",
+    "nesstar_api_received_bytes_total": "Bytes received from the Dataverse API.",
+    "nesstar_stage_runs_total": "Stage runs by outcome.",
+    "nesstar_stage_duration_seconds": "Duration of the last stage run.",
+    "nesstar_stage_running": "1 while a stage is running.",
+}
+
+
+class Metrics(object):
+    """Thread-safe registry of counters, gauges and histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Init a Metrics() class.
+
+        Parameters
+        ----------
+        buckets : list
+            Upper bounds of the histogram buckets in seconds.
+
+        """
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __str__(self):
+        """Return name of Metrics() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the Metrics() class.
+
+        """
+        return "Metrics ({0} series)".format(
+            len(self.counters) + len(self.gauges) + len(self.histograms)
+        )
+
+    def reset(self):
+        """Delete all collected values."""
+        with self.lock:
+            self.start = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, labels=None, value=1):
+        """Increase a counter.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+        labels : dict
+            Label names and values of the series.
+        value : float
+            Increment.
+
+        """
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """Set a gauge.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+        value : float
+            New value.
+        labels : dict
+            Label names and values of the series.
+
+        """
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, labels=None):
+        """Add an observation to a histogram.
+
+        Parameters
+        ----------
+        name : string
+            Metric name.
+        value : float
+            Observed value, e. g. a latency in seconds.
+        labels : dict
+            Label names and values of the series.
+
+        """
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {
+                    "buckets": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                }
+                self.histograms[key] = histogram
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][idx] += 1
+                    break
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["max"] = max(histogram["max"], value)
+
+    def snapshot(self):
+        """Return a consistent copy of all collected values."""
+        with self.lock:
+            return (
+                dict(self.counters),
+                dict(self.gauges),
+                {
+                    key: dict(val, buckets=list(val["buckets"]))
+                    for key, val in self.histograms.items()
+                },
+            )
+
+    def to_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        string
+            Metrics as text.
+
+        """
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+        for kind, series in [("counter", counters), ("gauge", gauges)]:
+            for name in sorted({name for name, _ in series}):
+                lines += metric_header(name, kind)
+                for (series_name, labels), val in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(
+                            "{0}{1} {2}".format(name, format_labels(labels), val)
+                        )
+        for name in sorted({name for name, _ in histograms}):
+            lines += metric_header(name, "histogram")
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    cumulative += count
+                    bucket_labels = format_labels(labels + (("le", str(bound)),))
+                    lines.append(
+                        "{0}_bucket{1} {2}".format(name, bucket_labels, cumulative)
+                    )
+                bucket_labels = format_labels(labels + (("le", "+Inf"),))
+                lines.append(
+                    "{0}_bucket{1} {2}".format(name, bucket_labels, histogram["count"])
+                )
+                lines.append(
+                    "{0}_sum{1} {2}".format(
+                        name, format_labels(labels), histogram["sum"]
+                    )
+                )
+                lines.append(
+                    "{0}_count{1} {2}".format(
+                        name, format_labels(labels), histogram["count"]
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Summarize the metrics for humans and the benchmark.
+
+        Returns
+        -------
+        dict
+            Requests by endpoint with latency figures, totals and stages.
+
+        """
+        counters, gauges, histograms = self.snapshot()
+        uptime = time.time() - self.start
+        requests = []
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != "nesstar_api_request_duration_seconds":
+                continue
+            labels_dict = dict(labels)
+            endpoint_labels = (
+                ("endpoint", labels_dict["endpoint"]),
+                ("method", labels_dict["method"]),
+            )
+            requests.append(
+                dict(
+                    labels_dict,
+                    count=histogram["count"],
+                    seconds_mean=round(histogram["sum"] / histogram["count"], 4),
+                    seconds_max=round(histogram["max"], 4),
+                    seconds_p50=self.quantile(histogram, 0.5),
+                    seconds_p95=self.quantile(histogram, 0.95),
+                    sent_bytes=counters.get(
+                        ("nesstar_api_sent_bytes_total", endpoint_labels), 0
+                    ),
+                )
+            )
+        total_requests = sum(req["count"] for req in requests)
+        errors = sum(
+            req["count"]
+            for req in requests
+            if req["status"] == "error" or not req["status"].startswith(("2", "3"))
+        )
+        sent = sum(
+            val
+            for (name, _), val in counters.items()
+            if name == "nesstar_api_sent_bytes_total"
+        )
+        received = sum(
+            val
+            for (name, _), val in counters.items()
+            if name == "nesstar_api_received_bytes_total"
+        )
+        stages = {}
+        for (name, labels), val in counters.items():
+            if name == "nesstar_stage_runs_total":
+                labels_dict = dict(labels)
+                stage = stages.setdefault(labels_dict["stage"], {})
+                stage[labels_dict["outcome"]] = val
+        for (name, labels), val in gauges.items():
+            if name == "nesstar_stage_duration_seconds":
+                stages.setdefault(dict(labels)["stage"], {})["seconds"] = round(val, 4)
+        error_rate = 0
+        if total_requests:
+            error_rate = round(errors / total_requests, 4)
+        return {
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "uptime_seconds": round(uptime, 2),
+            "totals": {
+                "requests": total_requests,
+                "errors": errors,
+                "error_rate": error_rate,
+                "sent_bytes": sent,
+                "received_bytes": received,
+                "sent_bytes_per_second": round(sent / uptime, 2) if uptime else 0,
+            },
+            "requests": requests,
+            "stages": stages,
+        }
+
+    def quantile(self, histogram, q):
+        """Estimate a quantile as the upper bound of its histogram bucket."""
+        if not histogram["count"]:
+            return None
+        rank = q * histogram["count"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram["buckets"]):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return round(histogram["max"], 4)
+
+    def write(self, filename_prometheus=None, filename_json=None):
+        """Write the metrics files atomically.
+
+        Parameters
+        ----------
+        filename_prometheus : string
+            Full path of the Prometheus textfile (``*.prom``).
+        filename_json : string
+            Full path of the JSON summary.
+
+        """
+        if filename_prometheus:
+            write_atomic(filename_prometheus, self.to_prometheus())
+        if filename_json:
+            write_atomic(filename_json, json.dumps(self.summary(), indent=2))
+
+
+class MetricsWriter(object):
+    """Background thread writing the metrics files periodically."""
+
+    def __init__(
+        self,
+        metrics,
+        filename_prometheus=None,
+        filename_json=None,
+        interval=WRITE_INTERVAL,
+    ):
+        """Init a MetricsWriter() class.
+
+        Parameters
+        ----------
+        metrics : Metrics
+            Registry to write.
+        filename_prometheus : string
+            Full path of the Prometheus textfile (``*.prom``).
+        filename_json : string
+            Full path of the JSON summary.
+        interval : float
+            Seconds between two writes.
+
+        """
+        self.metrics = metrics
+        self.filename_prometheus = filename_prometheus
+        self.filename_json = filename_json
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __str__(self):
+        """Return name of MetricsWriter() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the MetricsWriter() class.
+
+        """
+        return "Metrics writer ({0}s interval)".format(self.interval)
+
+    def start(self):
+        """Start writing in the background."""
+        self.thread.start()
+        return self
+
+    def run(self):
+        """Write the files until stopped."""
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Write the files once, without failing the migration."""
+        try:
+            self.metrics.write(self.filename_prometheus, self.filename_json)
+        except OSError as e:
+            print("WARNING: Metrics could not be written - {0}".format(e))
+
+    def stop(self):
+        """Stop the background thread and write the final values."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.write()
+
+
+METRICS = Metrics()
+
+
+def label_key(labels):
+    """Return the labels as hashable, sorted tuple."""
+    if not labels:
+        return ()
+    return tuple(sorted((key, str(val)) for key, val in labels.items()))
+
+
+def format_labels(labels):
+    """Format a label tuple as Prometheus label set."""
+    if not labels:
+        return ""
+    return "{{{0}}}".format(
+        ",".join(
+            '{0}="{1}"'.format(
+                key, val.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            )
+            for key, val in labels
+        )
+    )
+
+
+def metric_header(name, kind):
+    """Return the HELP and TYPE lines of a metric."""
+    lines = []
+    if name in HELP:
+        lines.append("# HELP {0} {1}".format(name, HELP[name]))
+    lines.append("# TYPE {0} {1}".format(name, kind))
+    return lines
+
+
+def write_atomic(filename, content):
+    """Write a file via a temporary file, so readers never see partial files."""
+    filename_tmp = "{0}.tmp".format(filename)
+    with open(filename_tmp, "w") as f:
+        f.write(content)
+    os.replace(filename_tmp, filename)
+
+
+def endpoint_template(url):
+    """Reduce a request URL to its endpoint, to keep label cardinality low.
+
+    Numeric IDs become ``{id}``, query strings (e. g. the persistentId) are
+    dropped: ``/api/v1/files/42/redetect?dryRun=true`` becomes
+    ``/api/v1/files/{id}/redetect``.
+
+    """
+    path = urlparse(url).path.rstrip("/") or "/"
+    path = re.sub(r"/dataverses/[^/]+", "/dataverses/{alias}", path)
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+def record_request(
+    method, url, status, seconds, sent_bytes=0, received_bytes=0, endpoint=None
+):
+    """Record one Dataverse API request.
+
+    Parameters
+    ----------
+    method : string
+        HTTP method.
+    url : string
+        Request URL.
+    status : int or string
+        HTTP status code, ``"error"`` if no response was received.
+    seconds : float
+        Latency in seconds.
+    sent_bytes : int
+        Size of the request body.
+    received_bytes : int
+        Size of the response body.
+    endpoint : string
+        Endpoint label, for URLs without a fixed template (e. g. presigned
+        storage URLs). Derived from the URL, if not passed.
+
+    """
+    if endpoint is None:
+        endpoint = endpoint_template(url)
+    labels = {"method": method, "endpoint": endpoint, "status": status}
+    METRICS.inc("nesstar_api_requests_total", labels)
+    METRICS.observe("nesstar_api_request_duration_seconds", seconds, labels)
+    if sent_bytes:
+        METRICS.inc(
+            "nesstar_api_sent_bytes_total",
+            {"method": method, "endpoint": endpoint},
+            sent_bytes,
+        )
+    if received_bytes:
+        METRICS.inc(
+            "nesstar_api_received_bytes_total",
+            {"method": method, "endpoint": endpoint},
+            received_bytes,
+        )
+
+
+def timed_stage(name):
+    """Decorate a stage function to record its runs and duration.
+
+    Parameters
+    ----------
+    name : string
+        Stage name used as label.
+
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            labels = {"stage": name}
+            METRICS.set("nesstar_stage_running", 1, labels)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                seconds = time.perf_counter() - start
+                METRICS.set("nesstar_stage_duration_seconds", seconds, labels)
+                METRICS.set("nesstar_stage_running", 0, labels)
+                METRICS.inc("nesstar_stage_runs_total", dict(labels, outcome=outcome))
+
+        return wrapper
+
+    return decorator
+
+
+def start_metrics_writer(
+    filename_prometheus=None, filename_json=None, interval=WRITE_INTERVAL
+):
+    """Start writing :data:`METRICS` to files in the background.
+
+    Parameters
+    ----------
+    filename_prometheus : string
+        Full path of the Prometheus textfile (``*.prom``).
+    filename_json : string
+        Full path of the JSON summary.
+    interval : float
+        Seconds between two writes.
+
+    Returns
+    -------
+    MetricsWriter
+        Running writer. Call ``stop()`` to write the final values.
+
+    """
+    return MetricsWriter(METRICS, filename_prometheus, filename_json, interval).start()
@@ -2,23 +2,37 @@
 # -*- coding: utf-8 -*-
 """NESSTAR Datenmigration."""
 import csv
+import hashlib
 import json
 import os
 import time
+import zipfile
+from collections import Counter
 from datetime import datetime
-import subprocess as sp
-
-from pyDataverse.api import DataAccessApi, NativeApi
-from pyDataverse.models import Datafile, Dataset
-from pyDataverse.oaistree import (datafile_from_aip_to_dip,
-                                  datafile_from_raw_to_sip,
-                                  datafile_from_sip_to_aip,
-                                  delete_all_folders_inside, read_history,
-                                  save_datafile_dataverse_json,
-                                  save_dataset_dataverse_json, save_history,
-                                  setup_oaistree, update_csv)
+from itertools import islice
+
 from pyDataverse.utils import (read_csv_as_dicts, read_file, read_json,
-                               read_pickle, write_pickle, write_json)
+                               read_pickle, write_file, write_pickle,
+                               write_json)
+from catalogue import (DatafileRecord, DatasetRecord, Metadata, RecordSchema,
+                       decode_json, decode_other_id, intern_value,
+                       json_loads)
+from client import configure_session, get_data_access_api, get_native_api
+from oaistree import (StatusJournal, build_dataset_payload, checksum_file,
+                      datafile_from_aip_to_dip, datafile_from_raw_to_sip,
+                      datafile_from_sip_to_aip, datafile_json_filename,
+                      dataset_json_filename, delete_all_folders_inside,
+                      import_history_files, is_dataset_payload_current,
+                      open_state_store, read_datafile_payload,
+                      read_dataset_payload, read_history, read_manifest,
+                      save_datafile_dataverse_json, save_datafile_history,
+                      save_dataset_dataverse_json, save_history,
+                      save_manifest, setup_oaistree, verify_manifest)
+from metrics import start_metrics_writer, timed_stage
+from pipeline import (BLOCKED, CHECKPOINT, DONE, FAILED, SKIPPED, Pipeline,
+                      Stage)
+from upload import direct_upload_datafile, progress_printer, upload_datafile
+from workers import RateLimiter, backoff, run_concurrent
 
 # Settings Instance: Docker Localhost
 # NUM_DATASETS = -1
@@ -41,6 +55,66 @@ API_TOKEN = 'e5630759-ee17-4a13-a4de-0ece4931faaa'
 DATA_DIR = 'data/nesstar/20200425_prod'
 
 # Settings Global
+# request rates of the creating stages, each shared by its workers
+UPLOAD_DATASETS_REQUESTS_PER_SECOND = 4
+UPLOAD_DATAFILES_REQUESTS_PER_SECOND = 4
+PUBLISH_REQUESTS_PER_SECOND = 4
+# lock polls only read, so they have a rate of their own
+LOCK_POLL_REQUESTS_PER_SECOND = 10
+SETUP_DIRS_WORKERS = 8
+UPLOAD_DATASETS_WORKERS = 4
+UPLOAD_DATAFILES_WORKERS = 4
+LOCK_POLL_INITIAL = 1
+LOCK_POLL_MAX = 30
+LOCK_TIMEOUT = 3600
+# without lock information (locks endpoint missing before Dataverse 4.9.3,
+# or failing LOCK_INFO_ATTEMPTS times in a row), uploads wait fixed delays
+# after each file again
+LOCK_INFO_ATTEMPTS = 3
+LOCK_FALLBACK_DELAY = 2
+LOCK_FALLBACK_DELAY_TABULAR = 30
+# datafiles are streamed from disk. Files from DIRECT_UPLOAD_MIN_SIZE bytes
+# on go in parts directly to the S3 store (needs direct upload enabled
+# in Dataverse), resuming unfinished uploads in later runs.
+DIRECT_UPLOAD = False
+DIRECT_UPLOAD_MIN_SIZE = 1024 ** 3
+DIRECT_UPLOAD_RETRIES = 3
+# presigned upload URLs expire, by default after 60 minutes
+DIRECT_UPLOAD_URL_EXPIRY = 3600
+UPLOAD_PROGRESS_MIN_SIZE = 100 * 1024 ** 2
+UPLOAD_PROGRESS_STEP = 10
+# pack the small, not tabular datafiles of a dataset into one zip, which
+# Dataverse unpacks. The file metadata is set afterwards.
+BUNDLE_DATAFILES = False
+BUNDLE_MAX_FILE_SIZE = 10 * 1024 ** 2
+BUNDLE_MIN_DATAFILES = 3
+BUNDLE_EXCLUDE_EXTENSIONS = ['.sav', '.dta', '.por', '.csv', '.tab', '.xlsx', '.rdata', '.zip']
+BUNDLE_METADATA_WORKERS = 4
+# file metadata sent once with the zip, for all unpacked files. Files with
+# other values get their own metadata request.
+BUNDLE_SHARED_METADATA_KEYS = ['description', 'categories', 'restrict']
+DATAFILE_METADATA_KEYS = ['label', 'description', 'categories', 'directoryLabel', 'restrict']
+# extensions of files, which Dataverse ingests and renames to .tab
+TABULAR_INGEST_EXTENSIONS = ['.sav', '.dta', '.por', '.csv', '.xlsx', '.rdata']
+REDETECT_WORKERS = 8
+REDETECT_REQUESTS_PER_SECOND = 10
+CRAWL_WORKERS = 8
+CRAWL_REQUESTS_PER_SECOND = 10
+UPDATE_DATASETS_WORKERS = 8
+UPDATE_REQUESTS_PER_SECOND = 10
+UPDATE_DATAFILES_WORKERS = 8
+REMOVE_WORKERS = 8
+REMOVE_REQUESTS_PER_SECOND = 10
+HISTORY_BATCH_SIZE = 100
+# allow access requests for datasets, in which files become restricted
+UPDATE_ALLOW_ACCESS_REQUEST = True
+PIPELINE_WORKERS = 8
+PUBLISH_WORKERS = 4
+# one keep-alive connection per concurrent worker, the pipeline runs the
+# upload stages side by side
+HTTP_POOL_SIZE = max(UPLOAD_DATASETS_WORKERS + UPLOAD_DATAFILES_WORKERS + PUBLISH_WORKERS, REDETECT_WORKERS, CRAWL_WORKERS, UPDATE_DATASETS_WORKERS, UPDATE_DATAFILES_WORKERS, REMOVE_WORKERS)
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 500
 DOI_PREFIX_AUSSDA = 'doi:10.11587'
 SEPERATOR = '<s>'
 RAW_DIR = 'data/nesstar/raw'
@@ -48,9 +122,18 @@ SIP_FOLDERNAME = 'SIP'
 AIP_FOLDERNAME = 'AIP'
 DIP_FOLDERNAME = 'DIP'
 INGEST_FOLDERNAME = 'ingest'
+# copy, hardlink, reflink or symlink, falls back to copy if not supported
+MATERIALIZE_STRATEGY = 'copy'
 INGEST_DIR = os.path.join(DATA_DIR, INGEST_FOLDERNAME)
 FILENAME_DATASETS = os.path.join(DATA_DIR, 'datasets.csv')
 FILENAME_DATAFILES = os.path.join(DATA_DIR, 'datafiles.csv')
+FILENAME_IMPORT_CACHE = os.path.join(DATA_DIR, 'import_cache.pickle')
+FILENAME_CRAWL_CACHE = os.path.join(DATA_DIR, 'datafiles_crawl.json')
+# Prometheus textfile and JSON summary, rewritten every METRICS_INTERVAL seconds
+FILENAME_METRICS_PROMETHEUS = os.path.join(DATA_DIR, 'metrics.prom')
+FILENAME_METRICS_JSON = os.path.join(DATA_DIR, 'metrics.json')
+METRICS_INTERVAL = 15
+IMPORT_CACHE_VERSION = 2
 DATASET_JSON_KEYS = [
     'otherId',
     'series',
@@ -93,129 +176,362 @@ def clean_string(str):
     return clean_str
 
 
+# Column handler tables. The header of a CSV file is parsed once into a list
+# of (column, target key, converter) entries, which is applied to every row,
+# and the record schema shared by the rows. JSON columns are kept as raw
+# strings and only decoded when read. Columns not relevant for the import are
+# left out of the table.
+COLUMN_TABLES = {}
+BOOLEANS = {'TRUE': True, 'FALSE': False}
+IGNORE = object()
+
+
+def to_value(val):
+    val = clean_string(val)
+    return BOOLEANS.get(val, val)
+
+
+def to_json(val):
+    return json_loads(clean_string(val))
+
+
+def to_string(val):
+    # boolean values of string columns are not imported
+    if val in BOOLEANS:
+        return IGNORE
+    return clean_string(val)
+
+
+def to_title(val):
+    if val in BOOLEANS:
+        return IGNORE
+    return clean_string(val.replace(';', ' - ').replace('\'', '\\\''))
+
+
+def dataset_columns(header):
+    # (dataset ID column, handlers, schema) for a datasets.csv header
+    key = ('dataset', header)
+    if key not in COLUMN_TABLES:
+        json_keys = set(DATASET_JSON_KEYS)
+        id_column = None
+        columns = []
+        decoders = {}
+        for column in header:
+            key_split = column.split('.')
+            if key_split[0] == 'dv':
+                real_key = key_split[1]
+                if real_key == 'otherId' and real_key in json_keys:
+                    columns.append((column, real_key, clean_string))
+                    decoders[real_key] = decode_other_id
+                elif real_key in json_keys:
+                    columns.append((column, real_key, clean_string))
+                    decoders[real_key] = decode_json
+                else:
+                    columns.append((column, real_key, to_value))
+            elif column == 'org.dataset_id':
+                id_column = column
+            elif column == 'org.dataverse_id':
+                columns.append((column, 'dataverse_id', to_value))
+            else:
+                columns.append((column, column, to_value))
+        schema = RecordSchema([real_key for column, real_key, convert in columns], decoders)
+        COLUMN_TABLES[key] = (id_column, columns, schema)
+    return COLUMN_TABLES[key]
+
+
+def datafile_columns(header):
+    # (dataset ID column, datafile ID column, handlers, schema) for a datafiles.csv header
+    key = ('datafile', header)
+    if key not in COLUMN_TABLES:
+        json_keys = set(DATAFILE_JSON_KEYS)
+        ds_id_column = None
+        df_id_column = None
+        columns = []
+        decoders = {}
+        for column in header:
+            key_split = column.split('.')
+            if key_split[0] == 'dv':
+                real_key = key_split[1]
+                if real_key in json_keys:
+                    columns.append((column, real_key, clean_string))
+                    decoders[real_key] = decode_json
+                elif real_key == 'title':
+                    columns.append((column, real_key, to_title))
+                else:
+                    columns.append((column, real_key, to_string))
+            elif column == 'org.datafile_id':
+                df_id_column = column
+            elif column == 'org.dataset_id':
+                ds_id_column = column
+            elif column == 'org.filename':
+                columns.append((column, 'filename', clean_string))
+        schema = RecordSchema([real_key for column, real_key, convert in columns], decoders)
+        COLUMN_TABLES[key] = (ds_id_column, df_id_column, columns, schema)
+    return COLUMN_TABLES[key]
+
+
+def import_dataset_row(dataset, columns=None):
+    if columns is None:
+        columns = dataset_columns(tuple(dataset))
+    id_column, handlers, schema = columns
+    ds_id = None
+    index = schema.index
+    values = schema.new_values()
+    if id_column and dataset[id_column]:
+        ds_id = clean_string(dataset[id_column])
+    for column, real_key, convert in handlers:
+        val = dataset[column]
+        if val:
+            values[index[real_key]] = intern_value(convert(val))
+    return ds_id, Metadata(schema, values)
+
+
+@timed_stage('import_datasets')
 def import_datasets(datasets_csv):
     data = {}
+    columns = None
     # license_default_en = read_file(os.path.join(DATA_DIR, LICENSE_EN))
 
     for dataset in datasets_csv:
-        ds_tmp = {}
-
-        for key, val in dataset.items():
-            if val:
-                val = clean_string(val)
-                if val == 'TRUE':
-                    val = True
-                elif val == 'FALSE':
-                    val = False
-                key_split = key.split('.')
-                if key_split[0] == 'dv':
-                    real_key = key_split[1]
-                    if real_key == 'otherId':
-                        val = val.replace('!', '_')
-                    if real_key in DATASET_JSON_KEYS:
-                        ds_tmp[real_key] = json.loads(val)
-                    else:
-                        ds_tmp[real_key] = val
-                elif key_split[0] == 'org':
-                    if key == 'org.dataset_id':
-                        ds_id = val
-                    elif key == 'org.dataverse_id':
-                        ds_tmp['dataverse_id'] = val
-                    else:
-                        ds_tmp[key] = val
-                else:
-                    ds_tmp[key] = val
+        if columns is None:
+            columns = dataset_columns(tuple(dataset))
+        ds_id, ds_tmp = import_dataset_row(dataset, columns)
         if 'dataverse_id' in ds_tmp:
-            data[ds_id] = {'metadata': ds_tmp}
+            data[ds_id] = DatasetRecord(ds_tmp)
     print('- Import Datasets COMPLETED.')
     return data
 
 
+def import_datafile_row(datafile, columns=None):
+    if columns is None:
+        columns = datafile_columns(tuple(datafile))
+    ds_id_column, df_id_column, handlers, schema = columns
+    ds_id = None
+    df_id = None
+    index = schema.index
+    values = schema.new_values()
+    if ds_id_column and datafile[ds_id_column]:
+        ds_id = clean_string(datafile[ds_id_column])
+    if df_id_column and datafile[df_id_column]:
+        df_id = clean_string(datafile[df_id_column])
+    for column, real_key, convert in handlers:
+        val = datafile[column]
+        if val:
+            val = convert(val)
+            if val is not IGNORE:
+                values[index[real_key]] = intern_value(val)
+    return ds_id, df_id, Metadata(schema, values)
+
+
+@timed_stage('import_datafiles')
 def import_datafiles(data, datafiles_csv):
+    columns = None
 
     for datafile in datafiles_csv:
-        df_tmp = {}
-        df_id = None
         if datafile['org.to_upload'] == 'TRUE':
-            for key, val in datafile.items():
-                if val:
-                    # TODO: Update read CSV file settings to auto-import boolean variables.
-                    if val == 'TRUE':
-                        val = True
-                    elif val == 'FALSE':
-                        val = False
-                    key_split = key.split('.')
-                    if key_split[0] == 'dv':
-                        real_key = key_split[1]
-                        if real_key in DATAFILE_JSON_KEYS:
-                            df_tmp[real_key] = json.loads(clean_string(val))
-                        else:
-                            if real_key == 'title':
-                                val = val.replace(';', ' - ')
-                                val = val.replace('\'', '\\\'')
-                            if isinstance(val, str):
-                                df_tmp[real_key] = clean_string(val)
-                    elif key_split[0] == 'org':
-                        # df_tmp[key] = val
-                        if key == 'org.datafile_id':
-                            df_id = clean_string(val)
-                        elif key == 'org.dataset_id':
-                            ds_id = clean_string(val)
-                        elif key == 'org.filename':
-                            df_tmp['filename'] = clean_string(val)
+            if columns is None:
+                columns = datafile_columns(tuple(datafile))
+            ds_id, df_id, df_tmp = import_datafile_row(datafile, columns)
             if ds_id in data:
                 if 'datafiles' not in data[ds_id]:
                     data[ds_id]['datafiles'] = {}
-                if df_id not in data[ds_id]['datafiles']:
-                    data[ds_id]['datafiles'][df_id] = {}
-                if 'metadata' not in data[ds_id]['datafiles'][df_id]:
-                    data[ds_id]['datafiles'][df_id]['metadata'] = {}
-
-                data[ds_id]['datafiles'][df_id]['metadata'] = df_tmp
+                data[ds_id]['datafiles'][df_id] = DatafileRecord(df_tmp)
 
     print('- Import Datafiles COMPLETED.')
     return data
 
 
-def setup_dirs(data, delete_all_folders=False, overwrite_all=False):
-    counter = 0
-    if delete_all_folders:
-        delete_all_folders_inside(INGEST_DIR)
+def read_csv_rows(filename, delimiter=','):
+    with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile, delimiter=delimiter):
+            yield row
 
-    for ds_id, dataset in data.items():
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
+
+def stream_catalogue_rows(filename_datasets, filename_datafiles):
+    # A first pass only counts the datafiles to upload per dataset. The
+    # second pass then hands out every dataset row together with its
+    # datafile rows, as soon as all of them have been read. If datafiles.csv
+    # is ordered like datasets.csv, only one dataset is held in memory.
+    num_datafiles = {}
+    for row in read_csv_rows(filename_datafiles):
+        if row['org.to_upload'] == 'TRUE':
+            ds_id = clean_string(row['org.dataset_id'])
+            num_datafiles[ds_id] = num_datafiles.get(ds_id, 0) + 1
+
+    datafiles_csv = read_csv_rows(filename_datafiles)
+    read_ahead = {}
+    for dataset_row in read_csv_rows(filename_datasets):
+        ds_id = clean_string(dataset_row.get('org.dataset_id') or '')
+        datafile_rows = read_ahead.pop(ds_id, [])
+        num_expected = num_datafiles.pop(ds_id, 0)
+        while len(datafile_rows) < num_expected:
+            row = next(datafiles_csv)
+            if row['org.to_upload'] == 'TRUE':
+                if clean_string(row['org.dataset_id']) == ds_id:
+                    datafile_rows.append(row)
+                else:
+                    read_ahead.setdefault(clean_string(row['org.dataset_id']), []).append(row)
+        yield dataset_row, datafile_rows
+
+
+def import_catalogue_rows(dataset_row, datafile_rows):
+    ds_id, ds_tmp = import_dataset_row(dataset_row)
+    if 'dataverse_id' not in ds_tmp:
+        return ds_id, None
+    dataset = DatasetRecord(ds_tmp)
+    for datafile_row in datafile_rows:
+        _, df_id, df_tmp = import_datafile_row(datafile_row)
+        if 'datafiles' not in dataset:
+            dataset['datafiles'] = {}
+        dataset['datafiles'][df_id] = DatafileRecord(df_tmp)
+    return ds_id, dataset
+
+
+def stream_catalogue(filename_datasets, filename_datafiles):
+    # lazy counterpart of import_datasets() + import_datafiles()
+    for dataset_row, datafile_rows in stream_catalogue_rows(filename_datasets, filename_datafiles):
+        ds_id, dataset = import_catalogue_rows(dataset_row, datafile_rows)
+        if dataset:
+            yield ds_id, dataset
+
+
+def import_schema(filename_datasets, filename_datafiles):
+    # everything, besides the rows, that influences the import result
+    with open(filename_datasets, 'r', newline='', encoding='utf-8') as f:
+        datasets_header = next(csv.reader(f), [])
+    with open(filename_datafiles, 'r', newline='', encoding='utf-8') as f:
+        datafiles_header = next(csv.reader(f), [])
+    schema = [IMPORT_CACHE_VERSION, datasets_header, datafiles_header, DATASET_JSON_KEYS, DATAFILE_JSON_KEYS]
+    return hashlib.sha256(json.dumps(schema).encode('utf-8')).hexdigest()
+
+
+@timed_stage('import_catalogue')
+def import_catalogue(filename_datasets, filename_datafiles, filename_cache):
+    # Cached import of datasets.csv and datafiles.csv. The cache is keyed on
+    # the hashes of both files and the column schema. If the files changed,
+    # only datasets whose rows (incl. their datafile rows) changed are parsed
+    # again, the others are taken over from the cache.
+    files = [checksum_file(filename_datasets, 'sha256'), checksum_file(filename_datafiles, 'sha256')]
+    schema = import_schema(filename_datasets, filename_datafiles)
+    cache = None
+    if os.path.isfile(filename_cache):
+        try:
+            cache = read_pickle(filename_cache)
+        except:
+            print('WARNING: Import cache {0} could not be read.'.format(filename_cache))
+    if cache and cache['schema'] != schema:
+        cache = None
+    if cache and cache['files'] == files:
+        print('- Import Catalogue from cache COMPLETED.')
+        return cache['data']
+
+    data = {}
+    row_hashes = {}
+    num_parsed = 0
+    for dataset_row, datafile_rows in stream_catalogue_rows(filename_datasets, filename_datafiles):
+        ds_id = clean_string(dataset_row.get('org.dataset_id') or '')
+        row_hash = hashlib.sha256(json.dumps([dataset_row, datafile_rows]).encode('utf-8')).hexdigest()
+        row_hashes[ds_id] = row_hash
+        if cache and cache['row_hashes'].get(ds_id) == row_hash:
+            if ds_id in cache['data']:
+                data[ds_id] = cache['data'][ds_id]
+        else:
+            num_parsed += 1
+            ds_id, dataset = import_catalogue_rows(dataset_row, datafile_rows)
+            if dataset:
+                data[ds_id] = dataset
+    write_pickle(filename_cache, {'schema': schema, 'files': files, 'row_hashes': row_hashes, 'data': data})
+    print('- Import Catalogue COMPLETED ({0} of {1} datasets parsed).'.format(num_parsed, len(row_hashes)))
+    return data
+
+
+def iter_datasets(data):
+    # stages accept the imported dict as well as the stream_catalogue() generator
+    if hasattr(data, 'items'):
+        return iter(data.items())
+    return iter(data)
+
+
+def limit_datasets(data):
+    # same semantics as the `counter >= NUM_DATASETS` checks: at least one
+    # dataset is processed, as soon as NUM_DATASETS is not negative.
+    if NUM_DATASETS >= 0:
+        return islice(iter_datasets(data), max(NUM_DATASETS, 1))
+    return iter_datasets(data)
+
+
+def setup_dataset_dir(ds_id, dataset, overwrite_all=False):
+    ds_dir = os.path.join(INGEST_DIR, ds_id)
+    manifest = None
+    try:
         setup_oaistree(ds_dir, ds_id,
                        os.path.join(DATA_DIR, 'terms-of-use_suf_v1.4.html'),
                        os.path.join(DATA_DIR, 'terms-of-access_suf_v1.4.html'),
                        overwrite_all)
-        if 'datafiles' in data[ds_id]:
-            for df_id, datafile in data[ds_id]['datafiles'].items():
+        # checksums are calculated once, while copying raw to SIP. Re-runs
+        # skip files which match the manifest, without reading them.
+        manifest = read_manifest(ds_dir)
+        if 'datafiles' in dataset:
+            for df_id, datafile in dataset['datafiles'].items():
                 datafile_from_raw_to_sip(
                     os.path.join(RAW_DIR, datafile['metadata']['filename']),
                     os.path.join(ds_dir, SIP_FOLDERNAME, datafile['metadata']['filename']),
-                    overwrite_all=overwrite_all)
+                    overwrite_all=overwrite_all, strategy=MATERIALIZE_STRATEGY, manifest=manifest)
                 datafile_from_sip_to_aip(
                     os.path.join(ds_dir, SIP_FOLDERNAME, datafile['metadata']['filename']),
                     os.path.join(ds_dir, AIP_FOLDERNAME, datafile['metadata']['filename']),
-                    overwrite_all=overwrite_all)
-                if 'Documentation' in datafile['metadata']['categories']:
-                    category = 'documentation'
-                elif 'Data' in datafile['metadata']['categories']:
-                    category = 'data'
-                else:
-                    category = None
+                    overwrite_all=overwrite_all, strategy=MATERIALIZE_STRATEGY, manifest=manifest)
                 datafile_from_aip_to_dip(
                     ds_dir, datafile['metadata']['filename'],
-                    overwrite_all=overwrite_all)
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
-    print('- Setup OAIS trees COMPLETED.')
+                    overwrite_all=overwrite_all, strategy=MATERIALIZE_STRATEGY, manifest=manifest)
+    except Exception as e:
+        return ds_id, '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        if manifest is not None:
+            save_manifest(ds_dir, manifest)
+    return ds_id, None
+
+
+@timed_stage('setup_dirs')
+def setup_dirs(data, delete_all_folders=False, overwrite_all=False):
+    errors = {}
+    if delete_all_folders:
+        delete_all_folders_inside(INGEST_DIR)
+        open_state_store(INGEST_DIR).clear()
+
+    def setup(item):
+        ds_id, dataset = item
+        return setup_dataset_dir(ds_id, dataset, overwrite_all)
 
+    # datasets share nothing, so their trees are set up in parallel.
+    for ds_id, error in run_concurrent(setup, limit_datasets(data), SETUP_DIRS_WORKERS):
+        if error:
+            print('ERROR: Setup OAIS tree {0} - {1}'.format(ds_id, error))
+            errors[ds_id] = error
+    if errors:
+        print('- Setup OAIS trees COMPLETED with {0} errors.'.format(len(errors)))
+    else:
+        print('- Setup OAIS trees COMPLETED.')
+    return errors
 
+
+@timed_stage('verify_dirs')
+def verify_dirs(data, deep=False):
+    mismatches = {}
+    for ds_id, dataset in limit_datasets(data):
+        ds_dir = os.path.join(INGEST_DIR, ds_id)
+        ds_mismatches = verify_manifest(ds_dir, read_manifest(ds_dir), deep=deep)
+        if ds_mismatches:
+            print('ERROR: OAIS tree {0} - files not matching manifest: {1}'.format(ds_id, ', '.join(ds_mismatches)))
+            mismatches[ds_id] = ds_mismatches
+    print('- Verify OAIS trees COMPLETED.')
+    return mismatches
+
+
+@timed_stage('create_datasets_json')
 def create_datasets_json(data):
     counter = 0
-    for ds_id, dataset in data.items():
+    for ds_id, dataset in iter_datasets(data):
         counter += 1
         ds_dir = os.path.join(INGEST_DIR, ds_id)
         save_dataset_dataverse_json(ds_dir, dataset['metadata'], ds_id)
@@ -224,482 +540,1147 @@ def create_datasets_json(data):
     print('- Create Datasets JSON COMPLETED.')
 
 
-def upload_datasets(data, filename_datasets):
-    counter = 0
-    update_dict = {}
-
-    api = NativeApi(BASE_URL, API_TOKEN)
-    for ds_id, dataset in data.items():
-        pid = None
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
-        history = read_history(ds_dir)
-        if 'upload_date' in history:
-            if history['upload_date']:
-                do_upload = False
-                print('Dataset {0} already uploaded.'.format(ds_id))
-            else:
-                do_upload = True
+def upload_dataset(api, limiter, ds_id, dataset):
+    pid = None
+    update = None
+    ds_dir = os.path.join(INGEST_DIR, ds_id)
+    history = read_history(ds_dir)
+    if 'upload_date' in history:
+        if history['upload_date']:
+            do_upload = False
+            print('Dataset {0} already uploaded.'.format(ds_id))
         else:
             do_upload = True
-        if do_upload:
-            try:
-                ds = Dataset()
-                ds.set(dataset['metadata'])
-                ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                resp = api.create_dataset(dataset['metadata']['dataverse_id'], ds.json())
-                if 'status' in resp.json():
-                    if resp.json()['status'] == 'OK':
-                        history['upload_date'] = ts
-                        if 'data' in resp.json():
-                            if 'persistentId' in resp.json()['data']:
-                                pid = resp.json()['data']['persistentId']
-                                history['pid'] = pid
-                                save_history(ds_dir, history)
-                                update_dict[ds_id] = {'org.doi': pid, 'org.is_uploaded': 'TRUE'}
-                            elif 'id' in resp.json()['data']:
-                                dataset_id = resp.json()['data']['id']
-                                history['dataverse_datasetId'] = str(dataset_id)
-                                resp = api.get_dataset(dataset_id, is_pid=False)
-                                pid = DOI_PREFIX_AUSSDA + '/' + resp.json()['data']['identifier']
-                                history['pid'] = pid
-                                save_history(ds_dir, history)
-                                update_dict[ds_id] = {'org.doi': pid, 'org.is_uploaded': 'TRUE'}
-                            else:
-                                print('ERROR: Create Dataset {0} - no \'persistentId\' in API response.'.format(ds_id))
+    else:
+        do_upload = True
+    if do_upload:
+        try:
+            # the JSON created by create_datasets_json(), if still up to date
+            payload = read_dataset_payload(ds_dir, dataset['metadata'], ds_id)
+            limiter.wait()
+            ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            resp = api.create_dataset(dataset['metadata']['dataverse_id'], payload)
+            if 'status' in resp.json():
+                if resp.json()['status'] == 'OK':
+                    history['upload_date'] = ts
+                    if 'data' in resp.json():
+                        if 'persistentId' in resp.json()['data']:
+                            pid = resp.json()['data']['persistentId']
+                            history['pid'] = pid
+                            save_history(ds_dir, history)
+                            update = {'org.doi': pid, 'org.is_uploaded': 'TRUE'}
+                        elif 'id' in resp.json()['data']:
+                            dataset_id = resp.json()['data']['id']
+                            history['dataverse_datasetId'] = str(dataset_id)
+                            limiter.wait()
+                            resp = api.get_dataset(dataset_id, is_pid=False)
+                            pid = DOI_PREFIX_AUSSDA + '/' + resp.json()['data']['identifier']
+                            history['pid'] = pid
+                            save_history(ds_dir, history)
+                            update = {'org.doi': pid, 'org.is_uploaded': 'TRUE'}
                         else:
-                            print('ERROR: Create Dataset {0} - no \'data\' in API response.'.format(ds_id))
+                            print('ERROR: Create Dataset {0} - no \'persistentId\' in API response.'.format(ds_id))
                     else:
-                        print('ERROR: Create Dataset {0} API Request Status not OK'.format(ds_id))
+                        print('ERROR: Create Dataset {0} - no \'data\' in API response.'.format(ds_id))
                 else:
-                    print('ERROR: Create Dataset {0} API Request not working.'.format(ds_id))
-            except:
-                print('Dataset {0} could not be created.'.format(ds_id))
-            time.sleep(1)
-        else:
-            pass
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
-    update_csv(filename_datasets, update_dict)
+                    print('ERROR: Create Dataset {0} API Request Status not OK'.format(ds_id))
+            else:
+                print('ERROR: Create Dataset {0} API Request not working.'.format(ds_id))
+        except:
+            print('Dataset {0} could not be created.'.format(ds_id))
+    return ds_id, update
+
+
+@timed_stage('upload_datasets')
+def upload_datasets(data, filename_datasets):
+    journal = StatusJournal(filename_datasets)
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(UPLOAD_DATASETS_REQUESTS_PER_SECOND)
+
+    def upload(item):
+        ds_id, dataset = item
+        return upload_dataset(api, limiter, ds_id, dataset)
+
+    for ds_id, update in run_concurrent(upload, limit_datasets(data), UPLOAD_DATASETS_WORKERS):
+        if update:
+            journal.append(ds_id, update)
+    journal.compact()
     print('- Upload Datasets COMPLETED.')
     return data
 
 
+def create_dataset_datafiles_json(ds_id, dataset):
+    ds_dir = os.path.join(INGEST_DIR, ds_id)
+    history = read_history(ds_dir)
+    if 'pid' not in history:
+        return ds_id, 'PID for Dataset {0} not available.'.format(ds_id)
+    if 'datafiles' in dataset:
+        pid = history['pid']
+        for df_id, datafile in dataset['datafiles'].items():
+            datafile['metadata']['pid'] = pid
+            save_datafile_dataverse_json(ds_dir, datafile['metadata'], ds_id, df_id)
+    else:
+        print('WARNING: No Datafile entry for Dataset {0} available.'.format(ds_id))
+    return ds_id, None
+
+
+@timed_stage('create_datafiles_json')
 def create_datafiles_json(data):
-    counter = 0
-    for ds_id, dataset in data.items():
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
-        history = read_history(ds_dir)
-        if 'pid' in history:
-            if 'datafiles' in dataset:
-                pid = history['pid']
-                for df_id, datafile in dataset['datafiles'].items():
-                    datafile['metadata']['pid'] = pid
-                    save_datafile_dataverse_json(ds_dir, datafile['metadata'], ds_id, df_id)
-            else:
-                print('WARNING: No Datafile entry for Dataset {0} available.'.format(ds_id))
-        else:
-            print('WARNING: PID for Dataset {0} not available.'.format(ds_id))
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
+    for ds_id, dataset in limit_datasets(data):
+        _, error = create_dataset_datafiles_json(ds_id, dataset)
+        if error:
+            print('WARNING: {0}'.format(error))
     print('- Create Datafiles COMPLETED.')
 
 
-def upload_datafiles(data, filename_datafiles):
-    counter = 0
-    update_dict = {}
-    api = NativeApi(BASE_URL, API_TOKEN)
+def get_dataset_locks(api, pid):
+    # locks of the dataset, None if the locks endpoint is not available
+    # (Dataverse < 4.9.3 answers 404 without data).
+    resp = api.get_dataset_lock(pid)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()['data']
 
-    for ds_id, dataset in data.items():
-        pid = None
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
-        history = read_history(ds_dir)
-        if 'pid' in history:
-            if 'datafiles' in dataset:
-                pid = history['pid']
-                for df_id, datafile in dataset['datafiles'].items():
-                    history = read_history(ds_dir)
-                    if 'datafiles' in history:
-                        if df_id in history['datafiles']:
-                            if 'upload_date' in history['datafiles'][df_id]:
-                                if history['datafiles'][df_id]['upload_date']:
-                                    do_upload = False
-                                else:
-                                    do_upload = True
+
+def wait_for_dataset_unlock(api, lock_limiter, pid, fallback_delay=LOCK_FALLBACK_DELAY):
+    # poll the dataset locks (e. g. tabular ingest) with growing delays,
+    # instead of sleeping a fixed time after every upload. If the locks can
+    # not be read, the fixed fallback_delay is waited instead.
+    start = time.monotonic()
+    failures = 0
+    for delay in backoff(LOCK_POLL_INITIAL, 2, LOCK_POLL_MAX):
+        lock_limiter.wait()
+        try:
+            locks = get_dataset_locks(api, pid)
+        except:
+            failures += 1
+            print('WARNING: Locks of Dataset {0} could not be retrieved.'.format(pid))
+            if failures < LOCK_INFO_ATTEMPTS:
+                time.sleep(delay)
+                continue
+            locks = None
+        if locks is None:
+            time.sleep(fallback_delay)
+            return True
+        if not locks:
+            return True
+        if time.monotonic() - start + delay > LOCK_TIMEOUT:
+            return False
+        time.sleep(delay)
+
+
+def lock_fallback_delay(filename):
+    # fixed delay after the upload of a file, if the locks can not be read
+    if os.path.splitext(filename)[1].lower() in TABULAR_INGEST_EXTENSIONS:
+        return LOCK_FALLBACK_DELAY_TABULAR
+    return LOCK_FALLBACK_DELAY
+
+
+def get_uploaded_md5(resp_json):
+    # MD5 checksum Dataverse calculated for the uploaded (original) file
+    try:
+        checksum = resp_json['data']['files'][0]['dataFile']['checksum']
+    except (KeyError, IndexError, TypeError):
+        return None
+    if checksum.get('type') == 'MD5':
+        return checksum.get('value')
+    return None
+
+
+def post_datafile_metadata(api, limiter, file_id, metadata):
+    # pyDataverse runs curl in a shell for this, the request is sent via the
+    # shared session instead.
+    url = '{0}/files/{1}/metadata'.format(api.base_url_api_native, file_id)
+    limiter.wait()
+    return api.request('POST', url, files={'jsonData': (None, json.dumps(metadata))}).json()
+
+
+def select_bundle_datafiles(ds_dir, dataset, history):
+    # datafiles not uploaded yet, which are small and not ingested as tabular.
+    # Files sharing a filename are left out, as the zip needs unique names.
+    bundle = {}
+    for df_id, datafile in dataset['datafiles'].items():
+        if history.get('datafiles', {}).get(df_id, {}).get('upload_date'):
+            continue
+        filename = datafile['metadata']['filename']
+        if os.path.splitext(filename)[1].lower() in BUNDLE_EXCLUDE_EXTENSIONS:
+            continue
+        if os.path.getsize(os.path.join(ds_dir, DIP_FOLDERNAME, filename)) > BUNDLE_MAX_FILE_SIZE:
+            continue
+        bundle[filename] = df_id
+    names = Counter(os.path.basename(filename) for filename in bundle)
+    bundle = {filename: df_id for filename, df_id in bundle.items() if names[os.path.basename(filename)] == 1}
+    if len(bundle) < BUNDLE_MIN_DATAFILES:
+        return {}
+    return bundle
+
+
+def bundled_datafile_metadata(ds_dir, ds_id, pid, dataset, df_id, filename):
+    # file metadata of a datafile, without the defaults of the zip upload
+    data_tmp = dataset['datafiles'][df_id]['metadata']
+    data_tmp['pid'] = pid
+    payload = json.loads(read_datafile_payload(ds_dir, data_tmp, ds_id, df_id))
+    metadata = {key: val for key, val in payload.items() if key in DATAFILE_METADATA_KEYS}
+    if metadata.get('label') == os.path.basename(filename):
+        del metadata['label']
+    if not metadata.get('restrict'):
+        metadata.pop('restrict', None)
+    return metadata
+
+
+def shared_bundle_metadata(metadata_by_file):
+    # most common values of BUNDLE_SHARED_METADATA_KEYS among the files
+    counter = Counter()
+    for metadata in metadata_by_file.values():
+        shared = {key: val for key, val in metadata.items() if key in BUNDLE_SHARED_METADATA_KEYS}
+        counter[json.dumps(shared, sort_keys=True)] += 1
+    if not counter:
+        return {}
+    return json.loads(counter.most_common(1)[0][0])
+
+
+def differing_bundle_metadata(metadata, shared):
+    # metadata a file needs on top of the shared metadata of the zip
+    differing = {key: val for key, val in metadata.items() if shared.get(key) != val}
+    resets = {'description': '', 'categories': [], 'restrict': False}
+    for key in shared:
+        if key not in metadata:
+            differing[key] = resets[key]
+    return differing
+
+
+def update_bundled_datafile_metadata(api, limiter, ds_dir, ds_id, pid, dataset, df_id, history_df):
+    # metadata of an unpacked datafile, which differs from the shared metadata
+    # of the zip. Histories of bundles before the shared metadata hold no
+    # pending metadata, so the complete metadata is sent.
+    if 'pending_metadata' in history_df:
+        metadata = history_df['pending_metadata']
+    else:
+        metadata = bundled_datafile_metadata(ds_dir, ds_id, pid, dataset, df_id, history_df['filename'])
+    if metadata:
+        resp_json = post_datafile_metadata(api, limiter, history_df['id'], metadata)
+        if resp_json.get('status') != 'OK':
+            print('ERROR: Update metadata of Datafile {0} API response status not OK. - MSG: {1}.'.format(df_id, resp_json))
+            return False
+    history_df.pop('pending_metadata', None)
+    history_df['metadata_date'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    save_datafile_history(ds_dir, df_id, history_df)
+    return True
+
+
+def upload_dataset_datafiles_bundle(api, limiter, lock_limiter, ds_id, dataset, history, manifest):
+    # one zip upload sets the metadata shared by most files, only files with
+    # other metadata need a request of their own afterwards.
+    ds_dir = os.path.join(INGEST_DIR, ds_id)
+    pid = history['pid']
+    bundle = select_bundle_datafiles(ds_dir, dataset, history)
+    uploaded = False
+    if bundle:
+        if not wait_for_dataset_unlock(api, lock_limiter, pid):
+            print('ERROR: Dataset {0} still locked after {1}s. Bundle skipped.'.format(pid, LOCK_TIMEOUT))
+            return False
+        metadata_by_file = {filename: bundled_datafile_metadata(ds_dir, ds_id, pid, dataset, df_id, filename) for filename, df_id in bundle.items()}
+        shared = shared_bundle_metadata(metadata_by_file)
+        filename_zip = os.path.join(ds_dir, '{0}_bundle.zip'.format(ds_id))
+        try:
+            with zipfile.ZipFile(filename_zip, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for filename in bundle:
+                    archive.write(os.path.join(ds_dir, DIP_FOLDERNAME, filename), os.path.basename(filename))
+            limiter.wait()
+            ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            resp = upload_datafile(api, pid, filename_zip, json.dumps(shared))
+        finally:
+            if os.path.isfile(filename_zip):
+                os.remove(filename_zip)
+        if resp.json().get('status') == 'OK':
+            labels = {os.path.basename(filename): filename for filename in bundle}
+            for file in resp.json()['data']['files']:
+                filename = labels.get(file['label'])
+                if filename is None:
+                    print('WARNING: Unpacked file {0} of Dataset {1} not in bundle.'.format(file['label'], ds_id))
+                    continue
+                df_id = bundle[filename]
+                md5 = get_uploaded_md5({'data': {'files': [file]}})
+                history_df = history.setdefault('datafiles', {}).setdefault(df_id, {})
+                history_df['upload_date'] = ts
+                history_df['filename'] = filename
+                history_df['id'] = file['dataFile']['id']
+                history_df['bundled'] = True
+                differing = differing_bundle_metadata(metadata_by_file[filename], shared)
+                if differing:
+                    history_df['pending_metadata'] = differing
+                else:
+                    history_df['metadata_date'] = ts
+                if md5:
+                    history_df['md5'] = md5
+                    entry = manifest.get(filename)
+                    if entry and entry['md5'] != md5:
+                        print('WARNING: Datafile {0} checksum {1} differs from manifest checksum {2}.'.format(df_id, md5, entry['md5']))
+                save_datafile_history(ds_dir, df_id, history_df)
+                uploaded = True
+            print('Bundle of {0} Datafiles of Dataset {1} uploaded.'.format(len(bundle), ds_id))
+        else:
+            print('ERROR: Upload bundle of Dataset {0} API response status not OK. - MSG: {1}.'.format(ds_id, resp.json()))
+
+    # metadata of bundled datafiles, including the ones failed before
+    pending = [df_id for df_id, history_df in history.get('datafiles', {}).items()
+               if history_df.get('bundled') and not history_df.get('metadata_date') and df_id in dataset['datafiles']]
+
+    def update(df_id):
+        try:
+            return update_bundled_datafile_metadata(api, limiter, ds_dir, ds_id, pid, dataset, df_id, history['datafiles'][df_id])
+        except:
+            print('WARNING: Metadata of Datafile {0} could not be updated.'.format(df_id))
+            return False
+
+    updated = sum(run_concurrent(update, pending, BUNDLE_METADATA_WORKERS))
+    if pending:
+        print('Metadata of {0}/{1} bundled Datafiles of Dataset {2} updated.'.format(updated, len(pending), ds_id))
+    return uploaded
+
+
+def upload_dataset_datafiles(api, limiter, lock_limiter, ds_id, dataset):
+    update = None
+    ds_dir = os.path.join(INGEST_DIR, ds_id)
+    history = read_history(ds_dir)
+    manifest = read_manifest(ds_dir)
+    if 'pid' in history:
+        if 'datafiles' in dataset:
+            pid = history['pid']
+            if BUNDLE_DATAFILES:
+                try:
+                    if upload_dataset_datafiles_bundle(api, limiter, lock_limiter, ds_id, dataset, history, manifest):
+                        update = {'org.is_uploaded': 'TRUE'}
+                except:
+                    print('WARNING: Bundle of Dataset {0} could not be uploaded.'.format(ds_id))
+            fallback_delay = 0
+            for df_id, datafile in dataset['datafiles'].items():
+                if 'datafiles' in history:
+                    if df_id in history['datafiles']:
+                        if 'upload_date' in history['datafiles'][df_id]:
+                            if history['datafiles'][df_id]['upload_date']:
+                                do_upload = False
                             else:
                                 do_upload = True
                         else:
                             do_upload = True
                     else:
                         do_upload = True
-                    # api_dataset_is_accessible = api.wait_api_dataset_lock(pid) # not working with Dataverse versions before 4.9.3
-                    if do_upload:
-                        try:
-                            data_tmp = datafile['metadata']
-                            df = Datafile()
-                            data_tmp['pid'] = pid
-                            df.set(data_tmp)
-                            filename = os.path.abspath(os.path.join(ds_dir, DIP_FOLDERNAME, datafile['metadata']['filename']))
-                            ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            resp = api.upload_datafile(pid, filename, json_str=df.json(), is_pid=True)
-                            if 'status' in resp.json():
-                                if resp.json()['status'] == 'OK':
-                                    print('Datafile {0} uploaded.'.format(df_id))
-                                    if 'datafiles' not in history:
-                                        history['datafiles'] = {}
-                                    if df_id not in history['datafiles']:
-                                        history['datafiles'][df_id] = {}
-                                    history['datafiles'][df_id]['upload_date'] = ts
-                                    history['datafiles'][df_id]['filename'] = datafile['metadata']['filename']
-                                    update_dict[ds_id] = {'org.is_uploaded': 'TRUE'}
-                                    save_history(ds_dir, history)
-                                else:
-                                    print('ERROR: Upload Datafile {0} API response status not OK. - MSG: {1}.'.format(df_id, resp.json()))
+                else:
+                    do_upload = True
+                if do_upload:
+                    # files of one dataset are uploaded in order, each one
+                    # as soon as the ingest of the previous one has finished.
+                    if not wait_for_dataset_unlock(api, lock_limiter, pid, fallback_delay):
+                        print('ERROR: Dataset {0} still locked after {1}s. Remaining datafiles skipped.'.format(pid, LOCK_TIMEOUT))
+                        break
+                    fallback_delay = lock_fallback_delay(datafile['metadata']['filename'])
+                    try:
+                        data_tmp = datafile['metadata']
+                        data_tmp['pid'] = pid
+                        payload = read_datafile_payload(ds_dir, data_tmp, ds_id, df_id)
+                        filename = os.path.abspath(os.path.join(ds_dir, DIP_FOLDERNAME, datafile['metadata']['filename']))
+                        size = os.path.getsize(filename)
+                        progress = None
+                        if size >= UPLOAD_PROGRESS_MIN_SIZE:
+                            progress = progress_printer('Datafile {0}'.format(df_id), UPLOAD_PROGRESS_STEP)
+                        limiter.wait()
+                        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        if DIRECT_UPLOAD and size >= DIRECT_UPLOAD_MIN_SIZE:
+                            entry = manifest.get(datafile['metadata']['filename'])
+                            resp = direct_upload_datafile(api, pid, filename, payload, open_state_store(INGEST_DIR), md5=entry['md5'] if entry else None, progress=progress, retries=DIRECT_UPLOAD_RETRIES, url_expiry=DIRECT_UPLOAD_URL_EXPIRY)
+                        else:
+                            resp = upload_datafile(api, pid, filename, payload, progress=progress)
+                        if 'status' in resp.json():
+                            if resp.json()['status'] == 'OK':
+                                print('Datafile {0} uploaded.'.format(df_id))
+                                if 'datafiles' not in history:
+                                    history['datafiles'] = {}
+                                if df_id not in history['datafiles']:
+                                    history['datafiles'][df_id] = {}
+                                history['datafiles'][df_id]['upload_date'] = ts
+                                history['datafiles'][df_id]['filename'] = datafile['metadata']['filename']
+                                md5 = get_uploaded_md5(resp.json())
+                                if md5:
+                                    history['datafiles'][df_id]['md5'] = md5
+                                    entry = manifest.get(datafile['metadata']['filename'])
+                                    if entry and entry['md5'] != md5:
+                                        print('WARNING: Datafile {0} checksum {1} differs from manifest checksum {2}.'.format(df_id, md5, entry['md5']))
+                                update = {'org.is_uploaded': 'TRUE'}
+                                save_datafile_history(ds_dir, df_id, history['datafiles'][df_id])
                             else:
-                                print('ERROR: Upload Datafile {0} API response not valid.'.format(df_id))
-                        except:
-                            print('WARNING: Datafile {0} could not be uploaded.'.format(df_id))
-                        if filename[-4:] == '.sav' or filename[-4:] == '.dta':
-                            time.sleep(30)
+                                print('ERROR: Upload Datafile {0} API response status not OK. - MSG: {1}.'.format(df_id, resp.json()))
                         else:
-                            time.sleep(2)
-                    else:
-                        print('Datafile {0} already uploaded.'.format(df_id))
-            else:
-                print('No Datafile for Dataset {0} available.'.format(ds_id))
+                            print('ERROR: Upload Datafile {0} API response not valid.'.format(df_id))
+                    except:
+                        print('WARNING: Datafile {0} could not be uploaded.'.format(df_id))
+                else:
+                    print('Datafile {0} already uploaded.'.format(df_id))
         else:
-            print('ERROR: Upload Datafile - PID {0} not available.'.format(ds_id))
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
-    update_csv(filename_datafiles, update_dict)
+            print('No Datafile for Dataset {0} available.'.format(ds_id))
+    else:
+        print('ERROR: Upload Datafile - PID {0} not available.'.format(ds_id))
+    return ds_id, update
+
+
+@timed_stage('upload_datafiles')
+def upload_datafiles(data, filename_datafiles):
+    journal = StatusJournal(filename_datafiles)
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(UPLOAD_DATAFILES_REQUESTS_PER_SECOND)
+    lock_limiter = RateLimiter(LOCK_POLL_REQUESTS_PER_SECOND)
+
+    def upload(item):
+        ds_id, dataset = item
+        return upload_dataset_datafiles(api, limiter, lock_limiter, ds_id, dataset)
+
+    # datasets are independent, so their datafiles are uploaded concurrently.
+    for ds_id, update in run_concurrent(upload, limit_datasets(data), UPLOAD_DATAFILES_WORKERS):
+        if update:
+            journal.append(ds_id, update)
+    journal.compact()
     print('- Upload Datafiles COMPLETED.')
     return data
 
 
-def destroy_datasets(data):
-    counter = 0
-    api = NativeApi(BASE_URL, API_TOKEN)
+# delete removes the draft version, destroy the dataset with all versions
+REMOVE_ACTIONS = {
+    'delete': ('deletion_date', 'deleted'),
+    'destroy': ('destruction_date', 'destroyed')
+}
 
-    for ds_id, dataset in data.items():
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
-        history = read_history(ds_dir)
-        if 'pid' in history:
-            pid = history['pid']
-            if 'destruction_date' in history:
-                if history['destruction_date']:
-                    do_destroy = False
+
+def remove_dataset(api, limiter, ds_id, action, dry_run=False):
+    # returns the history with the new timestamp, if the dataset was removed
+    date_key, done = REMOVE_ACTIONS[action]
+    history = read_history(os.path.join(INGEST_DIR, ds_id))
+    if 'pid' not in history:
+        return ds_id, None
+    pid = history['pid']
+    if history.get(date_key):
+        print('Dataset {0} can not be {1}.'.format(pid, done))
+        return ds_id, None
+    if dry_run:
+        print('Dataset {0} ({1}) would be {2}.'.format(pid, ds_id, done))
+        return ds_id, None
+    limiter.wait()
+    try:
+        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if action == 'delete':
+            resp = api.delete_dataset(pid)
+        else:
+            resp = api.destroy_dataset(pid)
+        if 'status' in resp.json():
+            if resp.json()['status'] == 'OK':
+                if 'data' in resp.json():
+                    history[date_key] = ts
+                    return ds_id, history
                 else:
-                    do_destroy = True
+                    print('ERROR: {0} Dataset {1} - no data in API response.'.format(action.capitalize(), pid))
             else:
-                do_destroy = True
-            if do_destroy:
-                try:
-                    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    resp = api.destroy_dataset(pid)
-                    if 'status' in resp.json():
-                        if resp.json()['status'] == 'OK':
-                            if 'data' in resp.json():
-                                history['destruction_date'] = ts
-                                save_history(ds_dir, history)
-                            else:
-                                print('ERROR: Destroy Dataset {0} - No data in API response.'.format(pid))
-                        else:
-                            print('ERROR: Destroy Dataset {0} API request status not OK.'.format(pid))
-                except:
-                    print('Dataset {0} could not be destroyed.'.format(pid))
-                time.sleep(1)
+                print('ERROR: {0} Dataset {1} - API request status not OK.'.format(action.capitalize(), pid))
+    except:
+        print('Dataset {0} could not be {1}.'.format(pid, done))
+    return ds_id, None
+
+
+def remove_datasets(data, action, dry_run=False):
+    # Datasets are removed concurrently. The timestamps are saved in batches
+    # of HISTORY_BATCH_SIZE histories per state store transaction.
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(REMOVE_REQUESTS_PER_SECOND)
+    store = open_state_store(INGEST_DIR)
+    histories = {}
+    num_removed = 0
+
+    def remove(item):
+        ds_id, dataset = item
+        return remove_dataset(api, limiter, ds_id, action, dry_run)
+
+    try:
+        for ds_id, history in run_concurrent(remove, limit_datasets(data), REMOVE_WORKERS):
+            if history:
+                histories[ds_id] = history
+                num_removed += 1
+                if len(histories) >= HISTORY_BATCH_SIZE:
+                    store.save_histories(histories)
+                    histories = {}
+    finally:
+        if histories:
+            store.save_histories(histories)
+    return num_removed
+
+
+@timed_stage('destroy_datasets')
+def destroy_datasets(data, dry_run=False):
+    num_destroyed = remove_datasets(data, 'destroy', dry_run)
+    print('- Destroy Datasets {0}COMPLETED ({1} destroyed).'.format('(dry run) ' if dry_run else '', num_destroyed))
+
+
+@timed_stage('delete_datasets')
+def delete_datasets(data, dry_run=False):
+    num_deleted = remove_datasets(data, 'delete', dry_run)
+    print('- Delete Datasets {0}COMPLETED ({1} deleted).'.format('(dry run) ' if dry_run else '', num_deleted))
+
+
+def publish_dataset(api, limiter, ds_id, pid):
+    # returns the CSV update, and if the dataset was locked (e. g. by the
+    # ingest of tabular files), so publishing can be tried again later.
+    update = None
+    locked = False
+    limiter.wait()
+    try:
+        resp = api.publish_dataset(pid, 'major')
+        if 'status' in resp.json():
+            if resp.json()['status'] == 'OK':
+                if 'data' in resp.json():
+                    update = {'org.is_published': 'TRUE'}
+                else:
+                    print('ERROR: Publish Dataset {0} - no data in API response.'.format(pid))
+            elif resp.status_code == 409:
+                locked = True
             else:
-                print('Dataset {0} can not be destroyed.'.format(pid))
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
-    print('- Destroy Datasets COMPLETED.')
+                print('ERROR: Publish Dataset {0} API request status not OK.'.format(pid))
+    except:
+        print('Dataset {0} could not be published.'.format(pid))
+    return ds_id, update, locked
 
 
+def publish_dataset_when_ready(api, limiter, lock_limiter, ds_id, pid):
+    # publish only datasets without locks, as the ingest of tabular files
+    # must be finished first. Locked datasets are reported back as locked.
+    # Without lock information the publish is tried, Dataverse answers 409
+    # for locked datasets.
+    lock_limiter.wait()
+    try:
+        if get_dataset_locks(api, pid):
+            return ds_id, None, True
+    except:
+        print('WARNING: Locks of Dataset {0} could not be retrieved.'.format(pid))
+    return publish_dataset(api, limiter, ds_id, pid)
+
+
+@timed_stage('publish_datasets')
 def publish_datasets(data, filename_datasets):
-    counter = 0
-    update_dict = {}
-    api = NativeApi(BASE_URL, API_TOKEN)
+    journal = StatusJournal(filename_datasets)
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(PUBLISH_REQUESTS_PER_SECOND)
+    lock_limiter = RateLimiter(LOCK_POLL_REQUESTS_PER_SECOND)
+    pids = {}
 
-    for ds_id, dataset in data.items():
-        pid = None
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
-        history = read_history(ds_dir)
-        if dataset['metadata']['org.to_publish'] and not dataset['metadata']['org.is_published']:
-            do_publish = True
-        else:
-            do_publish = False
+    for ds_id, dataset in limit_datasets(data):
         pid = dataset['metadata']['org.doi']
-        if do_publish:
-            try:
-                ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                resp = api.publish_dataset(pid, 'major')
-                if 'status' in resp.json():
-                    if resp.json()['status'] == 'OK':
-                        if 'data' in resp.json():
-                            # history['publishing_date'] = ts
-                            # save_history(ds_dir, history)
-                            update_dict[ds_id] = {'org.is_published': 'TRUE'}
-                        else:
-                            print('ERROR: Publish Dataset {0} - no data in API response.'.format(pid))
-                    else:
-                        print('ERROR: Publish Dataset {0} API request status not OK.'.format(pid))
-            except:
-                print('Dataset {0} could not be published.'.format(pid))
-            time.sleep(1)
+        if dataset['metadata']['org.to_publish'] and not dataset['metadata']['org.is_published']:
+            pids[ds_id] = pid
         else:
             print('Dataset {0} can not be published.'.format(pid))
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
+
+    def publish(ds_id):
+        return publish_dataset_when_ready(api, limiter, lock_limiter, ds_id, pids[ds_id])
+
+    # ready datasets are published concurrently, locked ones are requeued
+    # with growing delays, until LOCK_TIMEOUT is reached.
+    queue = list(pids)
+    start = time.monotonic()
+    delays = backoff(LOCK_POLL_INITIAL, 2, LOCK_POLL_MAX)
+    while queue:
+        requeue = []
+        for ds_id, update, locked in run_concurrent(publish, queue, PUBLISH_WORKERS):
+            if update:
+                journal.append(ds_id, update)
+                print('Dataset {0} published.'.format(pids[ds_id]))
+            elif locked:
+                requeue.append(ds_id)
+        if not requeue:
+            break
+        delay = next(delays)
+        if time.monotonic() - start + delay > LOCK_TIMEOUT:
+            for ds_id in requeue:
+                print('ERROR: Dataset {0} still locked after {1}s. Not published.'.format(pids[ds_id], LOCK_TIMEOUT))
             break
-    update_csv(filename_datasets, update_dict)
+        print('{0} Datasets locked, next try in {1}s.'.format(len(requeue), delay))
+        time.sleep(delay)
+        queue = requeue
+    journal.compact()
     print('- Publish Datasets COMPLETED.')
 
 
-def delete_datasets(data):
-    counter = 0
-    api = NativeApi(BASE_URL, API_TOKEN)
+@timed_stage('pipeline')
+def run_pipeline(data, filename_datasets, filename_datafiles, targets=None, force=False):
+    # Every dataset runs through its stages on its own, so uploads start as
+    # soon as the first OAIS trees are set up. Completed stages are saved as
+    # checkpoints in the state store, a re-run continues where it stopped.
+    # The upload and publish stages have rate limiters of their own, so
+    # they overlap instead of waiting for each other.
+    store = open_state_store(INGEST_DIR)
+    ds_journal = StatusJournal(filename_datasets)
+    df_journal = StatusJournal(filename_datafiles)
+    api = get_native_api(BASE_URL, API_TOKEN)
+    datasets_limiter = RateLimiter(UPLOAD_DATASETS_REQUESTS_PER_SECOND)
+    datafiles_limiter = RateLimiter(UPLOAD_DATAFILES_REQUESTS_PER_SECOND)
+    publish_limiter = RateLimiter(PUBLISH_REQUESTS_PER_SECOND)
+    lock_limiter = RateLimiter(LOCK_POLL_REQUESTS_PER_SECOND)
 
-    for ds_id, dataset in data.items():
-        counter += 1
-        ds_dir = os.path.join(INGEST_DIR, ds_id)
+    def setup_dir(ds_id, dataset):
+        _, error = setup_dataset_dir(ds_id, dataset)
+        if error:
+            raise RuntimeError(error)
+
+    def dataset_json(ds_id, dataset):
+        save_dataset_dataverse_json(os.path.join(INGEST_DIR, ds_id), dataset['metadata'], ds_id)
+
+    def upload_metadata(ds_id, dataset):
+        _, update = upload_dataset(api, datasets_limiter, ds_id, dataset)
+        if update:
+            ds_journal.append(ds_id, update)
+        if not store.is_dataset_uploaded(ds_id):
+            raise RuntimeError('Dataset not uploaded.')
+
+    def datafiles_json(ds_id, dataset):
+        _, error = create_dataset_datafiles_json(ds_id, dataset)
+        if error:
+            raise RuntimeError(error)
+
+    def upload_files(ds_id, dataset):
+        _, update = upload_dataset_datafiles(api, datafiles_limiter, lock_limiter, ds_id, dataset)
+        if update:
+            df_journal.append(ds_id, update)
+        missing = [df_id for df_id in dataset.get('datafiles', {}) if not store.is_datafile_uploaded(ds_id, df_id)]
+        if missing:
+            raise RuntimeError('Datafiles {0} not uploaded.'.format(', '.join(missing)))
+
+    def publish(ds_id, dataset):
+        metadata = dataset['metadata']
+        if not metadata.get('org.to_publish') or metadata.get('org.is_published'):
+            return SKIPPED
+        pid = read_history(os.path.join(INGEST_DIR, ds_id))['pid']
+        # the ingest of the last tabular files may still be running. Without
+        # lock information, a 409 of the publish request is tried again.
+        start = time.monotonic()
+        for delay in backoff(LOCK_POLL_INITIAL, 2, LOCK_POLL_MAX):
+            if not wait_for_dataset_unlock(api, lock_limiter, pid, 0):
+                raise RuntimeError('Dataset still locked after {0}s.'.format(LOCK_TIMEOUT))
+            _, update, locked = publish_dataset(api, publish_limiter, ds_id, pid)
+            if not locked:
+                break
+            if time.monotonic() - start + delay > LOCK_TIMEOUT:
+                raise RuntimeError('Dataset still locked after {0}s.'.format(LOCK_TIMEOUT))
+            time.sleep(delay)
+        if not update:
+            raise RuntimeError('Dataset not published.')
+        ds_journal.append(ds_id, update)
+
+    pipeline = Pipeline([
+        Stage('setup_dir', setup_dir, workers=SETUP_DIRS_WORKERS),
+        Stage('dataset_json', dataset_json, ['setup_dir']),
+        Stage('upload_dataset', upload_metadata, ['dataset_json'], UPLOAD_DATASETS_WORKERS),
+        Stage('datafiles_json', datafiles_json, ['upload_dataset']),
+        Stage('upload_datafiles', upload_files, ['datafiles_json'], UPLOAD_DATAFILES_WORKERS),
+        Stage('publish', publish, ['upload_datafiles'], PUBLISH_WORKERS)
+    ], store, PIPELINE_WORKERS)
+    summary = pipeline.run(limit_datasets(data), targets, force)
+    ds_journal.compact()
+    df_journal.compact()
+    for name, counts in summary.items():
+        print('- Pipeline {0}: {1} done, {2} skipped, {3} failed, {4} blocked, {5} from checkpoint.'.format(
+            name, counts[DONE], counts[SKIPPED], counts[FAILED], counts[BLOCKED], counts[CHECKPOINT]))
+    print('- Pipeline COMPLETED.')
+    return summary
+
+
+def dataset_fields(payload):
+    # metadata block fields of a dataset JSON by typeName
+    fields = {}
+    for block in json_loads(payload)['datasetVersion']['metadataBlocks'].values():
+        for field in block['fields']:
+            fields[field['typeName']] = field
+    return fields
+
+
+def diff_dataset_fields(old_fields, new_fields, keys):
+    # fields to replace and fields to delete, only for the given keys
+    changed = [field for type_name, field in new_fields.items() if type_name in keys and old_fields.get(type_name) != field]
+    removed = [field for type_name, field in old_fields.items() if type_name in keys and type_name not in new_fields]
+    return changed, removed
+
+
+def keep_dataset_fields(payload, old_payload, type_names):
+    # dataset JSON of payload, with the given fields of old_payload still in
+    # their metadata blocks
+    data = json_loads(payload)
+    blocks = data['datasetVersion']['metadataBlocks']
+    for name, block in json_loads(old_payload)['datasetVersion']['metadataBlocks'].items():
+        kept = [field for field in block['fields'] if field['typeName'] in type_names]
+        if kept:
+            blocks.setdefault(name, {'displayName': block.get('displayName', name), 'fields': []})['fields'].extend(kept)
+    return json.dumps(data, indent=2)
+
+
+def update_dataset(api, limiter, ds_id, metadata, keys):
+    # Only the fields, which differ from the dataset JSON of the last upload
+    # in the AIP, are sent. Unchanged datasets need no request at all and
+    # are journaled as such.
+    update = {'org.is_updated': 'TRUE', 'org.to_update': 'FALSE'}
+    unchanged = {'org.is_updated': 'UNCHANGED', 'org.to_update': 'FALSE'}
+    ds_dir = os.path.join(INGEST_DIR, ds_id)
+    # a bad cell or a corrupt AIP JSON only skips this dataset
+    try:
         history = read_history(ds_dir)
-        if 'pid' in history:
-            pid = history['pid']
-            if 'deletion_date' in history:
-                if history['deletion_date']:
-                    do_deletion = False
-                else:
-                    do_deletion = True
-            else:
-                do_deletion = True
-            if do_deletion:
-                try:
-                    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    resp = api.delete_dataset(pid)
-                    if 'status' in resp.json():
-                        if resp.json()['status'] == 'OK':
-                            if 'data' in resp.json():
-                                history['deletion_date'] = ts
-                                save_history(ds_dir, history)
-                            else:
-                                print('ERROR: Delete Dataset {0} - no data in API response.'.format(pid))
-                        else:
-                            print('ERROR: Delete Dataset {0} - API request status not OK.'.format(pid))
-                except:
-                    print('Dataset \'{0}\' could not be deleted.'.format(pid))
-                time.sleep(2)
-            else:
-                print('Dataset {0} can not be deleted.'.format(pid))
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
-    print('- Delete Datasets COMPLETED.')
+        if 'pid' not in history:
+            print('Dataset \'{0}\' is not been uploaded.'.format(ds_id))
+            return ds_id, None
+        pid = history['pid']
+        if is_dataset_payload_current(ds_dir, metadata, ds_id):
+            print('Dataset {0} unchanged.'.format(pid))
+            return ds_id, unchanged
+        payload = build_dataset_payload(metadata)
+        filename = dataset_json_filename(ds_dir, ds_id)
+        old_fields = dataset_fields(read_file(filename)) if os.path.isfile(filename) else {}
+        changed, removed = diff_dataset_fields(old_fields, dataset_fields(payload), keys)
+    except Exception as e:
+        print('ERROR: Update Dataset {0} - {1}: {2}'.format(ds_id, type(e).__name__, e))
+        return ds_id, None
+    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        if changed:
+            limiter.wait()
+            resp = api.edit_dataset_metadata(pid, json.dumps({'fields': changed}), replace=True)
+            if resp.json().get('status') != 'OK':
+                print('ERROR: Update Dataset {0} - API request status not OK. MSG: {1}'.format(pid, resp.json()))
+                return ds_id, None
+            if removed:
+                # the AIP follows the server after each edit, so a retry
+                # only sends the deletion. The payload hash stays the old
+                # one, until the deletion succeeded too.
+                write_file(filename, keep_dataset_fields(payload, read_file(filename), {field['typeName'] for field in removed}))
+        if removed:
+            limiter.wait()
+            url = '{0}/datasets/:persistentId/deleteMetadata?persistentId={1}'.format(api.base_url_api_native, pid)
+            resp = api.request('PUT', url, data=json.dumps({'fields': removed}))
+            if resp.json().get('status') != 'OK':
+                print('ERROR: Delete metadata of Dataset {0} - API request status not OK. MSG: {1}'.format(pid, resp.json()))
+                return ds_id, None
+    except:
+        print('Dataset \'{0}\' could not be updated.'.format(pid))
+        return ds_id, None
+    # the AIP holds the uploaded metadata again, for the next comparison
+    save_dataset_dataverse_json(ds_dir, metadata, ds_id, payload)
+    if not changed and not removed:
+        print('Dataset {0} unchanged.'.format(pid))
+        return ds_id, unchanged
+    if 'update_date' not in history:
+        history['update_date'] = []
+    history['update_date'].append(ts)
+    save_history(ds_dir, history)
+    print('Dataset {0} updated: {1}.'.format(pid, ', '.join(field['typeName'] for field in changed + removed)))
+    return ds_id, update
 
 
+@timed_stage('update_datasets')
 def update_datasets(data, filename_updated_csv):
-    counter = 0
-    update_dict = {}
-    api = NativeApi(BASE_URL, API_TOKEN)
+    # data are the rows of the updated datasets CSV. Every field of the
+    # CSV columns can be updated, the edits run concurrently.
+    journal = StatusJournal(filename_updated_csv)
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(UPDATE_REQUESTS_PER_SECOND)
+    keys = set()
 
-    for dataset in data:
-        counter += 1
-        if dataset['org.to_update'] == 'TRUE' and dataset['org.is_updated'] == 'FALSE':
-            do_update = True
-        else:
-            do_update = False
-
-        if do_update:
-            ds_id = dataset['org.dataset_id']
-            pid = dataset['org.doi']
-            geo_csv = json.loads(dataset['dv.geographicCoverage'])
-            g_list = []
-            for g in geo_csv:
-                d_dict = {}
-                for key, val in g.items():
-                    d_dict[key] = {}
-                    d_dict[key]['typeName'] = key
-                    d_dict[key]['value'] = val
-                g_list.append(d_dict)
-            data = {
-                "fields": [
-                    {
-                        "typeName": "geographicCoverage",
-                        "value": g_list
-                    }
-                ]
-            }
-            ds_dir = os.path.join(INGEST_DIR, ds_id)
-            history = read_history(ds_dir)
-            if 'pid' in history:
-                try:
-                    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    resp = api.edit_dataset_metadata(pid, json.dumps(data), replace=True)
-                    if 'status' in resp.json():
-                        if resp.json()['status'] == 'OK':
-                            if 'data' in resp.json():
-                                if 'update_date' not in history:
-                                    history['update_date'] = []
-                                history['update_date'].append(ts)
-                                update_dict[ds_id] = {'org.is_updated': 'TRUE', 'org.to_update': 'FALSE'}
-                                save_history(ds_dir, history)
-                            else:
-                                print('ERROR: Update Dataset {0} - no data in API response.'.format(pid))
-                        else:
-                            print('ERROR: Update Dataset {0} - API request status not OK. MSG: {1}'.format(pid, resp.json()['status']))
-                    else:
-                        print('ERROR: Update Dataset {0} - API request status not available.'.format(pid))
-                except:
-                    print('Dataset \'{0}\' could not be updated.'.format(pid))
-            else:
-                print('Dataset \'{0}\' is not been uploaded.'.format(pid))
-            time.sleep(2)
-        if counter >= NUM_DATASETS and NUM_DATASETS >= 0:
-            break
-    update_csv(filename_updated_csv, update_dict)
+    def to_update():
+        columns = None
+        rows = islice(data, max(NUM_DATASETS, 1)) if NUM_DATASETS >= 0 else data
+        for row in rows:
+            if columns is None:
+                columns = dataset_columns(tuple(row))
+                keys.update(columns[2].keys)
+            if row['org.to_update'] == 'TRUE' and row['org.is_updated'] == 'FALSE':
+                yield import_dataset_row(row, columns)
+
+    def edit(item):
+        ds_id, metadata = item
+        return update_dataset(api, limiter, ds_id, metadata, keys)
+
+    try:
+        for ds_id, update in run_concurrent(edit, to_update(), UPDATE_DATASETS_WORKERS):
+            if update:
+                journal.append(ds_id, update)
+    finally:
+        journal.compact()
     print('- Update Datasets COMPLETED.')
 
 
+def import_datafile_metadata_row(datafile):
+    # file metadata of a datafiles CSV row, as sent to Dataverse
+    metadata = {}
+    for key in DATAFILE_METADATA_KEYS:
+        val = datafile.get('dv.' + key)
+        if val:
+            if key == 'restrict':
+                val = BOOLEANS.get(clean_string(val))
+                if val is not None:
+                    metadata[key] = val
+            elif key in DATAFILE_JSON_KEYS:
+                metadata[key] = to_json(val)
+            else:
+                metadata[key] = clean_string(val)
+    return metadata
+
+
+def read_uploaded_datafile_metadata(ds_id, df_id):
+    # file metadata of the datafile JSON in the AIP, as it was uploaded
+    filename = datafile_json_filename(os.path.join(INGEST_DIR, ds_id), ds_id, df_id)
+    if not os.path.isfile(filename):
+        return None
+    return {key: val for key, val in read_json(filename).items() if key in DATAFILE_METADATA_KEYS}
+
+
+def datafile_labels(filename):
+    # labels a file gets in Dataverse: its filename, or for ingested tabular
+    # files the filename stem with .tab
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() in TABULAR_INGEST_EXTENSIONS:
+        return [filename, stem + '.tab']
+    return [filename]
+
+
+def index_datafile_listing(files):
+    # Dataverse file ID by filename and label
+    index = {}
+    for df in files:
+        index[df['filename']] = df['id']
+        if df.get('label'):
+            index[df['label']] = df['id']
+    return index
+
+
+@timed_stage('update_datafiles')
 def update_datafiles(datafiles_update_csv, datafiles_csv, datasets_csv):
+    # The updated datafiles are joined with datafiles.csv, datasets.csv and
+    # the datafile listings of Dataverse via dicts: datafile ID -> uploaded
+    # metadata, dataset ID -> PID and filename -> Dataverse file ID.
+    updates = {}
+    for datafile in datafiles_update_csv:
+        updates[clean_string(datafile['org.datafile_id'])] = import_datafile_metadata_row(datafile)
+
+    # only the fields, which differ from the uploaded metadata in the AIP
+    # (or datafiles.csv, if not available), are sent
+    jobs = {}
+    for datafile in datafiles_csv:
+        df_id = clean_string(datafile['org.datafile_id'])
+        if df_id not in updates:
+            continue
+        ds_id = clean_string(datafile['org.dataset_id'])
+        uploaded = read_uploaded_datafile_metadata(ds_id, df_id)
+        if uploaded is None:
+            uploaded = import_datafile_metadata_row(datafile)
+        # files are uploaded unrestricted, unless set otherwise
+        changed = {key: val for key, val in updates[df_id].items() if uploaded.get(key, False if key == 'restrict' else None) != val}
+        if changed:
+            jobs[df_id] = {
+                'ds_id': ds_id,
+                'filename': clean_string(datafile['org.filename']),
+                'metadata': changed
+            }
+    missing = [df_id for df_id in updates if df_id not in jobs]
+    print('{0} Datafiles to update, {1} unchanged or not in datafiles CSV.'.format(len(jobs), len(missing)))
+
+    ds_ids = set(job['ds_id'] for job in jobs.values())
+    pids = {}
+    for dataset in datasets_csv:
+        ds_id = clean_string(dataset['org.dataset_id'])
+        if ds_id in ds_ids:
+            pid = dataset.get('org.doi')
+            if not pid:
+                pid = read_history(os.path.join(INGEST_DIR, ds_id)).get('pid')
+            if pid:
+                pids[ds_id] = pid
+
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(UPDATE_REQUESTS_PER_SECOND)
+
+    def crawl(pid):
+        # only the listing is needed, not the dataset version
+        return crawl_datafiles(api, limiter, pid, version={})
+
+    file_ids = {}
+    for pid, entry, error in run_concurrent(crawl, sorted(set(pids.values())), CRAWL_WORKERS):
+        if error:
+            print('ERROR: Crawl Datafiles of Dataset {0} - {1}'.format(pid, error))
+        else:
+            file_ids[pid] = index_datafile_listing(entry['files'])
+
+    to_update = []
+    for df_id, job in jobs.items():
+        pid = pids.get(job['ds_id'])
+        if pid not in file_ids:
+            print('ERROR: Dataset {0} of Datafile {1} not available.'.format(job['ds_id'], df_id))
+            continue
+        for label in datafile_labels(job['filename']):
+            if label in file_ids[pid]:
+                to_update.append((df_id, file_ids[pid][label], job['metadata']))
+                break
+        else:
+            print('ERROR: Datafile {0} ({1}) not found in Dataset {2}.'.format(df_id, job['filename'], pid))
+
+    def update(item):
+        df_id, file_id, metadata = item
+        try:
+            return df_id, post_datafile_metadata(api, limiter, file_id, metadata)
+        except Exception as e:
+            return df_id, {'status': 'ERROR', 'message': '{0}: {1}'.format(type(e).__name__, e)}
+
+    num_updated = 0
+    for df_id, resp_json in run_concurrent(update, to_update, UPDATE_DATAFILES_WORKERS):
+        if resp_json.get('status') == 'OK':
+            num_updated += 1
+        else:
+            print('ERROR: Update Datafile {0} - API response status not OK. MSG: {1}'.format(df_id, resp_json.get('message', resp_json)))
+
+    if UPDATE_ALLOW_ACCESS_REQUEST:
+        restricted = set(pids[job['ds_id']] for job in jobs.values() if job['metadata'].get('restrict') and job['ds_id'] in pids)
+        api_da = get_data_access_api(BASE_URL, API_TOKEN)
+
+        def allow(pid):
+            limiter.wait()
+            try:
+                return pid, api_da.allow_access_request(pid).json()
+            except Exception as e:
+                return pid, {'status': 'ERROR', 'message': '{0}: {1}'.format(type(e).__name__, e)}
+
+        for pid, resp_json in run_concurrent(allow, sorted(restricted), UPDATE_DATAFILES_WORKERS):
+            if resp_json.get('status') != 'OK':
+                print('ERROR: Allow access request of Dataset {0} - MSG: {1}'.format(pid, resp_json.get('message', resp_json)))
+    print('- Update Datafiles COMPLETED ({0} of {1} updated).'.format(num_updated, len(jobs)))
+
+
+def get_datafiles_listing(api, pid, version=':latest'):
+    url = '{0}/datasets/:persistentId/versions/{1}/files?persistentId={2}'.format(api.base_url_api_native, version, pid)
+    return api.get_request(url, auth=True)
+
+
+def get_latest_version(api, pid):
+    # older Dataverse versions ignore excludeFiles and list the files too
+    url = '{0}/datasets/:persistentId/versions/:latest?persistentId={1}&excludeFiles=true'.format(api.base_url_api_native, pid)
+    return api.get_request(url, auth=True)
+
+
+def read_latest_version(api, limiter, pid):
+    # ID and last update time of the latest dataset version, which change
+    # with every edit on the server
+    limiter.wait()
+    resp_dict = get_latest_version(api, pid).json()
+    if resp_dict.get('status') != 'OK':
+        raise RuntimeError(resp_dict.get('message', resp_dict))
+    return {'version': resp_dict['data'].get('id'), 'last_update': resp_dict['data'].get('lastUpdateTime')}
+
+
+def is_redetect_candidate(datafile):
+    # PDFs, which were not detected as such during upload
+    filename = datafile['dataFile']['filename']
+    return os.path.splitext(filename)[1].lower() == '.pdf' and datafile['dataFile']['contentType'] != 'application/pdf'
+
+
+def history_change_date(history):
+    # timestamps share one format, so the latest one is the max string
+    dates = [history.get('upload_date'), history.get('deletion_date'), history.get('destruction_date')]
+    dates += history.get('update_date', [])
+    dates += [df.get('upload_date') for df in history.get('datafiles', {}).values()]
+    dates = [date for date in dates if date]
+    if dates:
+        return max(dates)
+    return None
+
+
+def crawl_datafiles(api, limiter, pid, version=None):
+    # the version is read before the listing, so changes in between are
+    # crawled again in the next run
+    try:
+        if version is None:
+            version = read_latest_version(api, limiter, pid)
+        limiter.wait()
+        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        resp_dict = get_datafiles_listing(api, pid).json()
+    except Exception as e:
+        return pid, None, '{0}: {1}'.format(type(e).__name__, e)
+    if resp_dict.get('status') != 'OK':
+        return pid, None, resp_dict.get('message', resp_dict)
+    files = [{
+        'id': str(df['dataFile']['id']),
+        'filename': df['dataFile']['filename'],
+        'label': df.get('label'),
+        'contentType': df['dataFile']['contentType']
+    } for df in resp_dict['data']]
+    return pid, dict(version, crawl_date=ts, files=files), None
+
+
+@timed_stage('discover_redetect_candidates')
+def discover_redetect_candidates(datasets_csv, filename_cache, recrawl_all=False):
+    # Crawls the datafile listings of all uploaded datasets concurrently.
+    # Listings are cached by PID, with ID and last update time of the
+    # dataset version. On re-runs, datasets changed locally since their last
+    # crawl are crawled again, the others only if their latest version on
+    # the server differs from the cached one.
+    cache = {}
+    if os.path.isfile(filename_cache) and not recrawl_all:
+        cache = read_json(filename_cache)
+    to_crawl = []
+    to_check = set()
+    for ds in datasets_csv:
+        pid = ds['org.doi']
+        if not pid:
+            continue
+        if pid in cache:
+            try:
+                change_date = history_change_date(read_history(os.path.join(INGEST_DIR, ds['org.dataset_id'])))
+            except FileNotFoundError:
+                change_date = None
+            if not change_date or change_date <= cache[pid]['crawl_date']:
+                to_check.add(pid)
+        to_crawl.append(pid)
+
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(CRAWL_REQUESTS_PER_SECOND)
+
+    def crawl(pid):
+        version = None
+        if pid in to_check:
+            try:
+                version = read_latest_version(api, limiter, pid)
+            except Exception as e:
+                return pid, None, '{0}: {1}'.format(type(e).__name__, e)
+            if all(cache[pid].get(key) == val for key, val in version.items()):
+                return pid, cache[pid], None
+        return crawl_datafiles(api, limiter, pid, version)
+
+    num_crawled = 0
+    for pid, entry, error in run_concurrent(crawl, to_crawl, CRAWL_WORKERS):
+        if error:
+            print('ERROR: Crawl Datafiles of Dataset {0} - {1}'.format(pid, error))
+        elif entry is not cache.get(pid):
+            cache[pid] = entry
+            num_crawled += 1
+    write_json(filename_cache, cache)
+
     df_id_lst = []
-    df_lst = []
-    ds_id_lst = []
-    ds_lst = []
-    data = []
-    df_attr_upload = [
-        'description',
-        'categories',
-        'restrict',
-        'directoryLabel',
-        'label'
-    ]
-    api = NativeApi(BASE_URL, API_TOKEN)
-    api_da = DataAccessApi(BASE_URL, API_TOKEN)
-
-    # # collect all datafile IDs
-    # for df in datafiles_update_csv:
-    #     if df['dv.restrict'] == 'TRUE':
-    #         df_id_lst.append(df['org.datafile_id'])
-    # # collect datafile data
-    # for df in datafiles_csv:
-    #     if df['org.datafile_id'] in df_id_lst:
-    #         df_lst.append({
-    #             'org.datafile_id': df['org.datafile_id'],
-    #             'filename': df['org.filename'],
-    #             'dataset_id': df['org.dataset_id']
-    #         })
-    #         if df['org.dataset_id'] not in ds_id_lst:
-    #             ds_id_lst.append(df['org.dataset_id'])
-    #
-    # # collect PID's
-    # for ds in datasets_csv:
-    #     if ds['org.dataset_id'] in ds_id_lst:
-    #         ds_lst.append({
-    #             'dataset_id': ds['org.dataset_id'],
-    #             'pid': ds['org.doi']
-    #         })
-    #
-    # # allow access request
-    # for ds in ds_lst:
-    #     resp = api_da.allow_access_request(ds['pid'])
-    #     print(resp.text)
-
-    # # update datafile metadata
-    # for ds in ds_lst:
-    #     resp = api.get_datafiles(ds['pid'], version=':latest')
-    #     dv_files = resp.json()['data']
-    #     for dv_file in dv_files:
-    #         for idx, df_file in enumerate(df_lst):
-    #             if dv_file['label'] == df_file['filename']:
-    #                 df_lst[idx]['dv.datafile_id'] = dv_file['dataFile']['id']
-    #             elif df_file['filename'].split('.')[1] == 'dta' and dv_file['label'].split('.')[1] == 'tab' and dv_file['label'].split('.')[0] == df_file['filename'].split('.')[0]:
-    #                 df_lst[idx]['dv.datafile_id'] = dv_file['dataFile']['id']
-    #                 df_lst[idx]['filename'] = dv_file['label']
-    # print(json.dumps(df_lst))
-    # df_lst = read_json(os.path.join(DATA_DIR, 'df_lst.json'))
-    # for df in df_lst:
-    #     resp = api.get_datafile_metadata(df['dv.datafile_id'], is_draft=True)
-    #     data_resp = resp.json()
-    #     dict_tmp = {
-    #         'restrict': True
-    #     }
-    #     for key, val in data_resp.items():
-    #         if key in df_attr_upload:
-    #             dict_tmp[key] = val
-    #     data.append([dict_tmp, df['dv.datafile_id']])
-    # print(json.dumps(data))
-
-    # data = read_json(os.path.join(DATA_DIR, 'df_metadata.json'))
-    # for df_data, df_id in data[:]:
-    #     resp = api.update_datafile_metadata(df_id, json_str=json.dumps(df_data), is_filepid=False)
-    #     print(resp)
+    for pid, entry in cache.items():
+        for df in entry['files']:
+            if is_redetect_candidate({'dataFile': df}):
+                df_id_lst.append(df['id'])
+    print('- Discover Datafiles COMPLETED ({0} Datasets crawled, {1} candidates).'.format(num_crawled, len(df_id_lst)))
+    return df_id_lst
+
+
+def apply_redetect_results(filename_cache, results):
+    # keep the cached listings up to date, instead of crawling them again
+    cache = read_json(filename_cache)
+    for entry in cache.values():
+        for df in entry['files']:
+            if df['id'] in results and results[df['id']].get('newContentType'):
+                df['contentType'] = results[df['id']]['newContentType']
+    write_json(filename_cache, cache)
+
+
+def redetect_datafile(api, limiter, df_id, dry_run=False):
+    url = '{0}/files/{1}/redetect'.format(api.base_url_api_native, df_id)
+    limiter.wait()
+    try:
+        resp = api.post_request(url, params={'dryRun': 'true' if dry_run else 'false'}, auth=True)
+        resp_dict = resp.json()
+    except Exception as e:
+        return df_id, None, '{0}: {1}'.format(type(e).__name__, e)
+    if resp_dict.get('status') != 'OK':
+        return df_id, None, resp_dict.get('message', resp_dict)
+    return df_id, resp_dict.get('data', {}), None
+
+
+@timed_stage('redetect_datafiles')
+def redetect_datafiles(df_id_lst, dry_run=False):
+    results = {}
+    num_changed = 0
+    num_failed = 0
+    api = get_native_api(BASE_URL, API_TOKEN)
+    limiter = RateLimiter(REDETECT_REQUESTS_PER_SECOND)
+
+    def redetect(df_id):
+        return redetect_datafile(api, limiter, df_id, dry_run)
+
+    for df_id, data, error in run_concurrent(redetect, df_id_lst, REDETECT_WORKERS):
+        if error:
+            print('ERROR: Redetect Datafile {0} - {1}'.format(df_id, error))
+            num_failed += 1
+        else:
+            results[df_id] = data
+            if data.get('oldContentType') != data.get('newContentType'):
+                num_changed += 1
+                print('Datafile {0}: {1} -> {2}'.format(df_id, data.get('oldContentType'), data.get('newContentType')))
+    print('- Redetect Datafiles {0}COMPLETED ({1} OK, {2} changed, {3} failed).'.format(
+        '(dry run) ' if dry_run else '', len(results), num_changed, num_failed))
+    return results
 
 
 if __name__ == '__main__':
     print('START --------------------------')
+    configure_session(pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT)
+    metrics_writer = start_metrics_writer(FILENAME_METRICS_PROMETHEUS, FILENAME_METRICS_JSON, METRICS_INTERVAL)
 
     # Workflow Control
-    CREATE_1 = False
-    CREATE_2 = False
-    CREATE_3 = False
+    COMPACT_JOURNALS = True
+    IMPORT_HISTORY = False
+    STREAM_IMPORT = False
+    # setup_dir -> dataset_json -> upload_dataset -> datafiles_json ->
+    # upload_datafiles -> publish. The targets run with all their
+    # dependencies, completed stages are skipped.
+    RUN_PIPELINE = False
+    PIPELINE_TARGETS = ['upload_datafiles']
+    PIPELINE_FORCE = False
+    VERIFY_DIRS = False
     DELETE = False
-    PUBLISH = False
+    DESTROY = False
+    # only list the datasets, which would be deleted or destroyed
+    REMOVE_DRY_RUN = True
     REDETECT_DATATYPE = True
+    REDETECT_DRY_RUN = False
     UPDATE_DATASETS = False
     UPDATE_DATAFILES = False
 
-    if CREATE_1:
-        datasets_csv = read_csv_as_dicts(FILENAME_DATASETS, delimiter=',')
-        data = import_datasets(datasets_csv)
-        datafiles_csv = read_csv_as_dicts(FILENAME_DATAFILES, delimiter=',')
-        data = import_datafiles(data, datafiles_csv)
-        write_pickle(os.path.join(DATA_DIR, 'import_datafiles.pickle'), data)
-        setup_dirs(data, delete_all_folders=False, overwrite_all=False)
-    if CREATE_2:
-        data = read_pickle(os.path.join(DATA_DIR, 'import_datafiles.pickle'))
-        create_datasets_json(data)
-        data = upload_datasets(data, FILENAME_DATASETS)
-    if CREATE_3:
-        data = read_pickle(os.path.join(DATA_DIR, 'import_datafiles.pickle'))
-        create_datafiles_json(data)
-        data = upload_datafiles(data, FILENAME_DATAFILES)
-    if PUBLISH:
-        datasets_csv = read_csv_as_dicts(FILENAME_DATASETS, delimiter=',')
-        data = import_datasets(datasets_csv)
-        write_pickle(os.path.join(DATA_DIR, 'publish_datasets.pickle'), data)
-        data = read_pickle(os.path.join(DATA_DIR, 'publish_datasets.pickle'))
-        publish_datasets(data, FILENAME_DATASETS)
+    if COMPACT_JOURNALS:
+        # merge status changes of an interrupted run into the CSV files
+        for filename in [FILENAME_DATASETS, FILENAME_DATAFILES, os.path.join(DATA_DIR, 'datasets_updated.csv')]:
+            if os.path.isfile(filename):
+                num_rows = StatusJournal(filename).compact()
+                if num_rows:
+                    print('- Compact Journal {0}: {1} rows updated.'.format(filename, num_rows))
+    if IMPORT_HISTORY:
+        # one-off migration of the {id}_history.json files into the state store
+        num_histories = import_history_files(INGEST_DIR)
+        print('- Import {0} History files COMPLETED.'.format(num_histories))
+    if RUN_PIPELINE:
+        if STREAM_IMPORT:
+            data = stream_catalogue(FILENAME_DATASETS, FILENAME_DATAFILES)
+        else:
+            data = import_catalogue(FILENAME_DATASETS, FILENAME_DATAFILES, FILENAME_IMPORT_CACHE)
+        run_pipeline(data, FILENAME_DATASETS, FILENAME_DATAFILES, targets=PIPELINE_TARGETS, force=PIPELINE_FORCE)
+    if VERIFY_DIRS:
+        data = import_catalogue(FILENAME_DATASETS, FILENAME_DATAFILES, FILENAME_IMPORT_CACHE)
+        verify_dirs(data, deep=False)
     if DELETE:
-        data = read_pickle(os.path.join(DATA_DIR, 'import_datafiles.pickle'))
-        delete_datasets(data)
+        data = import_catalogue(FILENAME_DATASETS, FILENAME_DATAFILES, FILENAME_IMPORT_CACHE)
+        delete_datasets(data, dry_run=REMOVE_DRY_RUN)
+    if DESTROY:
+        data = import_catalogue(FILENAME_DATASETS, FILENAME_DATAFILES, FILENAME_IMPORT_CACHE)
+        destroy_datasets(data, dry_run=REMOVE_DRY_RUN)
     if REDETECT_DATATYPE:
-        # df_id_lst = []
-        # datasets_csv = read_csv_as_dicts(FILENAME_DATASETS, delimiter=',')
-        # api = NativeApi(BASE_URL, API_TOKEN)
-        # for ds in datasets_csv:
-        #     resp = api.get_datafiles(ds['org.doi'])
-        #     for df in resp.json()['data']:
-        #         if df['dataFile']['filename'].split('.')[1] == 'pdf' and df['dataFile']['contentType'] != 'application/pdf':
-        #             df_id_lst.append(str(df['dataFile']['id']))
-        # write_json('df_id.json', df_id_lst)
-        df_id_lst = read_json('df_id.json')
-        for df in df_id_lst:
-            query = '{0}/api/files/{1}/redetect?dryRun=false'.format(BASE_URL, df)
-            shell_command = 'curl -H "X-Dataverse-key: {0}"'.format(API_TOKEN)
-            shell_command += ' -X POST {0}'.format(query)
-            result = sp.run(shell_command, shell=True, stdout=sp.PIPE)
-            resp_dict = json.loads(result.stdout)
-            if resp_dict['status'] != 'OK':
-                print('\n', resp_dict)
+        datasets_csv = read_csv_as_dicts(FILENAME_DATASETS, delimiter=',')
+        df_id_lst = discover_redetect_candidates(datasets_csv, FILENAME_CRAWL_CACHE, recrawl_all=False)
+        results = redetect_datafiles(df_id_lst, dry_run=REDETECT_DRY_RUN)
+        if not REDETECT_DRY_RUN:
+            apply_redetect_results(FILENAME_CRAWL_CACHE, results)
     if UPDATE_DATASETS:
         # 1. get all file ids via get_dataset() call
         filename_updated_csv = os.path.join(DATA_DIR, 'datasets_updated.csv')
-        data = read_csv_as_dicts(filename_updated_csv, delimiter=',')
-        update_datasets(data, filename_updated_csv)
+        update_datasets(read_csv_rows(filename_updated_csv), filename_updated_csv)
     if UPDATE_DATAFILES:
-        datafiles_update_csv = read_csv_as_dicts(os.path.join(DATA_DIR, 'datafiles_updated.csv'), delimiter=',')
-        datafiles_csv = read_csv_as_dicts(FILENAME_DATAFILES, delimiter=',')
-        datasets_csv = read_csv_as_dicts(FILENAME_DATASETS, delimiter=',')
-        update_datafiles(datafiles_update_csv, datafiles_csv, datasets_csv)
+        datafiles_update_csv = read_csv_rows(os.path.join(DATA_DIR, 'datafiles_updated.csv'))
+        update_datafiles(datafiles_update_csv, read_csv_rows(FILENAME_DATAFILES), read_csv_rows(FILENAME_DATASETS))
+    metrics_writer.stop()
     print('END ----------------------------')
@@ -2,17 +2,32 @@
 # -*- coding: utf-8 -*-
 """OAISTree directory structure."""
 import csv
+import hashlib
+import json
 import os
 import shutil
+import threading
 from datetime import datetime
 from tempfile import NamedTemporaryFile
 
 from pyDataverse.models import Datafile, Dataset
 from pyDataverse.utils import read_json, write_file, write_json
+from state import StateStore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 SIP_FOLDER = "SIP"
 AIP_FOLDER = "AIP"
 DIP_FOLDER = "DIP"
+MATERIALIZE_STRATEGIES = ["copy", "hardlink", "reflink", "symlink"]
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+STATE_STORE_FILENAME = "history.sqlite3"
+STATE_STORES = {}
+STATE_STORES_LOCK = threading.Lock()
 
 
 def setup_oaistree(
@@ -54,23 +69,20 @@ def setup_oaistree(
             os.path.join(dataset_dir, DIP_FOLDER, terms_of_access_filename),
             terms_of_access,
         )
-    if overwrite_all:
-        history = {}
-        history["creation_date"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        history["dataset_id"] = dataset_id
-        history["dataset_foldername"] = dataset_dir.split("/")[-1]
-    else:
-        if os.path.isfile(
+    history = None
+    if not overwrite_all:
+        history = get_state_store(dataset_dir).read_history(dataset_id)
+        if history is None and os.path.isfile(
             os.path.join(dataset_dir, "{0}_history.json".format(dataset_id))
         ):
             history = read_json(
                 os.path.join(dataset_dir, "{0}_history.json".format(dataset_id))
             )
-        else:
-            history = {}
-            history["creation_date"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            history["dataset_id"] = dataset_id
-            history["dataset_foldername"] = dataset_dir.split("/")[-1]
+    if history is None:
+        history = {}
+        history["creation_date"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        history["dataset_id"] = dataset_id
+        history["dataset_foldername"] = dataset_dir.split("/")[-1]
     save_history(dataset_dir, history)
 
 
@@ -90,8 +102,20 @@ def delete_all_folders_inside(base_dir):
     ]
 
 
-def datafile_from_raw_to_sip(filename_source, filename_target, overwrite_all=False):
-    """Save raw data to SIP.
+def materialize_file(filename_source, filename_target, strategy="copy"):
+    """Materialize a file at a new location.
+
+    Strategies:
+
+    * ``copy``: copy the bytes.
+    * ``hardlink``: create a hard link to the same inode.
+    * ``reflink``: clone the extents (copy-on-write, e.g. Btrfs, XFS) or let
+      the kernel copy them with ``copy_file_range``.
+    * ``symlink``: create a symbolic link to the absolute source path.
+
+    If the filesystem does not support the chosen strategy (e.g. links
+    across devices), the file is copied instead. An existing target is
+    removed first, so a linked target never writes through to its source.
 
     Parameters
     ----------
@@ -99,32 +123,340 @@ def datafile_from_raw_to_sip(filename_source, filename_target, overwrite_all=Fal
         Relative path of source file.
     filename_target : string
         Relative path of target file.
+    strategy : string
+        One of `MATERIALIZE_STRATEGIES`.
+
+    Returns
+    -------
+    string
+        Strategy actually used.
+
+    Raises
+    ------
+    ValueError
+        If the strategy is not one of `MATERIALIZE_STRATEGIES`.
 
     """
-    if not os.path.isfile(filename_target) or overwrite_all:
-        shutil.copyfile(filename_source, filename_target)
+    if strategy not in MATERIALIZE_STRATEGIES:
+        raise ValueError(
+            "Materialization strategy {0} not one of: {1}.".format(
+                strategy, ", ".join(MATERIALIZE_STRATEGIES)
+            )
+        )
+    if os.path.lexists(filename_target):
+        os.remove(filename_target)
+    try:
+        if strategy == "hardlink":
+            os.link(filename_source, filename_target)
+            return strategy
+        elif strategy == "symlink":
+            os.symlink(os.path.abspath(filename_source), filename_target)
+            return strategy
+        elif strategy == "reflink":
+            return reflink_file(filename_source, filename_target)
+    except OSError:
+        if os.path.lexists(filename_target):
+            os.remove(filename_target)
+    shutil.copyfile(filename_source, filename_target)
+    return "copy"
 
 
-def datafile_from_sip_to_aip(filename_source, filename_target, overwrite_all=False):
-    """Process raw files from SIP to AIP.
+def reflink_file(filename_source, filename_target):
+    """Clone a file with ``FICLONE``, else with ``copy_file_range``.
+
+    Parameters
+    ----------
+    filename_source : string
+        Relative path of source file.
+    filename_target : string
+        Relative path of target file.
+
+    Returns
+    -------
+    string
+        ``reflink`` if the extents were cloned, ``copy_file_range`` if they
+        were copied inside the kernel.
+
+    Raises
+    -------
+    OSError
+        If neither is supported for the two files.
+
+    """
+    with open(filename_source, "rb") as src, open(filename_target, "wb") as dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        if not hasattr(os, "copy_file_range"):
+            raise OSError("copy_file_range is not available.")
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset)
+            if not copied:
+                raise OSError("copy_file_range stopped at byte {0}.".format(offset))
+            offset += copied
+        return "copy_file_range"
+
+
+def checksum_file(filename, algorithm="md5"):
+    """Calculate the checksum of a file.
+
+    Parameters
+    ----------
+    filename : string
+        Relative path of file.
+    algorithm : string
+        Name of the hash algorithm, as accepted by :func:`hashlib.new`.
+        Defaults to ``md5``.
+
+    Returns
+    -------
+    string
+        Checksum as hex string.
+
+    """
+    checksum = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def copy_with_checksum(filename_source, filename_target):
+    """Copy a file and calculate its MD5 checksum in the same pass.
+
+    Parameters
+    ----------
+    filename_source : string
+        Relative path of source file.
+    filename_target : string
+        Relative path of target file.
+
+    Returns
+    -------
+    string
+        MD5 checksum as hex string.
+
+    """
+    checksum = hashlib.md5()
+    if os.path.lexists(filename_target):
+        os.remove(filename_target)
+    with open(filename_source, "rb") as src, open(filename_target, "wb") as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+            dst.write(chunk)
+    return checksum.hexdigest()
+
+
+def read_manifest(dataset_dir):
+    """Read the checksum manifest of a dataset.
+
+    The manifest holds MD5 checksum, size and modification time of every raw
+    file at the time it was copied to the SIP, by filename. ``aip_md5`` and
+    ``dip_md5`` hold the checksum of the file the AIP and DIP copies were
+    made from.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+
+    Returns
+    -------
+    dict
+        Manifest entries by filename. Empty, if there is no manifest yet.
+
+    """
+    dataset_id = dataset_dir.split("/")[-1]
+    filename = os.path.join(dataset_dir, "{0}_manifest.json".format(dataset_id))
+    if os.path.isfile(filename):
+        return read_json(filename)
+    return {}
+
+
+def save_manifest(dataset_dir, manifest):
+    """Save the checksum manifest of a dataset.
 
     Parameters
     ----------
     dataset_dir : string
         Full path of dataset directory.
+    manifest : dict
+        Manifest entries by filename.
+
+    """
+    dataset_id = dataset_dir.split("/")[-1]
+    write_json(
+        os.path.join(dataset_dir, "{0}_manifest.json".format(dataset_id)), manifest
+    )
+
+
+def is_unchanged(filename_target, entry, stat_source=None):
+    """Check a file against its manifest entry, without reading it.
+
+    Parameters
+    ----------
+    filename_target : string
+        Relative path of file to check.
+    entry : dict
+        Manifest entry of the file, or ``None``.
+    stat_source : os.stat_result
+        If passed, the source must also still match size and modification
+        time of the entry.
+
+    Returns
+    -------
+    bool
+        ``True`` if the file exists and matches the entry.
+
+    """
+    if not entry or not os.path.isfile(filename_target):
+        return False
+    if stat_source is not None:
+        if (
+            stat_source.st_size != entry["size"]
+            or stat_source.st_mtime != entry["mtime"]
+        ):
+            return False
+    return os.path.getsize(filename_target) == entry["size"]
+
+
+def is_copy_current(filename_target, entry, key):
+    """Check an AIP or DIP copy against its manifest entry, without reading it.
+
+    Parameters
+    ----------
+    filename_target : string
+        Relative path of file to check.
+    entry : dict
+        Manifest entry of the file, or ``None``.
+    key : string
+        Key of the checksum the copy was made from, ``aip_md5`` or
+        ``dip_md5``.
+
+    Returns
+    -------
+    bool
+        ``True`` if the copy matches the entry and was made from the current
+        SIP file. ``False`` after the SIP file was copied again.
+
+    """
+    return is_unchanged(filename_target, entry) and entry.get(key) == entry["md5"]
+
+
+def datafile_from_raw_to_sip(
+    filename_source,
+    filename_target,
+    overwrite_all=False,
+    strategy="copy",
+    manifest=None,
+):
+    """Save raw data to SIP.
+
+    If a manifest is passed, the MD5 checksum is calculated while copying
+    and recorded together with size and modification time of the raw file.
+    An existing SIP file is only copied again, if the raw file changed or
+    the SIP file does not match the manifest. Linked strategies read only
+    new or changed raw files for the checksum, otherwise the checksum of
+    the manifest is kept.
+
+    Parameters
+    ----------
     filename_source : string
         Relative path of source file.
     filename_target : string
         Relative path of target file.
+    strategy : string
+        Materialization strategy, see :func:`materialize_file`.
+    manifest : dict
+        Manifest of the dataset, see :func:`read_manifest`. Updated in place.
 
     """
-    if not os.path.isfile(filename_target) or overwrite_all:
-        shutil.copyfile(filename_source, filename_target)
-    # os.path.join(dataset_dir, AIP_FOLDER, '{0}'.format(filename_target)))
+    if manifest is None:
+        if not os.path.isfile(filename_target) or overwrite_all:
+            materialize_file(filename_source, filename_target, strategy)
+        return
+    filename = os.path.basename(filename_target)
+    stat_source = os.stat(filename_source)
+    entry = manifest.get(filename)
+    if not overwrite_all and is_unchanged(filename_target, entry, stat_source):
+        return
+    raw_unchanged = (
+        entry is not None
+        and entry["size"] == stat_source.st_size
+        and entry["mtime"] == stat_source.st_mtime
+    )
+    md5 = None
+    if (
+        not overwrite_all
+        and entry is None
+        and os.path.isfile(filename_target)
+        and os.path.getsize(filename_target) == stat_source.st_size
+    ):
+        # SIP created before manifests existed: record it without copying,
+        # if it has the content of the raw file
+        md5 = checksum_file(filename_source)
+        if checksum_file(filename_target) != md5:
+            md5 = None
+    if md5 is None:
+        if strategy == "copy":
+            md5 = copy_with_checksum(filename_source, filename_target)
+        else:
+            materialize_file(filename_source, filename_target, strategy)
+            md5 = entry["md5"] if raw_unchanged else checksum_file(filename_source)
+    if raw_unchanged and md5 == entry["md5"]:
+        # same content as before, so the AIP and DIP copies stay valid
+        return
+    manifest[filename] = {
+        "md5": md5,
+        "size": stat_source.st_size,
+        "mtime": stat_source.st_mtime,
+    }
 
 
-def datafile_from_aip_to_dip(dataset_dir, filename, overwrite_all=False):
-    """Short summary.
+def datafile_from_sip_to_aip(
+    filename_source,
+    filename_target,
+    overwrite_all=False,
+    strategy="copy",
+    manifest=None,
+):
+    """Process raw files from SIP to AIP.
+
+    Parameters
+    ----------
+    filename_source : string
+        Relative path of source file.
+    filename_target : string
+        Relative path of target file.
+    strategy : string
+        Materialization strategy, see :func:`materialize_file`.
+    manifest : dict
+        Manifest of the dataset. If passed, an existing AIP file is copied
+        again when it does not match the manifest or the SIP file was copied
+        again. Updated in place.
+
+    """
+    entry = None
+    if manifest is None:
+        do_copy = not os.path.isfile(filename_target)
+    else:
+        entry = manifest.get(os.path.basename(filename_target))
+        do_copy = not is_copy_current(filename_target, entry, "aip_md5")
+    if do_copy or overwrite_all:
+        materialize_file(filename_source, filename_target, strategy)
+        if entry:
+            entry["aip_md5"] = entry["md5"]
+
+
+def datafile_from_aip_to_dip(
+    dataset_dir, filename, overwrite_all=False, strategy="copy", manifest=None
+):
+    """Provide AIP file in DIP.
 
     Parameters
     ----------
@@ -132,21 +464,208 @@ def datafile_from_aip_to_dip(dataset_dir, filename, overwrite_all=False):
         Full path of dataset directory.
     filename : string
         Relative path of file.
+    strategy : string
+        Materialization strategy, see :func:`materialize_file`.
+    manifest : dict
+        Manifest of the dataset. If passed, an existing DIP file is copied
+        again when it does not match the manifest or the AIP file was copied
+        again. Updated in place.
 
     """
-    if (
-        not os.path.isfile(
-            os.path.join(dataset_dir, DIP_FOLDER, "{0}".format(filename))
-        )
-        or overwrite_all
-    ):
-        shutil.copyfile(
+    filename_target = os.path.join(dataset_dir, DIP_FOLDER, "{0}".format(filename))
+    entry = None
+    if manifest is None:
+        do_copy = not os.path.isfile(filename_target)
+    else:
+        entry = manifest.get(filename)
+        do_copy = not is_copy_current(filename_target, entry, "dip_md5")
+    if do_copy or overwrite_all:
+        materialize_file(
             os.path.join(dataset_dir, AIP_FOLDER, "{0}".format(filename)),
-            os.path.join(dataset_dir, DIP_FOLDER, "{0}".format(filename)),
+            filename_target,
+            strategy,
         )
+        if entry:
+            entry["dip_md5"] = entry.get("aip_md5")
+
+
+def verify_manifest(dataset_dir, manifest, deep=False):
+    """Verify the SIP, AIP and DIP files of a dataset against its manifest.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+    manifest : dict
+        Manifest of the dataset.
+    deep : bool
+        ``True`` to compare the MD5 checksums too, which reads every file.
+        ``False`` to only compare existence and size.
+
+    Returns
+    -------
+    list
+        Relative paths of files, which do not match the manifest.
+
+    """
+    mismatches = []
+    for filename, entry in manifest.items():
+        for folder in [SIP_FOLDER, AIP_FOLDER, DIP_FOLDER]:
+            filename_copy = os.path.join(dataset_dir, folder, filename)
+            if not is_unchanged(filename_copy, entry):
+                mismatches.append(os.path.join(folder, filename))
+            elif deep and checksum_file(filename_copy) != entry["md5"]:
+                mismatches.append(os.path.join(folder, filename))
+    return mismatches
+
+
+def payload_hash(model, data):
+    """Hash the metadata a payload is created from.
+
+    The ``org.*`` keys hold the migration status (e. g. ``org.is_uploaded``)
+    and are not part of the payload, so they are left out.
+
+    Parameters
+    ----------
+    model : class
+        pyDataverse model class, e. g. :class:`Dataset`.
+    data : dict
+        Metadata as dict.
+
+    Returns
+    -------
+    string
+        SHA-256 hash.
+
+    """
+    metadata = {key: val for key, val in data.items() if not key.startswith("org.")}
+    return hashlib.sha256(
+        json.dumps([model.__name__, metadata], sort_keys=True, default=str).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+
+
+def build_payload(model, data):
+    """Construct, validate and serialize metadata via a pyDataverse model.
+
+    Parameters
+    ----------
+    model : class
+        pyDataverse model class, e. g. :class:`Dataset`.
+    data : dict
+        Metadata as dict.
+
+    Returns
+    -------
+    string
+        Payload as JSON string.
+
+    """
+    obj = model()
+    obj.set(dict(data))
+    return obj.json()
+
+
+def is_payload_current(dataset_dir, filename, model, data):
+    """Check if a payload file was created from the same metadata.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+    filename : string
+        Full path of the payload JSON file.
+    model : class
+        pyDataverse model class, e. g. :class:`Dataset`.
+    data : dict
+        Metadata as dict.
+
+    Returns
+    -------
+    bool
+        ``True`` if the file exists and its hash matches the metadata.
+
+    """
+    key = os.path.relpath(filename, os.path.dirname(os.path.abspath(dataset_dir)))
+    stored_hash = get_state_store(dataset_dir).read_payload_hash(key)
+    return os.path.isfile(filename) and stored_hash == payload_hash(model, data)
+
+
+def save_payload(dataset_dir, filename, model, data, payload=None):
+    """Serialize metadata via a pyDataverse model, unless already done.
+
+    The model is only constructed, validated and serialized, if the file
+    does not exist yet or was created from different metadata. The hashes
+    are kept in the state store.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+    filename : string
+        Full path of the payload JSON file.
+    model : class
+        pyDataverse model class, e. g. :class:`Dataset`.
+    data : dict
+        Metadata as dict.
+    payload : string
+        Payload already built from `data` with :func:`build_payload`.
+
+    Returns
+    -------
+    bool
+        ``True`` if the file was (re-)written.
 
+    """
+    if is_payload_current(dataset_dir, filename, model, data):
+        return False
+    if payload is None:
+        payload = build_payload(model, data)
+    write_file(filename, payload)
+    key = os.path.relpath(filename, os.path.dirname(os.path.abspath(dataset_dir)))
+    get_state_store(dataset_dir).save_payload_hash(key, payload_hash(model, data))
+    return True
+
+
+def read_payload(dataset_dir, filename, model, data):
+    """Return the serialized payload of metadata, creating it if needed.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+    filename : string
+        Full path of the payload JSON file.
+    model : class
+        pyDataverse model class, e. g. :class:`Dataset`.
+    data : dict
+        Metadata as dict.
 
-def save_dataset_dataverse_json(dataset_dir, data, dataset_id):
+    Returns
+    -------
+    string
+        Payload as JSON string.
+
+    """
+    save_payload(dataset_dir, filename, model, data)
+    with open(filename, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def dataset_json_filename(dataset_dir, dataset_id):
+    """Return the full path of the dataset JSON inside the AIP."""
+    return os.path.join(dataset_dir, AIP_FOLDER, "{0}_dataset.json".format(dataset_id))
+
+
+def datafile_json_filename(dataset_dir, dataset_id, datafile_id):
+    """Return the full path of a datafile JSON inside the AIP."""
+    return os.path.join(
+        dataset_dir, AIP_FOLDER, "{0}_{1}_datafile.json".format(dataset_id, datafile_id)
+    )
+
+
+def save_dataset_dataverse_json(dataset_dir, data, dataset_id, payload=None):
     """Save dataset JSON to DVTree structure.
 
     Parameters
@@ -157,13 +676,28 @@ def save_dataset_dataverse_json(dataset_dir, data, dataset_id):
         Dataset data as dict.
     dataset_id : string
         Dataset ID.
+    payload : string
+        Dataset JSON already built from `data`.
 
     """
-    ds = Dataset()
-    ds.set(data)
-    write_file(
-        os.path.join(dataset_dir, AIP_FOLDER, "{0}_dataset.json".format(dataset_id)),
-        ds.json(),
+    save_payload(
+        dataset_dir,
+        dataset_json_filename(dataset_dir, dataset_id),
+        Dataset,
+        data,
+        payload,
+    )
+
+
+def build_dataset_payload(data):
+    """Return the dataset JSON of metadata, without saving it."""
+    return build_payload(Dataset, data)
+
+
+def is_dataset_payload_current(dataset_dir, data, dataset_id):
+    """Check if the dataset JSON of the AIP was created from `data`."""
+    return is_payload_current(
+        dataset_dir, dataset_json_filename(dataset_dir, dataset_id), Dataset, data
     )
 
 
@@ -182,66 +716,137 @@ def save_datafile_dataverse_json(dataset_dir, data, dataset_id, datafile_id):
         Datafile ID.
 
     """
-    datafile = Datafile()
-    datafile.set(data)
-    datafile.export_data(
-        os.path.join(
-            dataset_dir,
-            AIP_FOLDER,
-            "{0}_{1}_datafile.json".format(dataset_id, datafile_id),
-        )
+    save_payload(
+        dataset_dir,
+        datafile_json_filename(dataset_dir, dataset_id, datafile_id),
+        Datafile,
+        data,
     )
 
 
-def read_history(dataset_dir):
-    """Read internal Dataset metadata from JSON file.
+def read_dataset_payload(dataset_dir, data, dataset_id):
+    """Read the dataset JSON from the AIP, to upload it.
 
     Parameters
     ----------
     dataset_dir : string
         Full path of dataset directory.
+    data : dict
+        Dataset data as dict.
+    dataset_id : string
+        Dataset ID.
 
     Returns
     -------
-    dict
-        Internal Dataset related history as dict.
+    string
+        Dataset JSON, created first if missing or outdated.
 
     """
-    dataset_id = dataset_dir.split("/")[-1]
-    history = read_json(
-        os.path.join(dataset_dir, "{0}_history.json".format(dataset_id))
+    return read_payload(
+        dataset_dir, dataset_json_filename(dataset_dir, dataset_id), Dataset, data
     )
-    return history
 
 
-def save_history(dataset_dir, history):
-    """Short summary.
+def read_datafile_payload(dataset_dir, data, dataset_id, datafile_id):
+    """Read a datafile JSON from the AIP, to upload it.
 
     Parameters
     ----------
-    dataset_dir : type
-        Description of parameter `dataset_dir`.
-    history : type
-        Description of parameter `history`.
+    dataset_dir : string
+        Full path of dataset directory.
+    data : dict
+        Datafile data as dict.
+    dataset_id : string
+        Dataset ID.
+    datafile_id : string
+        Datafile ID.
 
     Returns
     -------
-    type
-        Description of returned object.
+    string
+        Datafile JSON, created first if missing or outdated.
 
-    Raises
+    """
+    return read_payload(
+        dataset_dir,
+        datafile_json_filename(dataset_dir, dataset_id, datafile_id),
+        Datafile,
+        data,
+    )
+
+
+def open_state_store(ingest_dir):
+    """Open the state store of an ingest directory.
+
+    All datasets inside one ingest directory share one store, which is
+    created on first use, together with the ingest directory if missing.
+
+    Parameters
+    ----------
+    ingest_dir : string
+        Full path of the ingest directory.
+
+    Returns
     -------
-    ExceptionName
-        Why the exception is raised.
+    StateStore
+        State store of the ingest directory.
 
-    Examples
+    """
+    filename = os.path.join(os.path.abspath(ingest_dir), STATE_STORE_FILENAME)
+    with STATE_STORES_LOCK:
+        if filename not in STATE_STORES:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            STATE_STORES[filename] = StateStore(filename)
+        return STATE_STORES[filename]
+
+
+def get_state_store(dataset_dir):
+    """Get the state store of the ingest directory of a dataset.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+
+    Returns
     -------
-    Examples should be written in doctest format, and
-    should illustrate how to use the function/class.
-    >>>
+    StateStore
+        State store of the ingest directory.
 
     """
-    """Save internal Dataset metadata to JSON file.
+    return open_state_store(os.path.dirname(os.path.abspath(dataset_dir)))
+
+
+def read_history(dataset_dir):
+    """Read internal Dataset metadata from the state store.
+
+    Histories which only exist as legacy ``{id}_history.json`` file are
+    imported into the state store on first read.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+
+    Returns
+    -------
+    dict
+        Internal Dataset related history as dict.
+
+    """
+    dataset_id = dataset_dir.split("/")[-1]
+    store = get_state_store(dataset_dir)
+    history = store.read_history(dataset_id)
+    if history is None:
+        history = read_json(
+            os.path.join(dataset_dir, "{0}_history.json".format(dataset_id))
+        )
+        store.save_history(dataset_id, history)
+    return history
+
+
+def save_history(dataset_dir, history):
+    """Save internal Dataset metadata to the state store.
 
     Parameters
     ----------
@@ -252,11 +857,56 @@ def save_history(dataset_dir, history):
 
     """
     dataset_id = dataset_dir.split("/")[-1]
-    write_json(
-        os.path.join(dataset_dir, "{0}_history.json".format(dataset_id)), history
+    get_state_store(dataset_dir).save_history(dataset_id, history)
+
+
+def save_datafile_history(dataset_dir, datafile_id, datafile_history):
+    """Save internal Datafile metadata to the state store.
+
+    Only the row of the datafile is written, not the whole Dataset history.
+
+    Parameters
+    ----------
+    dataset_dir : string
+        Full path of dataset directory.
+    datafile_id : string
+        Datafile ID.
+    datafile_history : dict
+        Internal Datafile related history as dict.
+
+    """
+    dataset_id = dataset_dir.split("/")[-1]
+    get_state_store(dataset_dir).save_datafile_history(
+        dataset_id, datafile_id, datafile_history
     )
 
 
+def import_history_files(ingest_dir):
+    """Import all ``{id}_history.json`` files of an ingest directory.
+
+    Parameters
+    ----------
+    ingest_dir : string
+        Full path of the ingest directory.
+
+    Returns
+    -------
+    int
+        Number of imported histories.
+
+    """
+    histories = {}
+    for dataset_id in os.listdir(ingest_dir):
+        filename = os.path.join(
+            ingest_dir, dataset_id, "{0}_history.json".format(dataset_id)
+        )
+        if os.path.isfile(filename):
+            histories[dataset_id] = read_json(filename)
+    if histories:
+        open_state_store(ingest_dir).save_histories(histories)
+    return len(histories)
+
+
 def update_csv(filename, data, delimiter=",", quotechar='"'):
     """Short summary.
 
@@ -307,6 +957,106 @@ def update_csv(filename, data, delimiter=",", quotechar='"'):
     shutil.move(tempfile.name, filename)
 
 
+class StatusJournal(object):
+    """Append-only journal of status changes for a CSV file.
+
+    Status changes are appended to ``{filename}.journal`` as one JSON line
+    each, as soon as they are known. :func:`compact` merges them into the
+    CSV file in one pass, so a crashed run does not lose its progress.
+
+    """
+
+    def __init__(self, filename, delimiter=",", quotechar='"'):
+        """Init a StatusJournal() class.
+
+        Parameters
+        ----------
+        filename : string
+            Full path of the CSV file.
+        delimiter : string
+            Cell delimiter of CSV file.
+        quotechar : string
+            Quote-character of CSV file.
+
+        """
+        self.filename = filename
+        self.filename_journal = "{0}.journal".format(filename)
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        """Return name of StatusJournal() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the StatusJournal() class.
+
+        """
+        return "Status journal {0}".format(self.filename_journal)
+
+    def append(self, row_id, values):
+        """Append the status changes of one row durably to the journal.
+
+        Parameters
+        ----------
+        row_id : string
+            ID of the row in the CSV file.
+        values : dict
+            Changed column values of the row.
+
+        """
+        line = json.dumps({"id": row_id, "values": values})
+        with self.lock, open(self.filename_journal, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self):
+        """Read the journal, later entries overriding earlier ones.
+
+        Returns
+        -------
+        dict
+            Changed column values by row ID.
+
+        """
+        data = {}
+        if os.path.isfile(self.filename_journal):
+            with open(self.filename_journal, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted write
+                        continue
+                    data.setdefault(entry["id"], {}).update(entry["values"])
+        return data
+
+    def compact(self):
+        """Merge the journal into the CSV file and remove it.
+
+        Returns
+        -------
+        int
+            Number of updated rows.
+
+        """
+        with self.lock:
+            data = self.read()
+            if data:
+                update_csv(
+                    self.filename,
+                    data,
+                    delimiter=self.delimiter,
+                    quotechar=self.quotechar,
+                )
+            if os.path.isfile(self.filename_journal):
+                os.remove(self.filename_journal)
+        return len(data)
+
+
 class History(object):
     """Doc."""
 
@@ -0,0 +1,229 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Dependency graph of per-item stages with resumable checkpoints."""
+import threading
+from contextlib import nullcontext
+
+from workers import run_concurrent
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+BLOCKED = "blocked"
+CHECKPOINT = "checkpoint"
+STATUSES = [DONE, SKIPPED, FAILED, BLOCKED, CHECKPOINT]
+
+
+class Stage(object):
+    """One step of the pipeline, run once per item."""
+
+    def __init__(self, name, func, depends=None, workers=None):
+        """Init a Stage() class.
+
+        Parameters
+        ----------
+        name : string
+            Stage name, used for the checkpoints.
+        func : callable
+            Called with item ID and item. Returns ``DONE`` (or ``None``) on
+            success, ``SKIPPED`` if there was nothing to do. Exceptions mark
+            the stage as failed for the item.
+        depends : list
+            Names of the stages, which must be done for an item first.
+        workers : int
+            Maximum number of items in this stage at the same time.
+            ``None`` for no limit besides the pipeline workers.
+
+        """
+        self.name = name
+        self.func = func
+        self.depends = list(depends or [])
+        self.workers = workers
+        if workers:
+            self.semaphore = threading.BoundedSemaphore(workers)
+        else:
+            self.semaphore = nullcontext()
+
+    def __str__(self):
+        """Return name of Stage() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the Stage() class.
+
+        """
+        return "Stage {0}".format(self.name)
+
+
+class Pipeline(object):
+    """Run the stages of a dependency graph for many items.
+
+    Every item (e. g. a dataset) passes the stages on its own: as soon as
+    a stage is done for an item, the next stage of this item starts, while
+    other items are still in earlier stages. Completed stages are saved as
+    checkpoints in the state store, so a restarted pipeline continues where
+    it stopped.
+
+    """
+
+    def __init__(self, stages, store, max_workers=1):
+        """Init a Pipeline() class.
+
+        Parameters
+        ----------
+        stages : list
+            :class:`Stage` objects.
+        store : state.StateStore
+            Store for the checkpoints.
+        max_workers : int
+            Number of items processed concurrently.
+
+        """
+        self.stages = sort_stages(stages)
+        self.store = store
+        self.max_workers = max_workers
+
+    def __str__(self):
+        """Return name of Pipeline() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the Pipeline() class.
+
+        """
+        return "Pipeline {0}".format(" -> ".join(stage.name for stage in self.stages))
+
+    def select(self, targets=None):
+        """Return the stages needed to reach the target stages, in order.
+
+        Parameters
+        ----------
+        targets : list
+            Names of the target stages. ``None`` selects all stages.
+
+        Returns
+        -------
+        list
+            :class:`Stage` objects.
+
+        """
+        if targets is None:
+            return list(self.stages)
+        by_name = {stage.name: stage for stage in self.stages}
+        selected = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in by_name:
+                raise ValueError("Unknown stage {0}.".format(name))
+            if name not in selected:
+                selected.add(name)
+                todo += by_name[name].depends
+        return [stage for stage in self.stages if stage.name in selected]
+
+    def run(self, items, targets=None, force=False):
+        """Run the pipeline.
+
+        Parameters
+        ----------
+        items : iterable
+            (item ID, item) tuples, e. g. ``data.items()``.
+        targets : list
+            Names of the stages to reach. Their dependencies run as well.
+            ``None`` runs all stages.
+        force : bool
+            ``True`` to ignore the checkpoints and run all stages again.
+
+        Returns
+        -------
+        dict
+            Number of items per status, by stage name.
+
+        """
+        stages = self.select(targets)
+        completed = {}
+        if not force:
+            completed = self.store.read_stage_items()
+        summary = {stage.name: dict.fromkeys(STATUSES, 0) for stage in stages}
+
+        def process(item):
+            item_id, data = item
+            return self.run_item(item_id, data, stages, completed.get(item_id, set()))
+
+        for results in run_concurrent(process, items, self.max_workers):
+            for name, status in results.items():
+                summary[name][status] += 1
+        return summary
+
+    def run_item(self, item_id, data, stages, completed):
+        """Run the stages of one item, skipping completed ones.
+
+        Returns
+        -------
+        dict
+            Status by stage name.
+
+        """
+        done = set(completed)
+        results = {}
+        for stage in stages:
+            if stage.name in done:
+                results[stage.name] = CHECKPOINT
+                continue
+            if not all(name in done for name in stage.depends):
+                results[stage.name] = BLOCKED
+                continue
+            error = None
+            with stage.semaphore:
+                try:
+                    status = stage.func(item_id, data) or DONE
+                except Exception as e:
+                    status = FAILED
+                    error = "{0}: {1}".format(type(e).__name__, e)
+            self.store.save_stage_item(stage.name, item_id, status, error)
+            if status == DONE:
+                done.add(stage.name)
+            elif status == FAILED:
+                print(
+                    "ERROR: Stage {0} of {1} - {2}".format(stage.name, item_id, error)
+                )
+            results[stage.name] = status
+        return results
+
+
+def sort_stages(stages):
+    """Sort stages topologically, keeping the given order where possible.
+
+    Raises
+    ------
+    ValueError
+        If a dependency is unknown or the stages depend on each other in a
+        cycle.
+
+    """
+    names = [stage.name for stage in stages]
+    for stage in stages:
+        for name in stage.depends:
+            if name not in names:
+                raise ValueError(
+                    "Stage {0} depends on unknown stage {1}.".format(stage.name, name)
+                )
+    ordered = []
+    placed = set()
+    remaining = list(stages)
+    while remaining:
+        for stage in remaining:
+            if all(name in placed for name in stage.depends):
+                ordered.append(stage)
+                placed.add(stage.name)
+                remaining.remove(stage)
+                break
+        else:
+            raise ValueError(
+                "Stages {0} depend on each other.".format(
+                    ", ".join(stage.name for stage in remaining)
+                )
+            )
+    return ordered
@@ -0,0 +1,411 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SQLite based migration state store."""
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    dataset_id TEXT PRIMARY KEY,
+    pid TEXT,
+    upload_date TEXT,
+    history TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS datasets_pid ON datasets (pid);
+CREATE TABLE IF NOT EXISTS datafiles (
+    dataset_id TEXT NOT NULL,
+    datafile_id TEXT NOT NULL,
+    filename TEXT,
+    upload_date TEXT,
+    history TEXT NOT NULL,
+    PRIMARY KEY (dataset_id, datafile_id)
+);
+CREATE TABLE IF NOT EXISTS payloads (
+    filename TEXT PRIMARY KEY,
+    metadata_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    filename TEXT PRIMARY KEY,
+    upload TEXT NOT NULL,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS stage_items (
+    stage TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    finished TEXT,
+    error TEXT,
+    PRIMARY KEY (stage, item_id)
+);
+"""
+
+
+class StateStore(object):
+    """Transactional store for the Dataset and Datafile histories.
+
+    One SQLite database (in WAL mode) holds the histories of all datasets
+    of an ingest directory. Every thread gets its own connection, so
+    concurrent workers can read and write the store safely.
+
+    """
+
+    def __init__(self, filename):
+        """Init a StateStore() class.
+
+        Parameters
+        ----------
+        filename : string
+            Full path of the SQLite database file.
+
+        """
+        self.filename = filename
+        self.local = threading.local()
+        self.connection.executescript(SCHEMA)
+
+    def __str__(self):
+        """Return name of StateStore() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the StateStore() class.
+
+        """
+        return "State store {0}".format(self.filename)
+
+    @property
+    def connection(self):
+        """Return the SQLite connection of the current thread."""
+        conn = getattr(self.local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in one write transaction."""
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def read_history(self, dataset_id):
+        """Read the history of a dataset.
+
+        Parameters
+        ----------
+        dataset_id : string
+            Dataset ID.
+
+        Returns
+        -------
+        dict
+            Internal Dataset related history as dict, ``None`` if the dataset
+            is not in the store.
+
+        """
+        row = self.connection.execute(
+            "SELECT history FROM datasets WHERE dataset_id = ?", (dataset_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        history = json.loads(row[0])
+        datafiles = self.connection.execute(
+            "SELECT datafile_id, history FROM datafiles WHERE dataset_id = ?",
+            (dataset_id,),
+        ).fetchall()
+        if datafiles:
+            history["datafiles"] = {
+                datafile_id: json.loads(df_history)
+                for datafile_id, df_history in datafiles
+            }
+        return history
+
+    def save_history(self, dataset_id, history):
+        """Save the history of a dataset, replacing the stored one.
+
+        Parameters
+        ----------
+        dataset_id : string
+            Dataset ID.
+        history : dict
+            Internal Dataset related history as dict.
+
+        """
+        with self.transaction() as conn:
+            self._save_history(conn, dataset_id, history)
+
+    def save_histories(self, histories):
+        """Save the histories of many datasets in one transaction.
+
+        Parameters
+        ----------
+        histories : dict
+            Internal Dataset related histories by Dataset ID.
+
+        """
+        with self.transaction() as conn:
+            for dataset_id, history in histories.items():
+                self._save_history(conn, dataset_id, history)
+
+    def _save_history(self, conn, dataset_id, history):
+        ds_history = {key: val for key, val in history.items() if key != "datafiles"}
+        conn.execute(
+            "INSERT OR REPLACE INTO datasets (dataset_id, pid, upload_date, history) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                dataset_id,
+                history.get("pid"),
+                history.get("upload_date"),
+                json.dumps(ds_history),
+            ),
+        )
+        conn.execute("DELETE FROM datafiles WHERE dataset_id = ?", (dataset_id,))
+        for datafile_id, df_history in history.get("datafiles", {}).items():
+            self._save_datafile_history(conn, dataset_id, datafile_id, df_history)
+
+    def save_datafile_history(self, dataset_id, datafile_id, df_history):
+        """Save the history of a single datafile.
+
+        Parameters
+        ----------
+        dataset_id : string
+            Dataset ID.
+        datafile_id : string
+            Datafile ID.
+        df_history : dict
+            Internal Datafile related history as dict.
+
+        """
+        with self.transaction() as conn:
+            self._save_datafile_history(conn, dataset_id, datafile_id, df_history)
+
+    def _save_datafile_history(self, conn, dataset_id, datafile_id, df_history):
+        conn.execute(
+            "INSERT OR REPLACE INTO datafiles "
+            "(dataset_id, datafile_id, filename, upload_date, history) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                dataset_id,
+                datafile_id,
+                df_history.get("filename"),
+                df_history.get("upload_date"),
+                json.dumps(df_history),
+            ),
+        )
+
+    def read_payload_hash(self, filename):
+        """Read the metadata hash of a serialized payload.
+
+        Parameters
+        ----------
+        filename : string
+            Payload filename, relative to the ingest directory.
+
+        Returns
+        -------
+        string
+            Hash of the metadata the payload was created from, ``None`` if
+            the payload is not known.
+
+        """
+        row = self.connection.execute(
+            "SELECT metadata_hash FROM payloads WHERE filename = ?", (filename,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def save_payload_hash(self, filename, metadata_hash):
+        """Save the metadata hash of a serialized payload.
+
+        Parameters
+        ----------
+        filename : string
+            Payload filename, relative to the ingest directory.
+        metadata_hash : string
+            Hash of the metadata the payload was created from.
+
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO payloads (filename, metadata_hash) "
+                "VALUES (?, ?)",
+                (filename, metadata_hash),
+            )
+
+    def read_upload(self, filename):
+        """Read the state of an unfinished direct upload.
+
+        Parameters
+        ----------
+        filename : string
+            Full path of the uploaded file.
+
+        Returns
+        -------
+        dict
+            Upload state (URLs, uploaded parts), ``None`` if there is none.
+
+        """
+        row = self.connection.execute(
+            "SELECT upload FROM uploads WHERE filename = ?", (filename,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_upload(self, filename, upload):
+        """Save the state of an unfinished direct upload.
+
+        Parameters
+        ----------
+        filename : string
+            Full path of the uploaded file.
+        upload : dict
+            Upload state (URLs, uploaded parts).
+
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads (filename, upload, updated) "
+                "VALUES (?, ?, ?)",
+                (
+                    filename,
+                    json.dumps(upload),
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
+
+    def delete_upload(self, filename):
+        """Delete the state of a direct upload, once it is finished.
+
+        Parameters
+        ----------
+        filename : string
+            Full path of the uploaded file.
+
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM uploads WHERE filename = ?", (filename,))
+
+    def read_stage_items(self):
+        """Read the completed pipeline stages of all items.
+
+        Returns
+        -------
+        dict
+            Names of the completed stages (as set) by item ID.
+
+        """
+        completed = {}
+        for stage, item_id in self.connection.execute(
+            "SELECT stage, item_id FROM stage_items WHERE status = 'done'"
+        ):
+            completed.setdefault(item_id, set()).add(stage)
+        return completed
+
+    def save_stage_item(self, stage, item_id, status, error=None):
+        """Save the outcome of a pipeline stage for one item.
+
+        Parameters
+        ----------
+        stage : string
+            Stage name.
+        item_id : string
+            Item ID, e. g. the Dataset ID.
+        status : string
+            Outcome of the stage, ``done`` marks it as completed.
+        error : string
+            Error message of a failed stage.
+
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stage_items "
+                "(stage, item_id, status, finished, error) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    stage,
+                    item_id,
+                    status,
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    error,
+                ),
+            )
+
+    def clear_stage_items(self, stage=None):
+        """Delete the pipeline checkpoints, so the stages run again.
+
+        Parameters
+        ----------
+        stage : string
+            Stage name. ``None`` deletes the checkpoints of all stages.
+
+        """
+        with self.transaction() as conn:
+            if stage is None:
+                conn.execute("DELETE FROM stage_items")
+            else:
+                conn.execute("DELETE FROM stage_items WHERE stage = ?", (stage,))
+
+    def clear(self):
+        """Delete all histories, payload hashes and pipeline checkpoints."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM stage_items")
+            conn.execute("DELETE FROM payloads")
+            conn.execute("DELETE FROM uploads")
+            conn.execute("DELETE FROM datafiles")
+            conn.execute("DELETE FROM datasets")
+
+    def is_dataset_uploaded(self, dataset_id):
+        """Check if a dataset has an upload date.
+
+        Parameters
+        ----------
+        dataset_id : string
+            Dataset ID.
+
+        Returns
+        -------
+        bool
+            ``True`` if the dataset was already uploaded.
+
+        """
+        row = self.connection.execute(
+            "SELECT upload_date FROM datasets WHERE dataset_id = ?", (dataset_id,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def is_datafile_uploaded(self, dataset_id, datafile_id):
+        """Check if a datafile has an upload date.
+
+        Parameters
+        ----------
+        dataset_id : string
+            Dataset ID.
+        datafile_id : string
+            Datafile ID.
+
+        Returns
+        -------
+        bool
+            ``True`` if the datafile was already uploaded.
+
+        """
+        row = self.connection.execute(
+            "SELECT upload_date FROM datafiles "
+            "WHERE dataset_id = ? AND datafile_id = ?",
+            (dataset_id, datafile_id),
+        ).fetchone()
+        return bool(row and row[0])
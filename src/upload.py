@@ -0,0 +1,453 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming and resumable direct uploads of datafiles."""
+import json
+import mimetypes
+import os
+import time
+import uuid
+from urllib.parse import urljoin
+
+from client import get_session
+from metrics import record_request
+from oaistree import checksum_file
+from workers import backoff
+
+CHUNK_SIZE = 1024 * 1024
+# presigned upload URLs expire, by default after 60 minutes
+# (dataverse.files.<id>.url-expiration-minutes)
+URL_EXPIRY = 3600
+# metrics label of the part uploads, as presigned URLs differ per file
+PART_ENDPOINT = "direct-upload-part"
+
+
+class UploadUrlExpired(Exception):
+    """Presigned upload URL rejected by the storage, as it expired."""
+
+
+class FileSlice(object):
+    """File-like view of a byte range of a file, read in chunks.
+
+    Used as request body, so a file is sent from disk with constant memory,
+    instead of being loaded completely.
+
+    """
+
+    def __init__(self, filename, offset=0, length=None, progress=None):
+        """Init a FileSlice() class.
+
+        Parameters
+        ----------
+        filename : string
+            Full path of the file.
+        offset : int
+            First byte of the slice.
+        length : int
+            Number of bytes. ``None`` reads until the end of the file.
+        progress : callable
+            Called with the number of bytes, every time bytes are read.
+
+        """
+        self.file = open(filename, "rb")
+        self.file.seek(offset)
+        if length is None:
+            length = os.path.getsize(filename) - offset
+        self.remaining = length
+        self.length = length
+        self.progress = progress
+
+    def __len__(self):
+        """Return the size of the slice in bytes."""
+        return self.length
+
+    def __str__(self):
+        """Return name of FileSlice() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the FileSlice() class.
+
+        """
+        return "File slice of {0} ({1} bytes)".format(self.file.name, self.length)
+
+    def read(self, size=-1):
+        """Read up to `size` bytes, at most CHUNK_SIZE at once."""
+        if size is None or size < 0 or size > CHUNK_SIZE:
+            size = CHUNK_SIZE
+        chunk = self.file.read(min(size, self.remaining))
+        self.remaining -= len(chunk)
+        if chunk and self.progress:
+            self.progress(len(chunk))
+        return chunk
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+class MultipartStream(object):
+    """Streaming ``multipart/form-data`` body with one file field."""
+
+    def __init__(self, fields, file_field, filename, progress=None):
+        """Init a MultipartStream() class.
+
+        Parameters
+        ----------
+        fields : dict
+            Form fields as name: string value, e. g. ``jsonData``.
+        file_field : string
+            Name of the file field.
+        filename : string
+            Full path of the file.
+        progress : callable
+            Called with the number of file bytes, every time bytes are read.
+
+        """
+        self.boundary = uuid.uuid4().hex
+        head = b""
+        for name, val in fields.items():
+            head += (
+                '--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n'.format(
+                    self.boundary, name
+                ).encode("utf-8")
+                + val.encode("utf-8")
+                + b"\r\n"
+            )
+        head += (
+            "--{0}\r\nContent-Disposition: form-data; "
+            'name="{1}"; filename="{2}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n".format(
+                self.boundary, file_field, os.path.basename(filename)
+            ).encode("utf-8")
+        )
+        tail = "\r\n--{0}--\r\n".format(self.boundary).encode("utf-8")
+        self.file = FileSlice(filename, progress=progress)
+        self.segments = [head, self.file, tail]
+        self.length = len(head) + len(self.file) + len(tail)
+        self.position = 0
+
+    def __len__(self):
+        """Return the size of the body in bytes."""
+        return self.length
+
+    def __str__(self):
+        """Return name of MultipartStream() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the MultipartStream() class.
+
+        """
+        return "Multipart stream ({0} bytes)".format(self.length)
+
+    @property
+    def content_type(self):
+        """Content-Type header of the body."""
+        return "multipart/form-data; boundary={0}".format(self.boundary)
+
+    def read(self, size=-1):
+        """Read the next part of the body."""
+        while self.segments:
+            segment = self.segments[0]
+            if isinstance(segment, bytes):
+                if size is None or size < 0:
+                    size = len(segment)
+                chunk = segment[self.position : self.position + size]
+                self.position += len(chunk)
+                if self.position >= len(segment):
+                    self.segments.pop(0)
+                    self.position = 0
+            else:
+                chunk = segment.read(size)
+                if not chunk:
+                    self.segments.pop(0)
+                    continue
+            if chunk:
+                return chunk
+        return b""
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+def progress_counter(total, progress=None, sent=0):
+    """Turn byte increments into (sent, total) progress calls."""
+    counter = {"sent": sent}
+
+    def advance(num_bytes):
+        counter["sent"] += num_bytes
+        if progress:
+            progress(counter["sent"], total)
+
+    return advance
+
+
+def progress_printer(label, step=10):
+    """Create a progress callback printing every `step` percent.
+
+    Parameters
+    ----------
+    label : string
+        Prefix of the printed lines, e. g. the Datafile ID.
+    step : float
+        Percent between two printed lines.
+
+    Returns
+    -------
+    callable
+        Progress callback, called with bytes sent and total bytes.
+
+    """
+    next_percent = {"val": step}
+
+    def progress(sent, total):
+        percent = 100.0 * sent / total if total else 100.0
+        if percent >= next_percent["val"]:
+            print("{0}: {1}% of {2} bytes sent.".format(label, int(percent), total))
+            next_percent["val"] = (percent // step + 1) * step
+
+    return progress
+
+
+def upload_datafile(api, pid, filename, json_str, progress=None):
+    """Upload a datafile, streaming it from disk.
+
+    Same request as :meth:`pyDataverse.api.NativeApi.upload_datafile`, but
+    the file is not loaded into memory.
+
+    Parameters
+    ----------
+    api : client.PooledNativeApi
+        Native API client.
+    pid : string
+        Persistent identifier of the dataset.
+    filename : string
+        Full path of the file.
+    json_str : string
+        Datafile metadata as JSON string.
+    progress : callable
+        Called with bytes sent and total bytes.
+
+    Returns
+    -------
+    requests.Response
+        Response of the add file request.
+
+    """
+    url = "{0}/datasets/:persistentId/add?persistentId={1}".format(
+        api.base_url_api_native, pid
+    )
+    advance = progress_counter(os.path.getsize(filename), progress)
+    body = MultipartStream({"jsonData": json_str}, "file", filename, advance)
+    try:
+        return api.request(
+            "POST", url, data=body, headers={"Content-Type": body.content_type}
+        )
+    finally:
+        body.close()
+
+
+def direct_upload_datafile(
+    api,
+    pid,
+    filename,
+    json_str,
+    store,
+    md5=None,
+    progress=None,
+    retries=3,
+    url_expiry=URL_EXPIRY,
+):
+    """Upload a datafile directly to the storage of Dataverse, in parts.
+
+    Requires a store with direct upload enabled. The upload URLs and the
+    uploaded parts are kept in the state store, so an interrupted upload
+    continues with the remaining parts, within this call (up to `retries`
+    times per part) or in a later run before the URLs expire. Expired
+    uploads are aborted and started again with new URLs.
+
+    Parameters
+    ----------
+    api : client.PooledNativeApi
+        Native API client.
+    pid : string
+        Persistent identifier of the dataset.
+    filename : string
+        Full path of the file.
+    json_str : string
+        Datafile metadata as JSON string.
+    store : state.StateStore
+        Store for the upload state.
+    md5 : string
+        MD5 checksum of the file, calculated if not passed.
+    progress : callable
+        Called with bytes sent and total bytes.
+    retries : int
+        Number of retries of a failed part.
+    url_expiry : int
+        Seconds after which the presigned URLs expire.
+
+    Returns
+    -------
+    requests.Response
+        Response of the request registering the file in the dataset, or
+        of the failed upload URL request.
+
+    """
+    stat = os.stat(filename)
+    for attempt in range(2):
+        upload = store.read_upload(filename)
+        if upload and (
+            (upload["size"], upload["mtime"]) != (stat.st_size, stat.st_mtime)
+            or time.time() - upload.get("created", 0) > url_expiry
+        ):
+            discard_direct_upload(api, store, filename, upload)
+            upload = None
+        if upload is None:
+            url = (
+                "{0}/datasets/:persistentId/uploadurls?persistentId={1}&size={2}"
+            ).format(api.base_url_api_native, pid, stat.st_size)
+            resp = api.get_request(url, auth=True)
+            if resp.json().get("status") != "OK":
+                return resp
+            upload = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "created": time.time(),
+                "urls": resp.json()["data"],
+                "etags": {},
+            }
+            store.save_upload(filename, upload)
+        try:
+            put_parts(filename, stat.st_size, upload, store, progress, retries)
+            break
+        except UploadUrlExpired:
+            # expired during the upload: start again once with new URLs
+            discard_direct_upload(api, store, filename, upload)
+            if attempt:
+                raise
+
+    urls = upload["urls"]
+    if "complete" in urls:
+        url = urljoin(api.base_url, urls["complete"])
+        resp = api.request("PUT", url, data=json.dumps(upload["etags"]))
+        resp.raise_for_status()
+
+    metadata = json.loads(json_str)
+    metadata["storageIdentifier"] = urls["storageIdentifier"]
+    metadata["fileName"] = os.path.basename(filename)
+    metadata["mimeType"] = (
+        mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    )
+    metadata["checksum"] = {"@type": "MD5", "@value": md5 or checksum_file(filename)}
+    url = "{0}/datasets/:persistentId/add?persistentId={1}".format(
+        api.base_url_api_native, pid
+    )
+    resp = api.request("POST", url, files={"jsonData": (None, json.dumps(metadata))})
+    if resp.json().get("status") == "OK":
+        store.delete_upload(filename)
+    return resp
+
+
+def put_parts(filename, size, upload, store, progress, retries):
+    """Upload the parts missing in the upload state, saving it after each."""
+    urls = upload["urls"]
+    if "url" in urls:
+        parts = {"1": urls["url"]}
+        part_size = size
+    else:
+        parts = urls["urls"]
+        part_size = urls["partSize"]
+    sent = sum(
+        min(part_size, size - (int(num) - 1) * part_size) for num in upload["etags"]
+    )
+    advance = progress_counter(size, progress, sent)
+    for num in sorted(parts, key=int):
+        if num in upload["etags"]:
+            continue
+        offset = (int(num) - 1) * part_size
+        length = min(part_size, size - offset)
+        upload["etags"][num] = put_part(
+            parts[num], filename, offset, length, advance, "url" in urls, retries
+        )
+        store.save_upload(filename, upload)
+
+
+def put_part(url, filename, offset, length, advance, single, retries):
+    """Upload one part to its presigned URL, retrying with backoff.
+
+    Returns
+    -------
+    string
+        ETag of the uploaded part.
+
+    Raises
+    ------
+    UploadUrlExpired
+        If the storage rejects the URL with 403, without retrying.
+
+    """
+    session = get_session()
+    headers = {}
+    if single:
+        # single part uploads are tagged temporary until registered
+        headers["x-amz-tagging"] = "dv-state=temp"
+    delays = backoff()
+    for attempt in range(retries + 1):
+        part = FileSlice(filename, offset, length)
+        try:
+            start = time.perf_counter()
+            try:
+                resp = session.put(
+                    url, data=part, headers=headers, timeout=session.timeout
+                )
+            except Exception:
+                record_request(
+                    "PUT",
+                    url,
+                    "error",
+                    time.perf_counter() - start,
+                    endpoint=PART_ENDPOINT,
+                )
+                raise
+            record_request(
+                "PUT",
+                url,
+                resp.status_code,
+                time.perf_counter() - start,
+                sent_bytes=length,
+                received_bytes=len(resp.content),
+                endpoint=PART_ENDPOINT,
+            )
+            if resp.status_code == 403:
+                raise UploadUrlExpired(url)
+            resp.raise_for_status()
+            advance(length)
+            return resp.headers.get("ETag")
+        except UploadUrlExpired:
+            raise
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(next(delays))
+        finally:
+            part.close()
+
+
+def discard_direct_upload(api, store, filename, upload):
+    """Abort an upload and delete its state, so it starts with new URLs."""
+    abort_direct_upload(api, upload)
+    store.delete_upload(filename)
+
+
+def abort_direct_upload(api, upload):
+    """Abort an outdated multipart upload, ignoring errors."""
+    if "abort" not in upload["urls"]:
+        return
+    try:
+        api.request("DELETE", urljoin(api.base_url, upload["urls"]["abort"]))
+    except Exception:
+        pass
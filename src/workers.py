@@ -0,0 +1,121 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Worker pool and rate limiting helpers for the migration stages."""
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+
+class RateLimiter(object):
+    """Limit the number of API requests per second across threads.
+
+    All workers of a stage share one instance, so the request rate towards
+    Dataverse stays the same, no matter how many workers are used.
+
+    """
+
+    def __init__(self, requests_per_second):
+        """Init a RateLimiter() class.
+
+        Parameters
+        ----------
+        requests_per_second : float
+            Maximum number of requests per second. ``0`` or ``None`` disables
+            the limit.
+
+        """
+        if requests_per_second:
+            self.interval = 1.0 / requests_per_second
+        else:
+            self.interval = 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request is allowed."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def __str__(self):
+        """Return name of RateLimiter() class for users.
+
+        Returns
+        -------
+        string
+            Naming of the RateLimiter() class.
+
+        """
+        return "Rate limiter ({0:.2f}s interval)".format(self.interval)
+
+
+def run_concurrent(func, items, max_workers=1):
+    """Call `func` for each item with a bounded pool of worker threads.
+
+    With ``max_workers=1`` the items are processed sequentially in the
+    calling thread, in the order given. Items are taken lazily from
+    `items`, so generators are not consumed ahead of the workers.
+
+    Parameters
+    ----------
+    func : callable
+        Function called with one item as argument.
+    items : iterable
+        Items to process.
+    max_workers : int
+        Maximum number of worker threads.
+
+    Returns
+    -------
+    generator
+        Yields the return values of `func` as they complete.
+
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def backoff(initial=1.0, factor=2.0, maximum=30.0):
+    """Generate exponentially growing delays.
+
+    Parameters
+    ----------
+    initial : float
+        First delay in seconds.
+    factor : float
+        Multiplier applied after each delay.
+    maximum : float
+        Upper bound of a single delay in seconds.
+
+    Returns
+    -------
+    generator
+        Infinite sequence of delays in seconds.
+
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)